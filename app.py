@@ -1,8 +1,16 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, Form
-from fastapi.responses import Response
+from fastapi.responses import JSONResponse, Response
+import hmac
+from starlette.concurrency import run_in_threadpool
 import os
+import threading
 from dotenv import load_dotenv
-from src.whatsapp_bot import WhatsAppBot
+from src.whatsapp_bot import ACK_MESSAGE, WhatsAppBot
+from src.webhook_guard import MessageDeduplicator, ResendTracker, SenderLanes
+from src.query_profiler import DEFAULT_SLOW_LOG_PATH, REPORT_ORDER_KEYS, QueryProfiler
+from src.loop_monitor import EventLoopLagMonitor
+from src.admission_control import DEFAULT_COST_LOG_PATH, AdmissionController
 import logging
 from twilio.twiml.messaging_response import MessagingResponse
 
@@ -10,43 +18,222 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="VividMoney Analytics Bot")
+_bot = None
+_bot_lock = threading.Lock()
 
-twilio_phone_number = os.getenv("TWILIO_PHONE_NUMBER")
-logger.info(f"Initializing WhatsAppBot with phone number: {twilio_phone_number}")
+# Профилирование выполнения сгенерированного кода включается явно
+query_profiler = QueryProfiler(
+    slow_threshold_seconds=float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "500")) / 1000,
+    log_path=os.getenv("SLOW_QUERY_LOG", DEFAULT_SLOW_LOG_PATH),
+    memory_mode=os.getenv("PROFILE_MEMORY", "rss")
+) if os.getenv("PROFILE_QUERIES", "false").lower() == "true" else None
 
-bot = WhatsAppBot(
-    account_sid=os.getenv("TWILIO_ACCOUNT_SID"),
-    auth_token=os.getenv("TWILIO_AUTH_TOKEN"),
-    phone_number=twilio_phone_number,
-    openai_api_key=os.getenv("OPENAI_API_KEY")
-)
+# Допуск сгенерированного кода по оценке стоимости: быстрая и тяжелая полосы, отказ сверх бюджета.
+# Включается явно; быстрая полоса по умолчанию не уже пула потоков (THREADPOOL_SIZE, у anyio 40)
+admission_controller = AdmissionController(
+    fast_concurrency=int(os.getenv("FAST_LANE_CONCURRENCY", os.getenv("THREADPOOL_SIZE", "40"))),
+    heavy_concurrency=int(os.getenv("HEAVY_LANE_CONCURRENCY", "1")),
+    heavy_threshold=float(os.getenv("HEAVY_COST_THRESHOLD", "5e6")),
+    max_cost=float(os.getenv("MAX_QUERY_COST", "1e9")),
+    heavy_queue_timeout=float(os.getenv("HEAVY_LANE_TIMEOUT", "20")),
+    log_path=os.getenv("QUERY_COST_LOG", DEFAULT_COST_LOG_PATH)
+) if os.getenv("ADMISSION_CONTROL", "false").lower() == "true" else None
+
+def get_bot() -> WhatsAppBot:
+    # Бот создается при первом обращении: импорт app.py не тянет LLM клиенты и данные
+    global _bot
+    if _bot is None:
+        with _bot_lock:
+            if _bot is None:
+                twilio_phone_number = os.getenv("TWILIO_PHONE_NUMBER")
+                logger.info(f"Initializing WhatsAppBot with phone number: {twilio_phone_number}")
+                _bot = WhatsAppBot(
+                    account_sid=os.getenv("TWILIO_ACCOUNT_SID"),
+                    auth_token=os.getenv("TWILIO_AUTH_TOKEN"),
+                    phone_number=twilio_phone_number,
+                    openai_api_key=os.getenv("OPENAI_API_KEY"),
+                    num_candidates=int(os.getenv("CODE_CANDIDATES", "1")),
+                    request_budget=float(os.getenv("LLM_REQUEST_BUDGET", "60")),
+                    twilio_api_base=os.getenv("TWILIO_API_BASE_URL", "https://api.twilio.com"),
+                    messages_per_second=float(os.getenv("TWILIO_MESSAGES_PER_SECOND", "1")),
+                    outbox_path=os.getenv("OUTBOX_PATH", "data/outbox.sqlite3"),
+                    # С --workers N каждый воркер импортирует app.py; общий снапшот в /dev/shm
+                    # не дает каждому из них держать свою копию данных
+                    shared_snapshot_dir=os.getenv("SHARED_SNAPSHOT_DIR"),
+                    query_profiler=query_profiler,
+                    admission_controller=admission_controller,
+                    ack_threshold_seconds=float(os.getenv("ACK_THRESHOLD_SECONDS", "5")),
+                    evaluation_followup=os.getenv("EVALUATION_FOLLOWUP", "true").lower() == "true"
+                )
+    return _bot
+
+def _warmup_in_background():
+    try:
+        timings = get_bot().warmup()
+        logger.info(f"Warmup completed: {timings}")
+    except Exception:
+        logger.exception("Warmup failed")
+
+loop_monitor = EventLoopLagMonitor()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Каждое сообщение держит поток пула на все время ответа; по умолчанию у anyio их 40
+    threadpool_size = os.getenv("THREADPOOL_SIZE")
+    if threadpool_size:
+        import anyio.to_thread
+        anyio.to_thread.current_default_thread_limiter().total_tokens = int(threadpool_size)
+    loop_monitor.start()
+    # Прогрев идет в фоне: порт открывается сразу, а первое сообщение ждет только остаток прогрева
+    if os.getenv("WARMUP_ON_STARTUP", "true").lower() == "true":
+        threading.Thread(target=_warmup_in_background, name="warmup", daemon=True).start()
+    yield
+    await loop_monitor.stop()
+
+app = FastAPI(title="VividMoney Analytics Bot", lifespan=lifespan)
+
+# Индекс MessageSid и очереди отправителей в SQLite общие для воркеров uvicorn;
+# WEBHOOK_STATE_PATH= (пусто) держит их в памяти процесса - только для одного воркера
+webhook_state_path = os.getenv("WEBHOOK_STATE_PATH", "data/webhook_state.sqlite3") or None
+message_deduplicator = MessageDeduplicator(path=webhook_state_path)
+sender_lanes = SenderLanes(cancel_superseded=os.getenv("CANCEL_SUPERSEDED", "false").lower() == "true",
+                           path=webhook_state_path)
+# Поэтапная доставка: "считаю…", ответ, оценка. Повторы вопроса считаются по режиму,
+# так что доля повторов сравнивается между прогонами с STAGED_REPLIES=true и false
+staged_replies = os.getenv("STAGED_REPLIES", "true").lower() == "true"
+resend_tracker = ResendTracker()
 
 @app.get("/")
 async def health_check():
     return {"status": "ok", "service": "VividMoney Analytics Bot"}
 
+@app.get("/ready")
+async def readiness_check():
+    # Строит данные, граф и клиенты; повторные вызовы почти бесплатны
+    try:
+        timings = await run_in_threadpool(get_bot().warmup)
+    except Exception:
+        logger.exception("Readiness check failed")
+        return JSONResponse(status_code=503, content={"status": "not_ready"})
+    return {"status": "ready", "warmup_seconds": timings}
+
+@app.get("/stats/repairs")
+async def repair_stats():
+    return get_bot().analytics_agent.code_repairer.stats()
+
+@app.get("/stats/optimizer")
+async def optimizer_stats():
+    return get_bot().analytics_agent.code_optimizer.stats()
+
+@app.get("/stats/slow-queries")
+async def slow_query_stats(top: int = 10, order_by: str = "total_wall_seconds"):
+    if query_profiler is None:
+        return {"enabled": False}
+    if order_by not in REPORT_ORDER_KEYS:
+        return {"error": f"order_by must be one of {', '.join(REPORT_ORDER_KEYS)}"}
+    return {"enabled": True, **query_profiler.report(top_n=top, order_by=order_by)}
+
+@app.get("/stats/admission")
+async def admission_stats():
+    if admission_controller is None:
+        return {"enabled": False}
+    return {"enabled": True, **admission_controller.stats()}
+
+@app.get("/stats/llm")
+async def llm_stats():
+    return {
+        "analytics_agent": get_bot().analytics_agent.llm_stats(),
+        "answer_evaluator": get_bot().answer_evaluator.llm_stats()
+    }
+
+@app.get("/stats/webhook")
+async def webhook_stats():
+    return {
+        "duplicates": message_deduplicator.duplicates,
+        **sender_lanes.stats(),
+        "reply_mode": "staged" if staged_replies else "single",
+        "resends": resend_tracker.stats(),
+        "reply_latency": get_bot().reply_latency.stats()
+    }
+
+@app.get("/stats/loop")
+async def loop_stats(seconds: float | None = None):
+    # Статистика одного воркера: с --workers N запрос попадает в случайный из них
+    return loop_monitor.stats(seconds)
+
+@app.get("/stats/outbound")
+async def outbound_stats():
+    return get_bot().outbound.stats()
+
+@app.post("/ingest")
+async def ingest(request: Request, batch: dict):
+    # Запись в данные только по токену; без INGEST_TOKEN эндпоинт выключен
+    token = os.getenv("INGEST_TOKEN")
+    if not token:
+        return JSONResponse(status_code=404, content={"error": "Ingest is disabled"})
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return JSONResponse(status_code=401, content={"error": "Invalid ingest token"})
+    
+    from src.ingest import TABLE_ALIASES, IngestError
+    batches = {TABLE_ALIASES.get(name, name): rows for name, rows in batch.items()}
+    try:
+        return await run_in_threadpool(get_bot().data_processor.ingest, batches)
+    except IngestError as e:
+        return JSONResponse(status_code=422, content={"error": str(e), "errors": e.errors})
+
 @app.post("/webhook/whatsapp")
-async def whatsapp_webhook(request: Request, Body: str = Form(...), From: str = Form(...)):
+async def whatsapp_webhook(request: Request, Body: str = Form(...), From: str = Form(...), MessageSid: str | None = Form(None)):
     try:
-        logger.info(f"Received message from {From}: {Body}")
+        logger.info(f"Received message from {From} ({MessageSid}): {Body}")
         
-        response_message = bot.handle_message(From, Body)
-
-        to_number_clean = From.replace('whatsapp:', '')
+        # Return an empty TwiML response to acknowledge receipt
+        twiml_response = MessagingResponse()
         
-        # Send the main answer as a separate message
-        bot.send_message(to_number_clean, response_message)
+        # Twilio повторяет медленные вебхуки с тем же MessageSid. Индекс, очереди отправителей
+        # и отмена ходят в общий SQLite и ждут его блокировку - только из пула потоков
+        if not await run_in_threadpool(message_deduplicator.first_seen, MessageSid):
+            return Response(content=str(twiml_response), media_type="application/xml")
+        
+        try:
+            resend_tracker.observe(From, Body, "staged" if staged_replies else "single")
+            to_number_clean = From.replace('whatsapp:', '')
+            
+            delivered = []
+            
+            def deliver(message: str):
+                get_bot().send_message(to_number_clean, message)
+                resend_tracker.replied(From)
+                delivered.append(message)
+            
+            ticket = await run_in_threadpool(sender_lanes.ticket, From)
+            async with sender_lanes.lane(ticket):
+                if await run_in_threadpool(ticket.is_superseded):
+                    sender_lanes.record_cancelled(ticket)
+                    return Response(content=str(twiml_response), media_type="application/xml")
+                
+                # В поэтапном режиме бот сам отправляет "считаю…" и ответ, здесь остается оценка
+                response_message = await run_in_threadpool(get_bot().handle_message, From, Body, ticket.is_superseded,
+                                                           deliver if staged_replies else None)
+                if response_message is None or await run_in_threadpool(ticket.is_superseded):
+                    # Отменой считаем только вопрос без ответа; "считаю…" ответом не является
+                    if all(message == ACK_MESSAGE for message in delivered):
+                        sender_lanes.record_cancelled(ticket)
+                    return Response(content=str(twiml_response), media_type="application/xml")
+                
+                # Send the main answer as a separate message
+                if response_message:
+                    await run_in_threadpool(deliver, response_message)
+        finally:
+            # Пока MessageSid не отмечен, ретрай после падения воркера будет обработан заново
+            await run_in_threadpool(message_deduplicator.finish, MessageSid)
 
         logger.info(f"Answer sent via send_message: {response_message}")
         
-        # Return an empty TwiML response to acknowledge receipt
-        twiml_response = MessagingResponse()
         return Response(content=str(twiml_response), media_type="application/xml")
         
     except Exception:
         logger.exception("Error processing WhatsApp webhook")
-        error_response = bot.create_webhook_response("Произошла ошибка при обработке сообщения.")
+        error_response = get_bot().create_webhook_response("Произошла ошибка при обработке сообщения.")
         return Response(content=error_response, media_type="application/xml")
 
         
@@ -64,7 +251,7 @@ async def test_query(query: dict):
         if not user_query:
             return {"error": "Message field is required"}
         
-        response = bot.handle_message("test_user", user_query)
+        response = await run_in_threadpool(get_bot().handle_message, "test_user", user_query)
         return {"response": response}
         
     except Exception:
@@ -0,0 +1,118 @@
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from benchmarks.ingest import scaled_frames
+from src.admission_control import AdmissionController, calibrate, load_cost_log
+from src.cost_estimator import estimate_cost
+from src.data_processor import DataProcessor
+
+SCALES = [1, 30, 100]
+QUERIES = {
+    "count": "result = len(orders_df[orders_df['status'] == 'completed'])",
+    "groupby": "result = orders_df.groupby('status')['order_amount'].sum()",
+    "merge": "merged = orders_df.merge(users_df, on='user_id')\nresult = merged.groupby('region')['order_amount'].sum()",
+    "apply": "result = orders_df['order_amount'].apply(lambda x: x * 1.2).sum()",
+    "groupby_apply": "result = orders_df.groupby('user_id')['order_amount'].apply(lambda s: s.max() - s.min()).mean()",
+    "iterrows": "total = 0\nfor _, row in orders_df.iterrows():\n    total += row['order_amount']\nresult = total",
+    "per_user": "result = {}\nfor u in users_df['user_id'].head(2000):\n"
+                "    result[u] = orders_df[orders_df['user_id'] == u]['order_amount'].sum()",
+}
+# Смешанная нагрузка: пул потоков как у uvicorn, тяжелые запросы вперемешку с дешевыми
+LOAD_SCALE = 100
+POOL_SIZE = 8
+HEAVY_QUERIES = 4
+CHEAP_QUERIES = 200
+CHEAP_INTERVAL_SECONDS = 0.01
+
+
+def processor_at(scale: int, base: DataProcessor) -> DataProcessor:
+    processor = DataProcessor()
+    processor._use_frames(scaled_frames(base, scale) if scale > 1 else dict(base._frames))
+    return processor
+
+
+def calibration(base: DataProcessor):
+    print("Оценка стоимости против фактического времени")
+    with tempfile.TemporaryDirectory() as workdir:
+        log_path = os.path.join(workdir, "costs.jsonl")
+        controller = AdmissionController(max_cost=None, log_path=log_path)
+        for scale in SCALES:
+            processor = processor_at(scale, base)
+            processor.admission = controller
+            for name, code in QUERIES.items():
+                if name == "iterrows" and scale > 30:
+                    continue
+                _, error = processor.execute_pandas_query(code)
+                assert error is None, error
+        controller.close()
+        records = list(load_cost_log(log_path))
+    names = [(scale, name) for scale in SCALES for name in QUERIES if not (name == "iterrows" and scale > 30)]
+    for (scale, name), record in zip(names, records):
+        print(f"  x{scale:<4} {name:14} оценка {record.estimated_cost:9.2g}  {record.wall_seconds * 1000:9.1f} ms  "
+              f"{record.lane}")
+    report = calibrate(records)
+    print(f"  секунд на единицу {report['seconds_per_unit']:.2g}, ранговая корреляция {report['rank_correlation']}, "
+          f"предлагаемые пороги: тяжелая полоса {report['suggested_heavy_threshold']:.2g}, "
+          f"отказ {report['suggested_max_cost']:.2g}")
+
+
+def mixed_load(processor: DataProcessor, controller: AdmissionController | None) -> dict:
+    processor.admission = controller
+    heavy = QUERIES["per_user"]
+    cheap = QUERIES["count"]
+    latencies, outcomes = [], {"ok": 0, "rejected": 0}
+    lock = threading.Lock()
+
+    def run_heavy():
+        _, error = processor.execute_pandas_query(heavy)
+        with lock:
+            outcomes["ok" if error is None else "rejected"] += 1
+
+    def run_cheap():
+        started = time.perf_counter()
+        _, error = processor.execute_pandas_query(cheap)
+        assert error is None, error
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=POOL_SIZE) as pool:
+        futures = [pool.submit(run_heavy) for _ in range(HEAVY_QUERIES)]
+        for _ in range(CHEAP_QUERIES):
+            futures.append(pool.submit(run_cheap))
+            time.sleep(CHEAP_INTERVAL_SECONDS)
+        for future in futures:
+            future.result()
+    latencies.sort()
+    return {
+        "cheap_p50_ms": statistics.median(latencies) * 1000,
+        "cheap_p95_ms": latencies[int(0.95 * len(latencies))] * 1000,
+        "heavy": outcomes,
+        "total_seconds": time.perf_counter() - started,
+    }
+
+
+def main():
+    base = DataProcessor()
+    calibration(base)
+
+    processor = processor_at(LOAD_SCALE, base)
+    table_rows = {name: len(df) for name, df in processor._frames.items()}
+    print(f"\nДешевые запросы рядом с {HEAVY_QUERIES} циклами по пользователям "
+          f"(оценка {estimate_cost(QUERIES['per_user'], table_rows).cost:.2g}), пул {POOL_SIZE} потоков")
+    for label, controller in [("без полос", None),
+                              ("с полосами", AdmissionController(heavy_threshold=5e6, max_cost=None,
+                                                                 heavy_queue_timeout=None, log_path=None))]:
+        stats = mixed_load(processor, controller)
+        print(f"  {label:12} p50 {stats['cheap_p50_ms']:7.1f} ms  p95 {stats['cheap_p95_ms']:7.1f} ms  "
+              f"тяжелые {stats['heavy']}  всего {stats['total_seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
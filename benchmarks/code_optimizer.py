@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import pandas as pd
+
+from src.code_optimizer import RULE_NAMES, apply_rule
+from src.data_processor import DataProcessor
+from src.speculative import result_fingerprint
+
+SCALES = [1, 10, 100]
+REPEATS = 3
+
+# Типичный для query_processor код с паттерном, который переписывает каждое правило
+SNIPPETS = {
+    "redundant_to_datetime": """orders_df['order_date'] = pd.to_datetime(orders_df['order_date'])
+users_df['registration_date'] = pd.to_datetime(users_df['registration_date'])
+june = orders_df[(pd.to_datetime(orders_df['order_date']) >= '2024-06-01') & (pd.to_datetime(orders_df['order_date']) < '2024-07-01')]
+result = june['order_amount'].sum()""",
+    "vectorize_apply": """orders_df['is_big'] = orders_df.apply(lambda r: r['order_amount'] > 5000 and r['status'] == 'completed', axis=1)
+orders_df['month'] = orders_df['order_date'].apply(lambda d: d.month)
+result = orders_df[orders_df['is_big']].groupby('month')['order_amount'].sum()""",
+    "vectorize_iterrows": """total = 0
+count = 0
+for _, row in orders_df.iterrows():
+    if row['status'] == 'completed' and row['order_amount'] > 1000:
+        total += row['order_amount']
+        count += 1
+result = total / count""",
+    "filter_before_merge": """merged = users_df.merge(orders_df, on='user_id')
+merged = merged[(merged['region'] == 'Москва') & (merged['status'] == 'completed')]
+result = merged['order_amount'].mean()""",
+    "hoist_repeated_masks": """revenue = orders_df[(orders_df['status'] == 'completed') & (orders_df['order_date'] >= pd.Timestamp('2024-06-01'))]['order_amount'].sum()
+buyers = orders_df[(orders_df['status'] == 'completed') & (orders_df['order_date'] >= pd.Timestamp('2024-06-01'))]['user_id'].nunique()
+orders = len(orders_df[(orders_df['status'] == 'completed') & (orders_df['order_date'] >= pd.Timestamp('2024-06-01'))])
+result = {'revenue': revenue, 'buyers': buyers, 'orders': orders}""",
+}
+
+
+def scaled_frames(processor: DataProcessor, scale: int) -> dict:
+    """Данные той же схемы, размноженные в scale раз, с уникальными user_id и order_id"""
+    users = pd.concat([processor.users_df.assign(user_id=processor.users_df['user_id'] + i * 100000)
+                       for i in range(scale)], ignore_index=True)
+    orders = pd.concat([processor.orders_df.assign(user_id=processor.orders_df['user_id'] + i * 100000,
+                                                   order_id=processor.orders_df['order_id'] + i * 1000000)
+                        for i in range(scale)], ignore_index=True)
+    return {'users_df': users, 'orders_df': orders}
+
+
+def best_time(processor: DataProcessor, code: str, frames: dict):
+    timings = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        result, error = processor.execute_pandas_query(code, frames=frames)
+        timings.append(time.perf_counter() - started)
+        if error:
+            raise RuntimeError(f"{error}\n{code}")
+    return min(timings), result
+
+
+def run_benchmark():
+    processor = DataProcessor()
+    schema = processor.get_columns()
+    print("=== Code optimizer: per-rule speedup (best of 3, includes frame copy) ===\n")
+    print(f"{'rule':<24}" + "".join(f"{f'x{scale} rows':>22}" for scale in SCALES))
+
+    for rule in RULE_NAMES:
+        code = SNIPPETS[rule]
+        optimized = apply_rule(code, rule, schema)
+        if optimized is None:
+            print(f"{rule:<24} rule did not fire")
+            continue
+        cells = []
+        for scale in SCALES:
+            frames = scaled_frames(processor, scale)
+            original_time, original_result = best_time(processor, code, frames)
+            optimized_time, optimized_result = best_time(processor, optimized, frames)
+            same = result_fingerprint(original_result) == result_fingerprint(optimized_result)
+            cell = f"{original_time * 1000:.1f}->{optimized_time * 1000:.1f}ms x{original_time / optimized_time:.1f}"
+            cells.append(cell if same else "MISMATCH")
+        print(f"{rule:<24}" + "".join(f"{cell:>22}" for cell in cells))
+
+    rows = len(scaled_frames(processor, SCALES[-1])['orders_df'])
+    print(f"\nLargest scale: {rows} orders; speedup grows with data size for row-wise rules")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Эти пакеты должны подгружаться только при прогреве или первом сообщении, не при импорте app.py
+DEFERRED_PACKAGES = ["langgraph", "langchain", "langchain_core", "langchain_openai", "openai",
+                     "pandas", "numpy", "requests", "twilio.rest"]
+RUNS = 5
+TOP = 15
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def profile_import(module: str):
+    """Один запуск python -X importtime в чистом процессе: {модуль: (self_us, cumulative_us, depth)}"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, env={**os.environ, "WARMUP_ON_STARTUP": "false"}
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return modules
+
+
+def run_benchmark(module: str, budget_ms: float | None) -> int:
+    runs = [profile_import(module) for _ in range(RUNS)]
+    totals = sorted(run[module][1] / 1000 for run in runs)
+    # Берем самый быстрый запуск: в остальных больше шума от файлового кэша и соседей
+    best = min(runs, key=lambda run: run[module][1])
+
+    print(f"=== Cold import of '{module}' (python -X importtime, {RUNS} runs) ===\n")
+    print(f"min {totals[0]:.0f} ms, median {totals[len(totals) // 2]:.0f} ms, max {totals[-1]:.0f} ms\n")
+
+    print(f"Top {TOP} direct imports of '{module}' by cumulative time:")
+    direct = [(name, cumulative) for name, (_, cumulative, depth) in best.items() if depth == 1]
+    for name, cumulative in sorted(direct, key=lambda item: -item[1])[:TOP]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failures = []
+    loaded = [name for name in DEFERRED_PACKAGES if name in best]
+    if loaded:
+        failures.append(f"deferred packages imported eagerly: {', '.join(loaded)}")
+    if budget_ms is not None and totals[0] > budget_ms:
+        failures.append(f"import took {totals[0]:.0f} ms, budget is {budget_ms:.0f} ms")
+
+    print()
+    if failures:
+        for failure in failures:
+            print(f"REGRESSION: {failure}")
+        return 1
+    print("OK: no deferred packages on the import path")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Профиль времени импорта приложения")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--budget-ms", type=float, default=None, help="Порог для min времени импорта")
+    args = parser.parse_args()
+    sys.exit(run_benchmark(args.module, args.budget_ms))
@@ -0,0 +1,171 @@
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import numpy as np
+import pandas as pd
+
+import src.data_processor as data_processor_module
+from src.data_processor import DataProcessor
+from src.ingest import coerce_rows
+from src.shared_snapshot import SharedSnapshotStore
+
+SCALE = 10000
+BATCH_SIZES = [100, 1000]
+BATCHES = 20
+LATENCY_SECONDS = 3.0
+QUERY = "result = orders_df[orders_df['status'] == 'completed'].groupby('user_id')['order_amount'].sum().nlargest(10)"
+
+
+def scaled_frames(processor: DataProcessor, scale: int) -> dict:
+    """Данные той же схемы, размноженные в scale раз, с уникальными user_id и order_id"""
+    def tile(df: pd.DataFrame, offsets: dict) -> pd.DataFrame:
+        copy = np.arange(scale).repeat(len(df))
+        tiled = df.iloc[np.tile(np.arange(len(df)), scale)].reset_index(drop=True)
+        for column, step in offsets.items():
+            tiled[column] = tiled[column] + copy * step
+        return tiled
+
+    return {'users_df': tile(processor.users_df, {'user_id': 100000}),
+            'orders_df': tile(processor.orders_df, {'user_id': 100000, 'order_id': 1000000})}
+
+
+class OrderStream:
+    """Новые заказы существующих пользователей с возрастающими order_id"""
+
+    def __init__(self, frames: dict):
+        self.user_ids = frames['users_df']['user_id'].tolist()
+        self.next_id = int(frames['orders_df']['order_id'].max()) + 1
+        self.random = random.Random(0)
+
+    def batch(self, size: int) -> list:
+        rows = []
+        for _ in range(size):
+            rows.append({"order_id": self.next_id, "user_id": self.random.choice(self.user_ids),
+                         "order_date": f"2024-07-{self.random.randint(1, 31):02d}T12:00:00",
+                         "order_amount": self.random.randint(100, 10000),
+                         "status": self.random.choice(["completed", "canceled", "pending"])})
+            self.next_id += 1
+        return rows
+
+
+def make_processor(mode: str, frames: dict, workdir: str) -> DataProcessor:
+    if mode == "local":
+        processor = DataProcessor()
+        processor._use_frames({name: df.copy() for name, df in frames.items()})
+        return processor
+    store = SharedSnapshotStore(os.path.join(workdir, f"snapshot-{time.monotonic_ns()}"))
+    store.publish(frames, DataProcessor()._source_key())
+    return DataProcessor(snapshot_store=store)
+
+
+def measure_throughput(mode: str, frames: dict, workdir: str, batch_size: int) -> float:
+    processor = make_processor(mode, frames, workdir)
+    stream = OrderStream(frames)
+    batches = [stream.batch(batch_size) for _ in range(BATCHES)]
+    # Первый пакет строит множества ключей и таблицы с емкостью - разовая стоимость, не в замер
+    processor.ingest({'orders_df': stream.batch(batch_size)})
+    started = time.perf_counter()
+    for rows in batches:
+        processor.ingest({'orders_df': rows})
+    return BATCHES * batch_size / (time.perf_counter() - started)
+
+
+def measure_full_rebuild(mode: str, frames: dict, workdir: str, batch_size: int) -> float:
+    """Наивный путь: те же проверки и журнал, но каждый пакет дает новый полный фрейм
+    (и полную публикацию снапшота), а повторы ищутся по всей таблице"""
+    processor = make_processor(mode, frames, workdir)
+    stream = OrderStream(frames)
+    batches = [stream.batch(batch_size) for _ in range(BATCHES)]
+    started = time.perf_counter()
+    for rows in batches:
+        current = processor._frames
+        typed = coerce_rows('orders_df', rows, current['orders_df'])
+        typed = typed[~typed['order_id'].isin(current['orders_df']['order_id'])]
+        orphans = ~typed['user_id'].isin(current['users_df']['user_id'])
+        if orphans.any():
+            raise RuntimeError("orphan orders")
+        processor._append_journal({'orders_df': typed})
+        rebuilt = {**current, 'orders_df': pd.concat([current['orders_df'], typed], ignore_index=True)}
+        if processor.snapshot is not None:
+            processor.snapshot_store.publish(rebuilt, processor._source_key())
+            processor.refresh_snapshot()
+        else:
+            processor._use_frames(rebuilt)
+    return BATCHES * batch_size / (time.perf_counter() - started)
+
+
+def query_latencies(processor: DataProcessor, seconds: float) -> list:
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        result, error = processor.execute_pandas_query(QUERY)
+        if error:
+            raise RuntimeError(error)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def percentile(values: list, q: float) -> float:
+    return statistics.quantiles(values, n=100)[int(q) - 1] if len(values) > 1 else values[0]
+
+
+def measure_query_latency(mode: str, frames: dict, workdir: str) -> dict:
+    processor = make_processor(mode, frames, workdir)
+    stream = OrderStream(frames)
+    processor.ingest({'orders_df': stream.batch(500)})
+    idle = query_latencies(processor, LATENCY_SECONDS)
+
+    stop = threading.Event()
+    ingested = []
+
+    def ingest_loop():
+        while not stop.is_set():
+            processor.ingest({'orders_df': stream.batch(500)})
+            ingested.append(500)
+
+    writer = threading.Thread(target=ingest_loop)
+    writer.start()
+    try:
+        busy = query_latencies(processor, LATENCY_SECONDS)
+    finally:
+        stop.set()
+        writer.join()
+    return {"idle": idle, "busy": busy, "ingested": sum(ingested)}
+
+
+def run_benchmark():
+    base = DataProcessor()
+    frames = scaled_frames(base, SCALE)
+    with tempfile.TemporaryDirectory() as workdir:
+        # Журнал ingest пишем во временный каталог, а не в data/
+        data_processor_module.INGEST_FILES = {'users_df': os.path.join(workdir, "users.csv"),
+                                              'orders_df': os.path.join(workdir, "orders.csv")}
+        print(f"=== Ingest: {len(frames['orders_df'])} orders, {len(frames['users_df'])} users, {BATCHES} batches ===\n")
+        print(f"{'mode':<8}{'batch':>7}{'append rows/s':>16}{'full rebuild rows/s':>22}{'speedup':>10}")
+        for mode in ("local", "shared"):
+            for batch_size in BATCH_SIZES:
+                append = measure_throughput(mode, frames, workdir, batch_size)
+                rebuild = measure_full_rebuild(mode, frames, workdir, batch_size)
+                print(f"{mode:<8}{batch_size:>7}{append:>16,.0f}{rebuild:>22,.0f}{append / rebuild:>9.1f}x")
+                for path in data_processor_module.INGEST_FILES.values():
+                    if os.path.exists(path):
+                        os.remove(path)
+
+        print("\n=== Query latency while ingesting 500-row batches in a background thread ===\n")
+        print(f"{'mode':<8}{'idle p50':>10}{'idle p95':>10}{'busy p50':>10}{'busy p95':>10}{'rows ingested':>15}")
+        for mode in ("local", "shared"):
+            result = measure_query_latency(mode, frames, workdir)
+            idle, busy = result["idle"], result["busy"]
+            print(f"{mode:<8}{percentile(idle, 50) * 1000:>8.1f}ms{percentile(idle, 95) * 1000:>8.1f}ms"
+                  f"{percentile(busy, 50) * 1000:>8.1f}ms{percentile(busy, 95) * 1000:>8.1f}ms{result['ingested']:>15,}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
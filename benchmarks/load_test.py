@@ -0,0 +1,514 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import httpx
+
+from src.reference_answers import REFERENCES
+from tests.fake_openai_server import FakeOpenAIServer, content_from_request
+from tests.fake_twilio_server import FakeTwilioServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Twilio ждет ответ вебхука 15 секунд, дальше считает доставку неудачной и повторяет ее
+TWILIO_WEBHOOK_TIMEOUT = 15.0
+# Ответы бота, которыми он сообщает об ошибке вместо ответа на вопрос
+ERROR_REPLIES = ("Произошла ошибка", "Не удалось обработать запрос")
+
+QUESTIONS = [question for question, _ in REFERENCES]
+SMALLTALK = ["Привет!", "Спасибо, понятно", "Что ты умеешь?"]
+# Код, который fake LLM "генерирует" для любого вопроса: настоящие вычисления на данных
+CODES = [
+    "result = orders_df[orders_df['status'] == 'completed'].groupby('user_id')['order_amount'].sum().nlargest(10)",
+    "result = users_df.merge(orders_df, on='user_id').groupby('region')['order_amount'].mean()",
+    "result = orders_df.groupby(orders_df['order_date'].dt.date)['order_id'].count()",
+    "result = (orders_df['status'] == 'canceled').mean() * 100",
+]
+
+
+def analytics_responder(rng: random.Random):
+    """Ответы fake LLM по схеме запроса: генерация кода, финальный ответ или оценка"""
+    def respond(request: Dict) -> str:
+        content = content_from_request(request)
+        try:
+            value = json.loads(content)
+        except ValueError:
+            return content
+        if not isinstance(value, dict):
+            return content
+        code = rng.choice(CODES)
+        if "requires_code" in value:
+            value["requires_code"] = True
+            value["direct_answer"] = None
+        if "pandas_code" in value:
+            value["pandas_code"] = code
+        if "pandas_code_candidates" in value:
+            value["pandas_code_candidates"] = [code]
+        if "final_answer" in value:
+            value["final_answer"] = "По данным за июнь выручка выросла на 12,5%, лидер - Москва."
+        return json.dumps(value, ensure_ascii=False)
+    return respond
+
+
+@dataclass
+class Outcome:
+    kind: str
+    step: int
+    started: float
+    finished: float
+    status: int | None
+    error: str | None
+    sender: str | None = None
+
+    @property
+    def latency(self) -> float:
+        return self.finished - self.started
+
+
+@dataclass
+class Sample:
+    at: float
+    step: int
+    in_flight: int
+    completed: int
+    loop_p95_ms: float | None
+    loop_max_ms: float | None
+    probe_ms: float | None
+    rss_mb: float | None
+    delivered: int | None
+    delivered_errors: int | None
+
+
+class ServerProcess:
+    """uvicorn с app.py в отдельном процессе (и N воркерах), логи - в файл"""
+
+    def __init__(self, workers: int, env: Dict[str, str], log_path: str):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.log = open(log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--workers", str(workers), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _log_tail(self, lines: int = 30) -> str:
+        self.log.flush()
+        with open(self.log.name, errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+
+    def wait_ready(self, workers: int, timeout: float = 120.0):
+        deadline = time.monotonic() + timeout
+        ready = 0
+        while ready < workers * 3:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.process.returncode}:\n{self._log_tail()}")
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Server is not ready after {timeout:.0f}s:\n{self._log_tail()}")
+            try:
+                # /ready попадает в случайный воркер: несколько успешных ответов подряд - прогреты все
+                ready = ready + 1 if httpx.get(f"{self.url}/ready", timeout=timeout).status_code == 200 else 0
+            except httpx.HTTPError:
+                time.sleep(0.2)
+
+    def rss_mb(self) -> float | None:
+        """Суммарный RSS главного процесса и воркеров по /proc"""
+        pids, children = {self.process.pid}, {}
+        try:
+            for name in os.listdir("/proc"):
+                if name.isdigit():
+                    try:
+                        with open(f"/proc/{name}/stat") as f:
+                            ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                    except (OSError, ValueError, IndexError):
+                        continue
+                    children.setdefault(ppid, []).append(int(name))
+        except OSError:
+            return None
+        stack = [self.process.pid]
+        while stack:
+            for child in children.get(stack.pop(), []):
+                if child not in pids:
+                    pids.add(child)
+                    stack.append(child)
+        total = 0
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/statm") as f:
+                    total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except (OSError, ValueError, IndexError):
+                pass
+        return round(total / 2 ** 20, 1)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+class LoadGenerator:
+    """Открытая модель нагрузки: запросы приходят с заданной частотой, не дожидаясь ответов.
+
+    Так очередь внутри сервиса растет, когда он не успевает, - как с настоящим Twilio.
+    """
+
+    def __init__(self, url: str, args, rng: random.Random, server: ServerProcess | None = None,
+                 twilio: FakeTwilioServer | None = None):
+        self.url = url
+        self.args = args
+        self.rng = rng
+        self.server = server
+        self.twilio = twilio
+        self.outcomes: List[Outcome] = []
+        self.samples: List[Sample] = []
+        self.in_flight = 0
+        self.step = 0
+        self.tasks = set()
+        mix = dict(item.split("=") for item in args.mix.split(","))
+        self.kinds, self.weights = list(mix), [float(weight) for weight in mix.values()]
+
+    def _message(self) -> str:
+        if self.rng.random() < self.args.smalltalk_share:
+            return self.rng.choice(SMALLTALK)
+        return self.rng.choice(QUESTIONS)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, client: httpx.AsyncClient, kind: str, step: int, sender: str | None = None, body: str | None = None):
+        self.in_flight += 1
+        started = time.monotonic()
+        status, error = None, None
+        try:
+            if kind in ("webhook", "resend"):
+                if sender is None:
+                    sender, body = f"whatsapp:+7900{self.rng.randrange(self.args.senders):07d}", self._message()
+                    if self.twilio is not None and self.args.patience > 0:
+                        self._spawn(self._resend_if_no_reply(client, step, sender, body, started))
+                response = await client.post("/webhook/whatsapp", data={
+                    "Body": body, "From": sender, "MessageSid": f"SM{uuid.uuid4().hex}"
+                })
+                status = response.status_code
+                # Ответ приходит пустым TwiML; <Message> внутри бывает только при ошибке
+                if status != 200:
+                    error = f"http_{status}"
+                elif "<Message>" in response.text:
+                    error = "error_reply"
+            else:
+                response = await client.post("/test/query", json={"message": self._message()})
+                status = response.status_code
+                body = response.json() if status == 200 else {}
+                if status != 200:
+                    error = f"http_{status}"
+                elif "error" in body:
+                    error = "error_reply"
+                elif str(body.get("response", "")).startswith(ERROR_REPLIES):
+                    error = "error_reply"
+        except httpx.TimeoutException:
+            error = "timeout"
+        except (httpx.HTTPError, ValueError) as e:
+            error = type(e).__name__
+        finally:
+            self.in_flight -= 1
+            self.outcomes.append(Outcome(kind, step, started, time.monotonic(), status, error, sender))
+
+    async def _resend_if_no_reply(self, client: httpx.AsyncClient, step: int, sender: str, body: str, sent_at: float):
+        # Нетерпеливый пользователь: ни одного сообщения за patience секунд - задает вопрос еще раз
+        await asyncio.sleep(self.args.patience)
+        if self.twilio.first_delivery(sender, since=sent_at) is None:
+            await self._send(client, "resend", step, sender, body)
+
+    def _delivered_errors(self) -> int | None:
+        # Ошибку вебхука бот отправляет сообщением через Twilio, HTTP ответ при этом пустой
+        if self.twilio is None:
+            return None
+        return sum(1 for message in list(self.twilio.messages) if message.get("Body", "").startswith(ERROR_REPLIES))
+
+    async def _monitor(self, client: httpx.AsyncClient, stop: asyncio.Event):
+        interval = self.args.sample_seconds
+        while not stop.is_set():
+            started = time.monotonic()
+            loop, probe_ms = {}, None
+            try:
+                # Время ответа самого легкого эндпоинта - задержка loop, видимая снаружи
+                response = await client.get("/stats/loop", params={"seconds": interval}, timeout=interval * 5)
+                probe_ms = (time.monotonic() - started) * 1000
+                loop = response.json()
+            except (httpx.HTTPError, ValueError):
+                pass
+            self.samples.append(Sample(
+                at=time.monotonic(), step=self.step, in_flight=self.in_flight, completed=len(self.outcomes),
+                loop_p95_ms=loop.get("p95_ms"), loop_max_ms=loop.get("window_max_ms"), probe_ms=probe_ms,
+                rss_mb=self.server.rss_mb() if self.server is not None else loop.get("rss_mb"),
+                delivered=len(self.twilio.messages) if self.twilio is not None else None,
+                delivered_errors=self._delivered_errors()
+            ))
+            self._print_sample(self.samples[-1])
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=max(0.0, interval - (time.monotonic() - started)))
+            except asyncio.TimeoutError:
+                pass
+
+    def _print_sample(self, sample: Sample):
+        previous = self.samples[-2] if len(self.samples) > 1 else None
+        rate = (sample.completed - previous.completed) / (sample.at - previous.at) if previous else 0.0
+
+        def ms(value):
+            return f"{value:>8.0f}ms" if value is not None else f"{'-':>10}"
+        print(f"  t={sample.at - self.started:>6.1f}s in_flight={sample.in_flight:>4} done/s={rate:>6.1f}"
+              f" loop_p95={ms(sample.loop_p95_ms)} loop_max={ms(sample.loop_max_ms)} probe={ms(sample.probe_ms)}"
+              f" rss={sample.rss_mb if sample.rss_mb is not None else '-':>8}MB"
+              + (f" delivered={sample.delivered}" if sample.delivered is not None else ""), flush=True)
+
+    async def run(self, rates: List[float]):
+        limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+        async with httpx.AsyncClient(base_url=self.url, timeout=self.args.timeout, limits=limits) as client:
+            stop = asyncio.Event()
+            self.started = time.monotonic()
+            monitor = asyncio.create_task(self._monitor(client, stop))
+            self.step_windows = []
+            for step, rate in enumerate(rates):
+                self.step = step
+                print(f"-- step {step + 1}/{len(rates)}: {rate:g} req/s for {self.args.step_seconds:g}s", flush=True)
+                step_started = time.monotonic()
+                step_end = step_started + self.args.step_seconds
+                next_at = step_started
+                while True:
+                    next_at += self.rng.expovariate(rate) if self.args.arrival == "poisson" else 1.0 / rate
+                    if next_at >= step_end:
+                        break
+                    await asyncio.sleep(max(0.0, next_at - time.monotonic()))
+                    kind = self.rng.choices(self.kinds, self.weights)[0]
+                    self._spawn(self._send(client, kind, step))
+                await asyncio.sleep(max(0.0, step_end - time.monotonic()))
+                self.step_windows.append((step_started, step_end))
+            if self.tasks:
+                print(f"-- draining {len(self.tasks)} in-flight requests", flush=True)
+            # Ожидание повтора может породить новый запрос уже во время дренажа
+            while self.tasks:
+                await asyncio.gather(*list(self.tasks))
+            stop.set()
+            await monitor
+
+
+def percentile(values: List[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize_step(generator: LoadGenerator, step: int, rate: float, args) -> Dict:
+    started, ended = generator.step_windows[step]
+    outcomes = [outcome for outcome in generator.outcomes if outcome.step == step]
+    ok = [outcome for outcome in outcomes if outcome.error is None]
+    latencies = [outcome.latency for outcome in ok]
+    webhooks = [outcome.latency for outcome in outcomes if outcome.kind == "webhook" and outcome.status is not None]
+    errors: Dict[str, int] = {}
+    for outcome in outcomes:
+        if outcome.error is not None:
+            errors[outcome.error] = errors.get(outcome.error, 0) + 1
+    # Ошибки, доставленные через fake Twilio, относим к шагу по времени доставки
+    # (последний шаг забирает и доставленные во время дренажа)
+    counts = [(sample.step, sample.delivered_errors) for sample in generator.samples if sample.delivered_errors is not None]
+    if counts:
+        before = max((count for at_step, count in counts if at_step < step), default=0)
+        until = max((count for at_step, count in counts if at_step <= step or step == len(generator.step_windows) - 1), default=before)
+        if until > before:
+            errors["error_delivered"] = until - before
+    # Пропускная способность - успешные ответы в окне шага, сдвинутом на медианную задержку:
+    # в установившемся режиме ответы на запросы шага приходят именно тогда
+    shift = percentile(latencies, 0.5) or 0.0
+    goodput = sum(1 for outcome in generator.outcomes
+                  if outcome.error is None and started + shift <= outcome.finished < ended + shift)
+    samples = [sample for sample in generator.samples if sample.step == step]
+    loop_p95 = [sample.loop_p95_ms for sample in samples if sample.loop_p95_ms is not None]
+    loop_max = [sample.loop_max_ms for sample in samples if sample.loop_max_ms is not None]
+    rss = [sample.rss_mb for sample in samples if sample.rss_mb is not None]
+    # Время до первого сообщения пользователю: "считаю…" в поэтапном режиме, иначе сам ответ.
+    # При совпадении отправителей сюда может попасть ответ на его прошлый вопрос
+    originals = [outcome for outcome in outcomes if outcome.kind == "webhook" and outcome.sender is not None]
+    first_replies = []
+    if generator.twilio is not None:
+        for outcome in originals:
+            delivered = generator.twilio.first_delivery(outcome.sender, since=outcome.started)
+            if delivered is not None:
+                first_replies.append(delivered - outcome.started)
+    resends = sum(1 for outcome in outcomes if outcome.kind == "resend")
+    summary = {
+        "rate": rate,
+        "sent": len(outcomes),
+        "ok": len(ok),
+        "error_rate": sum(errors.values()) / len(outcomes) if outcomes else 0.0,
+        "errors": errors,
+        "twilio_timeouts": sum(1 for latency in webhooks if latency > TWILIO_WEBHOOK_TIMEOUT),
+        "throughput": goodput / (ended - started),
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "webhook_p95": percentile(webhooks, 0.95),
+        "loop_p95_ms": max(loop_p95) if loop_p95 else None,
+        "loop_max_ms": max(loop_max) if loop_max else None,
+        "rss_max_mb": max(rss) if rss else None,
+        "first_reply_p50": percentile(first_replies, 0.5),
+        "first_reply_p95": percentile(first_replies, 0.95),
+        "resends": resends,
+        "resend_rate": resends / len(originals) if originals else 0.0,
+    }
+    reasons = []
+    if summary["error_rate"] > args.max_error_rate:
+        reasons.append(f"errors {summary['error_rate']:.1%}")
+    if summary["webhook_p95"] is not None and summary["webhook_p95"] > TWILIO_WEBHOOK_TIMEOUT:
+        reasons.append(f"webhook p95 {summary['webhook_p95']:.1f}s > Twilio timeout")
+    if summary["throughput"] < rate * args.min_throughput_ratio:
+        reasons.append(f"throughput {summary['throughput']:.2f}/s < {args.min_throughput_ratio:.0%} of offered")
+    summary["saturated"] = reasons
+    return summary
+
+
+def print_summary(setting: str, summaries: List[Dict]):
+    def seconds(value):
+        return f"{value:>7.2f}s" if value is not None else f"{'-':>8}"
+
+    def ms(value):
+        return f"{value:>8.0f}" if value is not None else f"{'-':>8}"
+
+    print(f"\n=== {setting} ===\n")
+    print(f"{'rate':>6}{'sent':>6}{'ok':>6}{'err%':>7}{'tw_to':>6}{'thrpt':>7}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'loop95ms':>9}{'loopmax':>9}{'rss MB':>9}")
+    for s in summaries:
+        print(f"{s['rate']:>6g}{s['sent']:>6}{s['ok']:>6}{s['error_rate'] * 100:>6.1f}%{s['twilio_timeouts']:>6}"
+              f"{s['throughput']:>7.2f}{seconds(s['p50'])}{seconds(s['p95'])}{seconds(s['p99'])}"
+              f"{ms(s['loop_p95_ms'])} {ms(s['loop_max_ms'])}{s['rss_max_mb'] if s['rss_max_mb'] is not None else '-':>9}")
+        if s["errors"]:
+            print(f"{'':>6}errors: {s['errors']}")
+        if s["first_reply_p50"] is not None:
+            print(f"{'':>6}first reply p50 {s['first_reply_p50']:.2f}s p95 {s['first_reply_p95']:.2f}s, "
+                  f"resends {s['resends']} ({s['resend_rate']:.1%})")
+
+    saturated = next((s for s in summaries if s["saturated"]), None)
+    sustainable = [s["rate"] for s in summaries if not s["saturated"] and (saturated is None or s["rate"] < saturated["rate"])]
+    if saturated is None:
+        print(f"\nNo saturation up to {summaries[-1]['rate']:g} req/s")
+    else:
+        print(f"\nSaturation at {saturated['rate']:g} req/s: {'; '.join(saturated['saturated'])}")
+        print(f"Max sustainable rate: {max(sustainable):g} req/s" if sustainable else "Saturated already at the first rate")
+
+
+def server_env(args, openai: FakeOpenAIServer, twilio: FakeTwilioServer, workdir: str) -> Dict[str, str]:
+    env = {
+        **os.environ,
+        "OPENAI_API_KEY": "sk-load-test",
+        "OPENAI_BASE_URL": openai.base_url,
+        "OPENAI_API_BASE": openai.base_url,
+        "TWILIO_ACCOUNT_SID": "AC" + "0" * 32,
+        "TWILIO_AUTH_TOKEN": "load-test",
+        "TWILIO_PHONE_NUMBER": "+10000000000",
+        "TWILIO_API_BASE_URL": twilio.base_url,
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.sqlite3"),
+        "WEBHOOK_STATE_PATH": os.path.join(workdir, "webhook_state.sqlite3"),
+        "SLOW_QUERY_LOG": os.path.join(workdir, "slow_queries.jsonl"),
+        "WARMUP_ON_STARTUP": "true",
+        # Лимит настоящего Twilio Sandbox растянул бы доставку: меряем сервис, а не очередь outbox
+        "TWILIO_MESSAGES_PER_SECOND": "100",
+        # Трейсы нагрузочного прогона не должны уходить в LangSmith
+        "LANGCHAIN_TRACING_V2": "false",
+        "LANGSMITH_TRACING": "false",
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест вебхука и /test/query на fake OpenAI и Twilio")
+    parser.add_argument("--rates", default="1,2,4,8", help="Частоты запросов в секунду по шагам, через запятую")
+    parser.add_argument("--step-seconds", type=float, default=30.0)
+    parser.add_argument("--arrival", choices=["poisson", "constant"], default="poisson")
+    parser.add_argument("--mix", default="webhook=0.8,query=0.2", help="Доли трафика: webhook (form) и query (JSON)")
+    parser.add_argument("--smalltalk-share", type=float, default=0.1)
+    parser.add_argument("--senders", type=int, default=1000, help="Число разных отправителей вебхуков")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Таймаут клиента на запрос")
+    parser.add_argument("--sample-seconds", type=float, default=1.0)
+    parser.add_argument("--workers", default="1", help="Воркеры uvicorn; список через запятую - прогон на каждом")
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE для сервера, например THREADPOOL_SIZE=100")
+    parser.add_argument("--url", help="Нагружать уже запущенный сервис вместо локального с fake upstream")
+    parser.add_argument("--llm-median-ms", type=float, default=800.0, help="Медиана задержки fake OpenAI")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="Sigma логнормальной задержки fake OpenAI")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Доля ответов 500 от fake OpenAI")
+    parser.add_argument("--twilio-latency-ms", type=float, default=150.0)
+    parser.add_argument("--patience", type=float, default=0.0,
+                        help="Секунды без единого сообщения, после которых отправитель вебхука повторяет вопрос (0 - не повторять)")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--min-throughput-ratio", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="JSON с итогами шагов и временным рядом")
+    args = parser.parse_args(argv)
+
+    rates = [float(rate) for rate in args.rates.split(",")]
+    rng = random.Random(args.seed)
+    results = {}
+
+    if args.url:
+        generator = LoadGenerator(args.url.rstrip("/"), args, rng)
+        asyncio.run(generator.run(rates))
+        summaries = [summarize_step(generator, step, rate, args) for step, rate in enumerate(rates)]
+        print_summary(args.url, summaries)
+        results[args.url] = {"steps": summaries, "timeline": [asdict(sample) for sample in generator.samples]}
+    else:
+        llm_rng = random.Random(args.seed + 1)
+        median = args.llm_median_ms / 1000
+        # Задержка LLM логнормальная: большинство ответов около медианы, но с длинным хвостом
+        openai = FakeOpenAIServer(
+            latency=lambda n: median * llm_rng.lognormvariate(0.0, args.llm_sigma),
+            status=lambda n: 500 if llm_rng.random() < args.llm_error_rate else 200,
+            responder=analytics_responder(random.Random(args.seed + 2))
+        )
+        twilio = FakeTwilioServer(latency=args.twilio_latency_ms / 1000)
+        with openai, twilio, tempfile.TemporaryDirectory() as workdir:
+            for workers in [int(value) for value in args.workers.split(",")]:
+                setting = f"workers={workers}" + "".join(f" {item}" for item in args.env)
+                print(f"\n### {setting}: starting server", flush=True)
+                server = ServerProcess(workers, server_env(args, openai, twilio, workdir),
+                                       os.path.join(workdir, f"server-{workers}.log"))
+                try:
+                    server.wait_ready(workers)
+                    generator = LoadGenerator(server.url, args, rng, server=server, twilio=twilio)
+                    asyncio.run(generator.run(rates))
+                finally:
+                    server.stop()
+                summaries = [summarize_step(generator, step, rate, args) for step, rate in enumerate(rates)]
+                print_summary(setting, summaries)
+                results[setting] = {"steps": summaries, "timeline": [asdict(sample) for sample in generator.samples]}
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
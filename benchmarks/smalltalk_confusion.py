@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import random
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.smalltalk_classifier import DATA_LABEL, SmallTalkClassifier, load_examples
+from tests.test_smalltalk_classifier import UNSEEN_DATA_QUESTIONS
+
+THRESHOLDS = [0.5, 0.7, 0.8, 0.9, 0.95, 0.99]
+FOLDS = 5
+
+
+def cross_validate(examples, threshold: float):
+    """k-fold: предсказания маршрута для каждого примера моделью, не видевшей его"""
+    shuffled = examples[:]
+    random.Random(42).shuffle(shuffled)
+    predictions = []
+    for fold in range(FOLDS):
+        test = shuffled[fold::FOLDS]
+        train = [example for i, example in enumerate(shuffled) if i % FOLDS != fold]
+        model = SmallTalkClassifier.train(train, threshold=threshold)
+        predictions += [(label, model.route(text), text) for text, label in test]
+    return predictions
+
+
+def print_confusion(predictions, labels):
+    print(f"{'true / routed':>14} " +" ".join(f"{label:>13}" for label in labels))
+    for true_label in labels:
+        row = [sum(1 for t, p, _ in predictions if t == true_label and p == label) for label in labels]
+        print(f"{true_label:>14} " + " ".join(f"{count:>13}" for count in row))
+
+
+def run_benchmark():
+    examples = load_examples()
+    labels = sorted({label for _, label in examples} - {DATA_LABEL}) + [DATA_LABEL]
+
+    print("=== Small talk pre-classifier: confusion matrix (5-fold CV) ===\n")
+    for threshold in THRESHOLDS:
+        predictions = cross_validate(examples, threshold)
+        misrouted_data = [text for t, p, text in predictions if t == DATA_LABEL and p != DATA_LABEL]
+        smalltalk = [(t, p) for t, p, _ in predictions if t != DATA_LABEL]
+        answered_locally = sum(1 for t, p in smalltalk if p == t)
+        print(f"threshold={threshold}")
+        print_confusion(predictions, labels)
+        print(f"Вопросы по данным, ушедшие в шаблон: {len(misrouted_data)}")
+        for text in misrouted_data:
+            print(f"  - {text}")
+        print(f"Small talk, отвеченный локально: {answered_locally}/{len(smalltalk)}")
+        # Вопросы со словами, которых нет в обучающем наборе: модель на всех примерах
+        model = SmallTalkClassifier.train(examples, threshold=threshold)
+        unseen = [(text, model.route(text)) for text in UNSEEN_DATA_QUESTIONS]
+        print(f"Вопросы по данным вне обучающего набора, ушедшие в шаблон: "
+              f"{sum(1 for _, routed in unseen if routed != DATA_LABEL)}/{len(unseen)}")
+        for text, routed in unseen:
+            if routed != DATA_LABEL:
+                print(f"  - {text} -> {routed}")
+        print()
+
+    model = SmallTalkClassifier.train(examples)
+    texts = [text for text, _ in examples]
+    iterations = 20
+    started = time.perf_counter()
+    for _ in range(iterations):
+        for text in texts:
+            model.route(text)
+    per_call = (time.perf_counter() - started) / (iterations * len(texts))
+    print(f"Время классификации: {per_call * 1e6:.1f} мкс на сообщение")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,265 @@
+import json
+import logging.handlers
+import sys
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from .cost_estimator import CostEstimate, estimate_cost
+from .query_profiler import code_hash, log_files, worker_log_path
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COST_LOG_PATH = "data/query_costs.jsonl"
+FAST_LANE = "fast"
+HEAVY_LANE = "heavy"
+REJECTED = "rejected"
+# Префикс ошибки отказа: по нему граф не тратит попытки на починку кода
+REJECTION_PREFIX = "QueryRejected: "
+NARROWING_HINT = "Попробуйте сузить вопрос: период, регион или статус заказа, без перебора по каждому пользователю."
+
+
+def is_rejection(error: str | None) -> bool:
+    return bool(error) and error.startswith(REJECTION_PREFIX)
+
+
+def rejection_message(error: str) -> str:
+    """Текст отказа для пользователя без технического префикса"""
+    return error[len(REJECTION_PREFIX):] if is_rejection(error) else error
+
+
+@dataclass
+class CostRecord:
+    code_hash: str
+    lane: str
+    estimated_cost: float
+    reasons: List[str]
+    tables: Dict[str, int]
+    queue_seconds: float
+    wall_seconds: float | None
+    cpu_seconds: float | None
+    error: str | None
+    timestamp: float = field(default_factory=time.time)
+
+
+class _Lane:
+    def __init__(self, name: str, concurrency: int, queue_timeout: float | None):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.admitted = 0
+        self.active = 0
+        self.waiting = 0
+        self.timed_out = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "admitted": self.admitted,
+            "active": self.active,
+            "waiting": self.waiting,
+            "timed_out": self.timed_out,
+            "mean_wait_seconds": round(self.wait_seconds / self.admitted, 4) if self.admitted else None,
+            "mean_run_seconds": round(self.run_seconds / self.admitted, 4) if self.admitted else None,
+        }
+
+
+class AdmissionController:
+    """Допуск сгенерированного кода к выполнению по статической оценке стоимости.
+
+    Дешевые запросы идут в быструю полосу, тяжелые - в отдельную полосу с меньшим
+    лимитом параллельности, чтобы cross join не задерживал "сколько заказов".
+    Запросы дороже max_cost отклоняются без выполнения. Оценка и фактическое время
+    каждого выполнения пишутся в JSONL для калибровки порогов.
+    """
+
+    def __init__(self, fast_concurrency: int = 40, heavy_concurrency: int = 1, heavy_threshold: float = 5e6,
+                 max_cost: float | None = 1e9, heavy_queue_timeout: float | None = 20.0,
+                 log_path: str | None = DEFAULT_COST_LOG_PATH, max_log_bytes: int = 10 * 1024 * 1024, log_backups: int = 3):
+        self.heavy_threshold = heavy_threshold
+        self.max_cost = max_cost
+        self.log_path = worker_log_path(log_path) if log_path else None
+        # Быструю полосу ждем без таймаута: ее запросы по определению короткие, а лимит
+        # по умолчанию совпадает с пулом потоков и ограничивает только тяжелую полосу
+        self._lanes = {
+            FAST_LANE: _Lane(FAST_LANE, fast_concurrency, None),
+            HEAVY_LANE: _Lane(HEAVY_LANE, heavy_concurrency, heavy_queue_timeout),
+        }
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._cost_log = None
+        if log_path:
+            # Как и журнал медленных запросов: отдельный логгер, в файле только строки JSON
+            self._cost_log = logging.getLogger(f"{__name__}.costs.{id(self)}")
+            self._cost_log.propagate = False
+            self._cost_log.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(self.log_path, maxBytes=max_log_bytes, backupCount=log_backups,
+                                                           encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._cost_log.addHandler(handler)
+
+    def close(self):
+        if self._cost_log is not None:
+            for handler in list(self._cost_log.handlers):
+                self._cost_log.removeHandler(handler)
+                handler.close()
+
+    def classify(self, estimate: CostEstimate) -> str:
+        if self.max_cost is not None and estimate.cost > self.max_cost:
+            return REJECTED
+        return HEAVY_LANE if estimate.cost >= self.heavy_threshold else FAST_LANE
+
+    def execute(self, code: str, table_rows: Dict[str, int], run: Callable[[], Tuple[Any, str | None]]) -> Tuple[Any, str | None]:
+        estimate = estimate_cost(code, table_rows)
+        lane_name = self.classify(estimate)
+        if lane_name == REJECTED:
+            with self._lock:
+                self.rejected += 1
+            error = (f"{REJECTION_PREFIX}Запрос слишком тяжелый для выполнения "
+                     f"(оценка {estimate.cost:.2g} при лимите {self.max_cost:.2g}): {'; '.join(estimate.reasons)}. {NARROWING_HINT}")
+            logger.warning(f"Rejected generated code {code_hash(code)} with estimated cost {estimate.cost:.3g}")
+            self._log(code, REJECTED, estimate, 0.0, None, None, error)
+            return None, error
+
+        lane = self._lanes[lane_name]
+        queued = time.perf_counter()
+        with self._lock:
+            lane.waiting += 1
+        acquired = lane.semaphore.acquire(timeout=lane.queue_timeout)
+        queue_seconds = time.perf_counter() - queued
+        with self._lock:
+            lane.waiting -= 1
+            if acquired:
+                lane.admitted += 1
+                lane.active += 1
+                lane.wait_seconds += queue_seconds
+            else:
+                lane.timed_out += 1
+        if not acquired:
+            error = (f"{REJECTION_PREFIX}Сейчас выполняются другие тяжелые запросы, ваш не дождался очереди "
+                     f"за {queue_seconds:.0f} с. Повторите вопрос позже. {NARROWING_HINT}")
+            logger.warning(f"Heavy lane busy, dropped generated code {code_hash(code)} after {queue_seconds:.1f}s")
+            self._log(code, lane_name, estimate, queue_seconds, None, None, error)
+            return None, error
+
+        try:
+            wall_started, cpu_started = time.perf_counter(), time.thread_time()
+            result, error = run()
+            wall, cpu = time.perf_counter() - wall_started, time.thread_time() - cpu_started
+        finally:
+            lane.semaphore.release()
+            with self._lock:
+                lane.active -= 1
+        with self._lock:
+            lane.run_seconds += wall
+        self._log(code, lane_name, estimate, queue_seconds, wall, cpu, error)
+        return result, error
+
+    def _log(self, code: str, lane: str, estimate: CostEstimate, queue_seconds: float,
+             wall: float | None, cpu: float | None, error: str | None):
+        if self._cost_log is None:
+            return
+        record = CostRecord(
+            code_hash=code_hash(code), lane=lane, estimated_cost=round(estimate.cost, 1), reasons=estimate.reasons,
+            tables=estimate.tables, queue_seconds=round(queue_seconds, 6),
+            wall_seconds=None if wall is None else round(wall, 6), cpu_seconds=None if cpu is None else round(cpu, 6),
+            error=error
+        )
+        self._cost_log.info(json.dumps(asdict(record), ensure_ascii=False))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "heavy_threshold": self.heavy_threshold,
+                "max_cost": self.max_cost,
+                "rejected": self.rejected,
+                "lanes": {name: lane.stats() for name, lane in self._lanes.items()},
+            }
+
+
+def load_cost_log(path: str = DEFAULT_COST_LOG_PATH) -> Iterable[CostRecord]:
+    """Записи журналов всех воркеров вместе с ротированными файлами path.1, path.2, ..."""
+    for file_path in log_files(path):
+        try:
+            with open(file_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield CostRecord(**json.loads(line))
+        except FileNotFoundError:
+            continue
+
+
+def calibrate(records: Iterable[CostRecord], target_fast_seconds: float = 0.1,
+              max_seconds: float = 30.0) -> Dict[str, Any]:
+    """Сверяет оценку с фактическим временем выполнения.
+
+    seconds_per_unit - медиана wall_seconds / estimated_cost по успешным выполнениям;
+    по ней предлагаются пороги: тяжелая полоса с target_fast_seconds, отказ с max_seconds.
+    Ранговая корреляция показывает, упорядочивает ли оценка запросы так же, как реальность.
+    """
+    executed = [record for record in records
+                if record.wall_seconds is not None and record.error is None and record.estimated_cost > 0]
+    if not executed:
+        return {"executions": 0}
+    ratios = sorted(record.wall_seconds / record.estimated_cost for record in executed)
+    seconds_per_unit = ratios[len(ratios) // 2]
+    by_lane = defaultdict(list)
+    for record in executed:
+        by_lane[record.lane].append(record.wall_seconds)
+    return {
+        "executions": len(executed),
+        "seconds_per_unit": seconds_per_unit,
+        "rank_correlation": _spearman([record.estimated_cost for record in executed],
+                                      [record.wall_seconds for record in executed]),
+        "suggested_heavy_threshold": target_fast_seconds / seconds_per_unit if seconds_per_unit > 0 else None,
+        "suggested_max_cost": max_seconds / seconds_per_unit if seconds_per_unit > 0 else None,
+        "lanes": {lane: {"executions": len(walls), "max_wall_seconds": max(walls)} for lane, walls in by_lane.items()},
+    }
+
+
+def _ranks(values: List[float]) -> List[float]:
+    order = sorted(range(len(values)), key=values.__getitem__)
+    ranks = [0.0] * len(values)
+    i = 0
+    while i < len(order):
+        # Одинаковым значениям - средний ранг
+        j = i
+        while j + 1 < len(order) and values[order[j + 1]] == values[order[i]]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[order[k]] = (i + j) / 2
+        i = j + 1
+    return ranks
+
+
+def _spearman(xs: List[float], ys: List[float]) -> float | None:
+    if len(xs) < 3:
+        return None
+    rx, ry = _ranks(xs), _ranks(ys)
+    mean_x, mean_y = sum(rx) / len(rx), sum(ry) / len(ry)
+    cov = sum((a - mean_x) * (b - mean_y) for a, b in zip(rx, ry))
+    var_x = sum((a - mean_x) ** 2 for a in rx)
+    var_y = sum((b - mean_y) ** 2 for b in ry)
+    if var_x == 0 or var_y == 0:
+        return None
+    return round(cov / (var_x * var_y) ** 0.5, 3)
+
+
+if __name__ == "__main__":
+    # python -m src.admission_control [query_costs.jsonl]
+    log_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_COST_LOG_PATH
+    report = calibrate(load_cost_log(log_path))
+    if not report["executions"]:
+        print(f"В {log_path} нет успешных выполнений")
+    else:
+        print(f"Выполнений: {report['executions']}, секунд на единицу стоимости: {report['seconds_per_unit']:.3g}, "
+              f"ранговая корреляция оценки и времени: {report['rank_correlation']}")
+        for lane, lane_stats in report["lanes"].items():
+            print(f"  {lane}: выполнений {lane_stats['executions']}, макс {lane_stats['max_wall_seconds']:.3f}s")
+        print(f"Предлагаемые пороги: HEAVY_COST_THRESHOLD={report['suggested_heavy_threshold']:.3g}, "
+              f"MAX_QUERY_COST={report['suggested_max_cost']:.3g}")
@@ -1,11 +1,19 @@
 import json
+import threading
 from typing import Dict, Any
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, field
+import pandas as pd
 from langgraph.graph import StateGraph, END
 from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
 from pydantic import BaseModel, Field
 from .data_processor import DataProcessor
+from .code_repair import CodeRepairer, classify_error
+from .admission_control import is_rejection, rejection_message
+from .code_optimizer import CodeOptimizer
+from .speculative import run_candidates
+from .llm_resilience import CircuitBreaker, ResilientCaller
+from .smalltalk_classifier import DATA_LABEL, TEMPLATES, SmallTalkClassifier
 import logging
 
 logger = logging.getLogger(__name__)
@@ -16,15 +24,28 @@ class QueryResponse(BaseModel):
     pandas_code: str | None = Field(description="Pandas код для выполнения (если requires_code=True)", default=None)
     direct_answer: str | None = Field(description="Прямой ответ без кода (если requires_code=False)", default=None)
 
+class MultiQueryResponse(BaseModel):
+    requires_code: bool = Field(description="Требует ли запрос выполнения pandas кода")
+    reasoning: str = Field(description="Логика и рассуждения о том, как решить задачу")
+    pandas_code_candidates: list[str] = Field(description="Альтернативные варианты pandas кода (если requires_code=True)", default_factory=list)
+    direct_answer: str | None = Field(description="Прямой ответ без кода (если requires_code=False)", default=None)
+
 class AnswerResponse(BaseModel):
     reasoning: str = Field(description="Анализ результатов и логика формирования ответа")
     final_answer: str = Field(description="Финальный ответ пользователю")
 
+class RepairResponse(BaseModel):
+    reasoning: str = Field(description="Причина ошибки и способ исправления")
+    pandas_code: str = Field(description="Исправленный pandas код")
+
 @dataclass
 class AnalyticsState:
     user_query: str
+    query_type: str | None = None
     requires_data_analysis: bool | None = None
     pandas_code: str | None = None
+    code_candidates: list[str] | None = None
+    candidate_agreement: float | None = None
     code_reasoning: str | None = None
     execution_result: Any = None
     execution_error: str | None = None
@@ -32,40 +53,88 @@ class AnalyticsState:
     answer_reasoning: str | None = None
     retry_count: int = 0
     max_retries: int = 3
+    pending_repair_class: str | None = None
+    unoptimized_code: str | None = None
+    optimizations: list[str] | None = None
+    deadline: float | None = None
+    token_usage: Dict[str, int] = field(default_factory=dict)
 
 class AnalyticsAgent:
-    def __init__(self, openai_api_key: str):
+    def __init__(self, openai_api_key: str, num_candidates: int = 1, llm_call_timeout: float = 30.0, data_processor: DataProcessor | None = None):
+        self.num_candidates = max(1, num_candidates)
         self.llm = ChatOpenAI(
             model="gpt-4o",
             temperature=0,
-            api_key=openai_api_key
+            api_key=openai_api_key,
+            timeout=llm_call_timeout,
+            max_retries=0
         )
-        self.data_processor = DataProcessor()
+        self.fallback_llm = ChatOpenAI(
+            model="gpt-4o-mini",
+            temperature=0,
+            api_key=openai_api_key,
+            timeout=llm_call_timeout,
+            max_retries=0
+        )
+        # Один breaker на gpt-4o, задержки отслеживаются отдельно для каждого места вызова
+        self.llm_breaker = CircuitBreaker()
+        self._usage_lock = threading.Lock()
+        self.llm_callers = {
+            name: ResilientCaller(name, breaker=self.llm_breaker, call_timeout=llm_call_timeout)
+            for name in ("query_processor", "code_repairer", "answer_formatter")
+        }
+        self.smalltalk_classifier = SmallTalkClassifier.load()
+        self.data_processor = data_processor or DataProcessor()
+        self.code_repairer = CodeRepairer(self.data_processor.execute_pandas_query)
+        self.code_optimizer = CodeOptimizer(self.data_processor.execute_on_sample, self.data_processor.get_columns)
         self.graph = self._build_graph()
     
     def _build_graph(self):
         workflow = StateGraph(AnalyticsState)
         
+        workflow.add_node("smalltalk_classifier", self._classify_smalltalk)
         workflow.add_node("query_processor", self._process_query)
+        workflow.add_node("code_optimizer", self._optimize_code)
         workflow.add_node("code_executor", self._execute_code)
+        workflow.add_node("code_repairer", self._repair_code)
         workflow.add_node("answer_formatter", self._format_answer)
         
-        workflow.set_entry_point("query_processor")
+        workflow.set_entry_point("smalltalk_classifier")
+        
+        workflow.add_conditional_edges(
+            "smalltalk_classifier",
+            self._route_after_classification,
+            {
+                "process": "query_processor",
+                "end": END
+            }
+        )
         
         workflow.add_conditional_edges(
             "query_processor",
             self._route_after_query_processing,
             {
-                "execute": "code_executor",
+                "execute": "code_optimizer",
                 "end": END
             }
         )
         
+        workflow.add_edge("code_optimizer", "code_executor")
+        
         workflow.add_conditional_edges(
             "code_executor",
             self._should_retry,
             {
-                "retry": "query_processor",
+                "repair": "code_repairer",
+                "format": "answer_formatter"
+            }
+        )
+        
+        workflow.add_conditional_edges(
+            "code_repairer",
+            self._route_after_repair,
+            {
+                "execute": "code_executor",
                 "format": "answer_formatter"
             }
         )
@@ -74,6 +143,22 @@ class AnalyticsAgent:
         
         return workflow.compile()
     
+    def _classify_smalltalk(self, state: AnalyticsState) -> AnalyticsState:
+        # Очевидный small talk отвечаем шаблоном без вызова gpt-4o
+        if self.smalltalk_classifier is None:
+            state.query_type = DATA_LABEL
+            return state
+        
+        state.query_type = self.smalltalk_classifier.route(state.user_query)
+        if state.query_type != DATA_LABEL:
+            logger.info(f"Answered locally as small talk: {state.query_type}")
+            state.requires_data_analysis = False
+            state.final_answer = TEMPLATES[state.query_type]
+        return state
+    
+    def _route_after_classification(self, state: AnalyticsState) -> str:
+        return "process" if state.query_type == DATA_LABEL else "end"
+    
     def _process_query(self, state: AnalyticsState) -> AnalyticsState:
         data_schema = self.data_processor.get_data_schema()
         
@@ -101,22 +186,27 @@ class AnalyticsAgent:
 
 Сначала объясни логику, затем предоставь либо код, либо прямой ответ."""
         
-        error_context = ""
-        if state.execution_error and state.retry_count > 0:
-            error_context = f"\nПредыдущая ошибка: {state.execution_error}\nИсправь код."
+        if self.num_candidates > 1:
+            system_prompt += f"""
+
+Если нужен код, предложи {self.num_candidates} независимых варианта pandas кода, решающих задачу разными способами."""
         
         messages = [
-            SystemMessage(content=system_prompt + error_context),
+            SystemMessage(content=system_prompt),
             HumanMessage(content=state.user_query)
         ]
         
-        structured_llm = self.llm.with_structured_output(QueryResponse)
-        response = structured_llm.invoke(messages)
+        response_schema = MultiQueryResponse if self.num_candidates > 1 else QueryResponse
+        response = self._invoke_structured("query_processor", response_schema, messages, state.deadline, usage=state.token_usage)
         
         state.requires_data_analysis = response.requires_code
         state.code_reasoning = response.reasoning
         
-        if response.requires_code:
+        if response.requires_code and self.num_candidates > 1:
+            candidates = [code for code in response.pandas_code_candidates if code and code.strip()]
+            state.pandas_code = candidates[0] if candidates else None
+            state.code_candidates = candidates[:self.num_candidates]
+        elif response.requires_code:
             state.pandas_code = response.pandas_code
         else:
             state.final_answer = response.direct_answer
@@ -126,14 +216,45 @@ class AnalyticsAgent:
     def _route_after_query_processing(self, state: AnalyticsState) -> str:
         return "execute" if state.requires_data_analysis else "end"
     
+    def _optimize_code(self, state: AnalyticsState) -> AnalyticsState:
+        # Медленные паттерны (iterrows, apply по строкам, merge до фильтра) переписываем до выполнения
+        if state.code_candidates:
+            state.code_candidates = [self.code_optimizer.optimize(code).code for code in state.code_candidates]
+            state.pandas_code = state.code_candidates[0]
+        elif state.pandas_code:
+            optimized = self.code_optimizer.optimize(state.pandas_code)
+            if optimized.applied:
+                state.unoptimized_code = state.pandas_code
+                state.pandas_code = optimized.code
+                state.optimizations = optimized.applied
+        return state
+    
     def _execute_code(self, state: AnalyticsState) -> AnalyticsState:
         if not state.pandas_code:
             logger.warning("No pandas code generated for execution")
             state.execution_error = "No pandas code generated"
             return state
         
-        logger.info(f"Executing pandas code (attempt {state.retry_count + 1}): {state.pandas_code[:100]}...")
-        result, error = self.data_processor.execute_pandas_query(state.pandas_code)
+        if state.code_candidates and len(state.code_candidates) > 1:
+            logger.info(f"Executing {len(state.code_candidates)} code candidates in parallel")
+            outcome = run_candidates(self.data_processor.execute_pandas_query, state.code_candidates)
+            state.code_candidates = None
+            state.candidate_agreement = outcome.agreement
+            state.pandas_code = outcome.code
+            result, error = outcome.result, outcome.error
+        else:
+            logger.info(f"Executing pandas code (attempt {state.retry_count + 1}): {state.pandas_code[:100]}...")
+            result, error = self.data_processor.execute_pandas_query(state.pandas_code)
+            if error and state.unoptimized_code and not is_rejection(error):
+                # Выборка не поймала расхождение - выполняем код в том виде, в каком его сгенерировали
+                self.code_optimizer.record_fallback(state.optimizations or [])
+                state.pandas_code, state.optimizations = state.unoptimized_code, None
+                result, error = self.data_processor.execute_pandas_query(state.pandas_code)
+            state.unoptimized_code = None
+        
+        if state.pending_repair_class:
+            self.code_repairer.record_llm_repair(state.pending_repair_class, success=error is None)
+            state.pending_repair_class = None
         
         if error:
             logger.warning(f"Code execution failed (attempt {state.retry_count + 1}): {error}")
@@ -141,21 +262,31 @@ class AnalyticsAgent:
             state.retry_count += 1
         else:
             logger.info(f"Code execution successful. Result type: {type(result)}")
-            # Convert pandas objects to a more manageable format
-            if hasattr(result, 'to_dict'):
-                state.execution_result = result.to_dict('records')
-            elif hasattr(result, 'to_json'):
-                state.execution_result = result.to_json(orient='split')
-            else:
-                state.execution_result = result
+            state.execution_result = self._serialize_result(result)
             state.execution_error = None
         
         return state
     
+    def _serialize_result(self, result: Any) -> Any:
+        # Convert pandas objects to a more manageable format
+        if isinstance(result, pd.Series):
+            # У Series нет orient='records': индекс становится ключами
+            return result.to_dict()
+        if hasattr(result, 'to_dict'):
+            return result.to_dict('records')
+        elif hasattr(result, 'to_json'):
+            return result.to_json(orient='split')
+        return result
+    
     def _should_retry(self, state: AnalyticsState) -> str:
+        if is_rejection(state.execution_error):
+            # Отказ по стоимости не ошибка кода: починка даст такой же тяжелый запрос
+            logger.info(f"Query rejected by admission control: {state.execution_error}")
+            return "format"
+        
         if state.execution_error and state.retry_count < state.max_retries:
-            logger.info(f"Retrying code generation (attempt {state.retry_count + 1}/{state.max_retries})")
-            return "retry"
+            logger.info(f"Repairing failed code (attempt {state.retry_count + 1}/{state.max_retries})")
+            return "repair"
         
         if state.execution_error:
             logger.error(f"Max retries exceeded. Final error: {state.execution_error}")
@@ -164,7 +295,45 @@ class AnalyticsAgent:
         
         return "format"
     
+    def _repair_code(self, state: AnalyticsState) -> AnalyticsState:
+        local_repair = self.code_repairer.repair_locally(state.pandas_code, state.execution_error)
+        if local_repair:
+            state.pandas_code = local_repair.code
+            state.execution_result = self._serialize_result(local_repair.result)
+            state.execution_error = None
+            return state
+        
+        # Локально не починили - отправляем компактный промпт: прошлый код + ошибка
+        system_prompt = f"""Ты исправляешь pandas код, который упал с ошибкой.
+
+Доступные данные:
+{self.data_processor.get_compact_schema()}
+
+Правила:
+1. Всегда присваивай финальный результат переменной 'result'
+2. Используй только pandas операции
+3. Меняй только то, что нужно для исправления ошибки"""
+        
+        messages = [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=f"Вопрос: {state.user_query}\n\nКод:\n{state.pandas_code}\n\nОшибка: {state.execution_error}")
+        ]
+        
+        response = self._invoke_structured("code_repairer", RepairResponse, messages, state.deadline, usage=state.token_usage)
+        
+        state.pandas_code = response.pandas_code
+        state.code_reasoning = response.reasoning
+        state.pending_repair_class = classify_error(state.execution_error)
+        
+        return state
+    
+    def _route_after_repair(self, state: AnalyticsState) -> str:
+        return "format" if state.execution_error is None else "execute"
+    
     def _format_answer(self, state: AnalyticsState) -> AnalyticsState:
+        if is_rejection(state.execution_error):
+            state.final_answer = rejection_message(state.execution_error)
+            return state
         if state.execution_error:
             state.final_answer = f"Ошибка при выполнении запроса: {state.execution_error}"
             return state
@@ -190,23 +359,77 @@ class AnalyticsAgent:
             HumanMessage(content=f"Пользовательский запрос: {state.user_query}\n\nРезультат pandas: {state.execution_result}")
         ]
         
-        structured_llm = self.llm.with_structured_output(AnswerResponse)
-        response = structured_llm.invoke(messages)
+        response = self._invoke_structured(
+            "answer_formatter", AnswerResponse, messages, state.deadline,
+            fallback=lambda: self._format_answer_locally(state.execution_result),
+            usage=state.token_usage
+        )
         
         state.final_answer = response.final_answer
         state.answer_reasoning = response.reasoning
         
         return state
     
+    def _invoke_structured(self, call_site: str, schema: type[BaseModel], messages: list, deadline: float | None, fallback=None,
+                           usage: Dict[str, int] | None = None):
+        def structured(llm):
+            output = llm.with_structured_output(schema, include_raw=True).invoke(messages)
+            if output.get("parsing_error") is not None or output.get("parsed") is None:
+                raise output.get("parsing_error") or ValueError(f"Empty structured output for {schema.__name__}")
+            # Считаем все завершившиеся вызовы, включая проигравший хедж: его токены тоже оплачены
+            metadata = getattr(output["raw"], "usage_metadata", None) or {}
+            if usage is not None:
+                with self._usage_lock:
+                    usage["input_tokens"] = usage.get("input_tokens", 0) + metadata.get("input_tokens", 0)
+                    usage["output_tokens"] = usage.get("output_tokens", 0) + metadata.get("output_tokens", 0)
+                    usage["llm_calls"] = usage.get("llm_calls", 0) + 1
+            return output["parsed"]
+        
+        def fallback_model():
+            return structured(self.fallback_llm)
+        
+        return self.llm_callers[call_site].call(
+            lambda: structured(self.llm),
+            fallback=fallback if fallback is not None else fallback_model,
+            deadline=deadline
+        )
+    
+    def _format_answer_locally(self, execution_result: Any) -> AnswerResponse:
+        if isinstance(execution_result, list) and execution_result and isinstance(execution_result[0], dict):
+            rows = ["; ".join(f"{key}: {value}" for key, value in row.items()) for row in execution_result[:10]]
+            answer = "\n".join(rows)
+            if len(execution_result) > 10:
+                answer += f"\n... и еще {len(execution_result) - 10} строк"
+        elif isinstance(execution_result, dict):
+            answer = ", ".join(f"{key}: {value}" for key, value in list(execution_result.items())[:20])
+        elif isinstance(execution_result, float):
+            answer = f"{execution_result:.2f}"
+        else:
+            answer = str(execution_result)
+        return AnswerResponse(reasoning="Локальное форматирование без LLM", final_answer=f"Результат: {answer}")
+    
+    def answer_with_code(self, user_query: str, pandas_code: str, deadline: float | None = None) -> Dict[str, Any] | None:
+        """Выполняет готовый код и форматирует ответ, минуя генерацию кода. None - код упал"""
+        state = AnalyticsState(user_query=user_query, query_type="followup", requires_data_analysis=True,
+                               pandas_code=pandas_code, deadline=deadline)
+        state = self._execute_code(state)
+        if state.execution_error:
+            return None
+        return asdict(self._format_answer(state))
+    
+    def llm_stats(self) -> Dict[str, Any]:
+        return {name: caller.stats() for name, caller in self.llm_callers.items()}
+    
+    def answer_query(self, user_query: str, deadline: float | None = None) -> Dict[str, Any]:
+        """Прогоняет вопрос через граф и возвращает итоговое состояние целиком"""
+        final_state = self.graph.invoke(AnalyticsState(user_query=user_query, deadline=deadline))
+        # Граф возвращает dict, а не dataclass
+        return final_state if isinstance(final_state, dict) else asdict(final_state)
+    
     def process_query(self, user_query: str) -> str:
         try:
-            initial_state = AnalyticsState(user_query=user_query)
-            final_state = self.graph.invoke(initial_state)
-            
-            if hasattr(final_state, 'final_answer'):
-                return final_state.final_answer or "Не удалось обработать запрос"
-            else:
-                return final_state.get('final_answer') or "Не удалось обработать запрос"
+            final_state = self.answer_query(user_query)
+            return final_state.get('final_answer') or "Не удалось обработать запрос"
             
         except Exception:
             logger.exception("Error processing query")
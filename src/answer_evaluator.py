@@ -1,7 +1,7 @@
-from langchain_openai import ChatOpenAI
-from langchain.schema import HumanMessage, SystemMessage
 from typing import Dict, Any
 from openai import OpenAI
+from .llm_resilience import CircuitBreaker, ResilientCaller
+from .reference_answers import ReferenceChecker
 import logging
 
 logger = logging.getLogger(__name__)
@@ -12,23 +12,26 @@ class EvaluationResult:
         self.reasoning = reasoning
 
 class AnswerEvaluator:
-    def __init__(self, openai_api_key: str):
-        self.client = OpenAI(api_key=openai_api_key)
-        self.llm = ChatOpenAI(
-            model="gpt-4o",
-            temperature=0,
-            api_key=openai_api_key
-        )
+    def __init__(self, openai_api_key: str, llm_call_timeout: float = 30.0, reference_checker: ReferenceChecker | None = None):
+        self.reference_checker = reference_checker
+        self.client = OpenAI(api_key=openai_api_key, timeout=llm_call_timeout, max_retries=0)
+        self.model = "gpt-4o"
+        self.fallback_model = "gpt-4o-mini"
+        self.llm_breaker = CircuitBreaker()
+        self.llm_callers = {
+            name: ResilientCaller(name, breaker=self.llm_breaker, call_timeout=llm_call_timeout)
+            for name in ("correctness", "conciseness", "code_quality")
+        }
     
-    def evaluate_answer(self, user_query: str, answer: str, pandas_code: str = "", execution_result: str = "", code_reasoning: str = "", answer_reasoning: str = "") -> Dict[str, Any]:
+    def evaluate_answer(self, user_query: str, answer: str, pandas_code: str = "", execution_result: str = "", code_reasoning: str = "", answer_reasoning: str = "", deadline: float | None = None) -> Dict[str, Any]:
         """Оценивает ответ по 3 критериям: correctness, conciseness, code_checker"""
         
-        correctness_result = self._evaluate_correctness(user_query, answer, execution_result, answer_reasoning)
-        conciseness_result = self._evaluate_conciseness(user_query, answer, answer_reasoning)
+        correctness_result = self._evaluate_correctness(user_query, answer, execution_result, answer_reasoning, deadline)
+        conciseness_result = self._evaluate_conciseness(user_query, answer, answer_reasoning, deadline)
         
         # Оценка кода только если есть pandas_code
         if pandas_code and pandas_code.strip():
-            code_checker_result = self._evaluate_code_quality(pandas_code, user_query, code_reasoning)
+            code_checker_result = self._evaluate_code_quality(pandas_code, user_query, code_reasoning, deadline)
             scores = [correctness_result.score, conciseness_result.score, code_checker_result.score]
         else:
             code_checker_result = None
@@ -49,8 +52,28 @@ class AnswerEvaluator:
             "evaluation_text": f"Оценка качества ответа: {overall_score} из 5" if overall_score is not None else "Ошибка при оценке качества ответа"
         }
     
-    def _evaluate_correctness(self, user_query: str, answer: str, execution_result: str, answer_reasoning: str = "") -> EvaluationResult:
+    def _create_completion(self, call_site: str, messages: list, response_format: dict, deadline: float | None = None):
+        """Вызов судьи через resilience-слой; при открытом breaker - более дешевая модель"""
+        return self.llm_callers[call_site].call(
+            lambda: self.client.chat.completions.create(model=self.model, messages=messages, response_format=response_format),
+            fallback=lambda: self.client.chat.completions.create(model=self.fallback_model, messages=messages, response_format=response_format),
+            deadline=deadline
+        )
+    
+    def llm_stats(self) -> Dict[str, Any]:
+        return {name: caller.stats() for name, caller in self.llm_callers.items()}
+    
+    def _evaluate_correctness(self, user_query: str, answer: str, execution_result: str, answer_reasoning: str = "", deadline: float | None = None) -> EvaluationResult:
         """Оценка корректности ответа"""
+        # Для канонических вопросов числа сверяются с эталонным расчетом локально, без судьи
+        if self.reference_checker is not None:
+            check = self.reference_checker.check(user_query, answer)
+            if check is not None and check.decided:
+                return EvaluationResult(check.score, check.reasoning)
+            if check is not None:
+                # Числа не привязались к регионам/дням - сверку по меткам решает судья
+                logger.info(f"Reference check undecided, falling back to LLM judge: {check.reasoning}")
+        
         correctness_prompt = """
         You are an expert data labeler evaluating model outputs for correctness. Your task is to assign a score based on the following rubric:
 
@@ -98,19 +121,14 @@ class AnswerEvaluator:
         
         prompt_with_data = correctness_prompt.replace("{{inputs}}", inputs).replace("{{outputs}}", outputs)
         
-        messages = [
-            SystemMessage(content=prompt_with_data),
-            HumanMessage(content="Оцени от 1 до 5:")
-        ]
-        
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
+            response = self._create_completion(
+                "correctness",
+                [
                     {"role": "system", "content": prompt_with_data},
                     {"role": "user", "content": "Оцени от 1 до 5 и предоставь reasoning:"}
                 ],
-                response_format={
+                {
                     "type": "json_schema",
                     "json_schema": {
                         "name": "evaluation_result",
@@ -124,7 +142,8 @@ class AnswerEvaluator:
                             "additionalProperties": False
                         }
                     }
-                }
+                },
+                deadline
             )
             
             import json
@@ -134,7 +153,7 @@ class AnswerEvaluator:
             logger.exception("Error evaluating correctness")
             return EvaluationResult(None, "Error occurred during evaluation")
     
-    def _evaluate_conciseness(self, user_query: str, answer: str, answer_reasoning: str = "") -> EvaluationResult:
+    def _evaluate_conciseness(self, user_query: str, answer: str, answer_reasoning: str = "", deadline: float | None = None) -> EvaluationResult:
         """Оценка краткости ответа"""
         conciseness_prompt = """
 You are an expert data labeler evaluating model outputs for conciseness. Your task is to assign a score based on the following rubric:
@@ -184,19 +203,14 @@ You are an expert data labeler evaluating model outputs for conciseness. Your ta
         
         prompt_with_data = conciseness_prompt.replace("{{inputs}}", inputs).replace("{{outputs}}", outputs)
         
-        messages = [
-            SystemMessage(content=prompt_with_data),
-            HumanMessage(content="Оцени от 1 до 5:")
-        ]
-        
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
+            response = self._create_completion(
+                "conciseness",
+                [
                     {"role": "system", "content": prompt_with_data},
                     {"role": "user", "content": "Оцени от 1 до 5 и предоставь reasoning:"}
                 ],
-                response_format={
+                {
                     "type": "json_schema",
                     "json_schema": {
                         "name": "evaluation_result",
@@ -210,7 +224,8 @@ You are an expert data labeler evaluating model outputs for conciseness. Your ta
                             "additionalProperties": False
                         }
                     }
-                }
+                },
+                deadline
             )
             
             import json
@@ -220,7 +235,7 @@ You are an expert data labeler evaluating model outputs for conciseness. Your ta
             logger.exception("Error evaluating conciseness")
             return EvaluationResult(None, "Error occurred during evaluation")
     
-    def _evaluate_code_quality(self, pandas_code: str, user_query: str, code_reasoning: str = "") -> EvaluationResult:
+    def _evaluate_code_quality(self, pandas_code: str, user_query: str, code_reasoning: str = "", deadline: float | None = None) -> EvaluationResult:
         """Оценка качества сгенерированного кода"""
         code_checker_prompt = """
         You are an expert code reviewer evaluating code for correctness. Your task is to assign a score based on the following rubric:
@@ -271,19 +286,14 @@ You are an expert data labeler evaluating model outputs for conciseness. Your ta
         
         prompt_with_data = code_checker_prompt.replace("{{inputs}}", inputs).replace("{{outputs}}", outputs)
         
-        messages = [
-            SystemMessage(content=prompt_with_data),
-            HumanMessage(content="Оцени от 1 до 5:")
-        ]
-        
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
+            response = self._create_completion(
+                "code_quality",
+                [
                     {"role": "system", "content": prompt_with_data},
                     {"role": "user", "content": "Оцени от 1 до 5 и предоставь reasoning:"}
                 ],
-                response_format={
+                {
                     "type": "json_schema",
                     "json_schema": {
                         "name": "evaluation_result",
@@ -297,7 +307,8 @@ You are an expert data labeler evaluating model outputs for conciseness. Your ta
                             "additionalProperties": False
                         }
                     }
-                }
+                },
+                deadline
             )
             
             import json
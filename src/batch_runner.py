@@ -0,0 +1,207 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import IO, Any, Callable, Dict, Iterable, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUESTION_FIELDS = ("question", "query", "message")
+
+
+@dataclass
+class BatchQuestion:
+    id: str
+    question: str
+
+    @property
+    def key(self) -> str:
+        return normalize_question(self.question)
+
+
+def normalize_question(text: str) -> str:
+    return " ".join(text.lower().replace("ё", "е").split())
+
+
+def parse_questions(lines: Iterable[str]) -> List[BatchQuestion]:
+    """Вопросы из JSONL ({"id": ..., "question": ...}), JSON-строк или просто строк текста"""
+    questions: Dict[str, BatchQuestion] = {}
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            item = line
+        if isinstance(item, dict):
+            text = next((item[name] for name in QUESTION_FIELDS if item.get(name)), None)
+            question_id = item.get("id")
+        elif isinstance(item, str):
+            text, question_id = item, None
+        else:
+            raise ValueError(f"Строка {number}: ожидался объект или строка, получено {type(item).__name__}")
+        if not text or not str(text).strip():
+            logger.warning(f"Line {number} has no question, skipping")
+            continue
+
+        text = str(text).strip()
+        # Без явного id ключом служит сам вопрос: так перезапуск находит уже готовые ответы
+        question_id = str(question_id) if question_id is not None else \
+            "q-" + hashlib.sha1(normalize_question(text).encode("utf-8")).hexdigest()[:10]
+        existing = questions.get(question_id)
+        if existing is not None and existing.key != normalize_question(text):
+            raise ValueError(f"Строка {number}: id {question_id!r} уже занят другим вопросом")
+        questions.setdefault(question_id, BatchQuestion(id=question_id, question=text))
+    return list(questions.values())
+
+
+def load_completed(path: str, retry_errors: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Готовые записи из прошлого запуска; оборванная последняя строка пропускается"""
+    completed = {}
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(record, dict) and "id" in record and (record.get("status") == "ok" or not retry_errors):
+                completed[record["id"]] = record
+    return completed
+
+
+def open_output(path: str) -> IO[str]:
+    if path == "-":
+        return sys.stdout
+    needs_newline = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    out = open(path, "a", encoding="utf-8")
+    if needs_newline:
+        # Прошлый запуск прервали посреди записи - начинаем с новой строки
+        out.write("\n")
+    return out
+
+
+def _answer_one(answer: Callable[[str], Dict[str, Any]], question: BatchQuestion) -> Dict[str, Any]:
+    started = time.perf_counter()
+    record: Dict[str, Any] = {"id": question.id, "question": question.question}
+    try:
+        state = answer(question.question)
+        record.update(
+            status="error" if state.get("execution_error") else "ok",
+            answer=state.get("final_answer"),
+            query_type=state.get("query_type"),
+            pandas_code=state.get("pandas_code"),
+            execution_result=state.get("execution_result"),
+            execution_error=state.get("execution_error"),
+            optimizations=state.get("optimizations"),
+            token_usage=state.get("token_usage") or {},
+        )
+    except Exception as e:
+        logger.exception(f"Question {question.id} failed")
+        record.update(status="error", answer=None, error=f"{type(e).__name__}: {e}", token_usage={})
+    record["wall_seconds"] = round(time.perf_counter() - started, 3)
+    record["finished_at"] = time.time()
+    return record
+
+
+def run_batch(questions: List[BatchQuestion], answer: Callable[[str], Dict[str, Any]], out: IO[str],
+              concurrency: int = 4, completed: Dict[str, Dict[str, Any]] | None = None) -> Dict[str, Any]:
+    """Отвечает на вопросы с ограниченным параллелизмом и пишет каждый ответ в out сразу по готовности"""
+    completed = completed or {}
+    started = time.perf_counter()
+    summary = {"questions": len(questions), "resumed": 0, "answered": 0, "deduplicated": 0, "errors": 0,
+               "input_tokens": 0, "output_tokens": 0}
+
+    def write(record: Dict[str, Any]):
+        out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        out.flush()
+
+    # Одинаковые вопросы считаем один раз; ответ копируем всем их id
+    groups: Dict[str, List[BatchQuestion]] = {}
+    done_by_key = {normalize_question(record["question"]): record for record in completed.values()
+                   if record.get("status") == "ok" and record.get("question")}
+    for question in questions:
+        if question.id in completed:
+            summary["resumed"] += 1
+            continue
+        previous = done_by_key.get(question.key)
+        if previous is not None:
+            write({**previous, "id": question.id, "question": question.question, "deduplicated_from": previous["id"]})
+            summary["deduplicated"] += 1
+            continue
+        groups.setdefault(question.key, []).append(question)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch")
+    try:
+        futures = {executor.submit(_answer_one, answer, group[0]): group for group in groups.values()}
+        for future in as_completed(futures):
+            group = futures[future]
+            record = future.result()
+            write(record)
+            summary["answered"] += 1
+            summary["errors"] += record["status"] != "ok"
+            summary["input_tokens"] += record["token_usage"].get("input_tokens", 0)
+            summary["output_tokens"] += record["token_usage"].get("output_tokens", 0)
+            for duplicate in group[1:]:
+                write({**record, "id": duplicate.id, "question": duplicate.question, "deduplicated_from": record["id"]})
+                summary["deduplicated"] += 1
+    finally:
+        # При Ctrl+C не ждем оставшиеся вопросы: записанное уже на диске, перезапуск продолжит
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    summary["wall_seconds"] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Пакетные ответы на вопросы: JSONL на входе и на выходе")
+    parser.add_argument("input", nargs="?", default="-", help="JSONL с вопросами или '-' для stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSONL с ответами; при перезапуске готовые вопросы пропускаются")
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--budget", type=float, default=float(os.getenv("LLM_REQUEST_BUDGET", "60")),
+                        help="Бюджет на все LLM вызовы одного вопроса, секунды")
+    parser.add_argument("--num-candidates", type=int, default=int(os.getenv("CODE_CANDIDATES", "1")))
+    parser.add_argument("--retry-errors", action="store_true", help="Заново задать вопросы, завершившиеся ошибкой")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    from .analytics_agent import AnalyticsAgent
+    from .llm_resilience import deadline_after
+
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    if args.input == "-":
+        questions = parse_questions(sys.stdin)
+    else:
+        with open(args.input, encoding="utf-8") as f:
+            questions = parse_questions(f)
+    completed = load_completed(args.output, args.retry_errors) if args.output != "-" else {}
+
+    # Один агент на весь запуск: общий снапшот данных, общие HTTP клиенты и circuit breaker
+    agent = AnalyticsAgent(os.getenv("OPENAI_API_KEY"), num_candidates=args.num_candidates)
+    out = open_output(args.output)
+    try:
+        summary = run_batch(questions, lambda question: agent.answer_query(question, deadline_after(args.budget)),
+                            out, concurrency=args.concurrency, completed=completed)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == "__main__":
+    # python -m src.batch_runner questions.jsonl -o answers.jsonl -c 4
+    sys.exit(main())
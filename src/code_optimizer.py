@@ -0,0 +1,709 @@
+import ast
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from .speculative import result_fingerprint
+from .ttl_cache import TTLCache
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Схема данных: {имя фрейма: {колонка: dtype}}
+Schema = Dict[str, Dict[str, str]]
+
+ARITHMETIC_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+COMPARE_OPS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+DT_FIELDS = {"year", "month", "day", "hour", "minute", "quarter", "dayofweek", "dayofyear"}
+DT_METHODS = {"strftime"}
+STR_METHODS = {"lower", "upper", "strip", "startswith", "endswith"}
+# Вызовы, которые можно вычислить один раз вместо нескольких одинаковых
+PURE_MASK_METHODS = {"isin", "between", "isna", "notna", "isnull", "notnull", "contains", "startswith",
+                     "endswith", "Timestamp", "to_datetime"}
+
+
+def _is_pd_call(node: ast.AST, name: str) -> bool:
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == name
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == "pd")
+
+
+def _column_of(node: ast.AST, frame: str, columns: Set[str] | None = None) -> str | None:
+    """'col' для frame['col'] или frame.col (атрибут - только если это известная колонка)"""
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == frame:
+        if isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+            return node.slice.value
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == frame:
+        if columns is None or node.attr in columns:
+            return node.attr
+    return None
+
+
+def _is_plain_reference(node: ast.AST) -> bool:
+    """Имя, колонка или атрибут: такое выражение можно продублировать без побочных эффектов"""
+    if isinstance(node, ast.Name):
+        return True
+    if isinstance(node, ast.Subscript):
+        return isinstance(node.slice, ast.Constant) and _is_plain_reference(node.value)
+    if isinstance(node, ast.Attribute):
+        return _is_plain_reference(node.value)
+    return False
+
+
+def _stored_names(node: ast.AST) -> Set[str]:
+    """Имена, в которые пишет оператор, включая df['x'] = ... и df.x = ..."""
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, (ast.Store, ast.Del)):
+            names.add(child.id)
+        elif isinstance(child, (ast.Subscript, ast.Attribute)) and isinstance(child.ctx, (ast.Store, ast.Del)):
+            base = child.value
+            while isinstance(base, (ast.Subscript, ast.Attribute)):
+                base = base.value
+            if isinstance(base, ast.Name):
+                names.add(base.id)
+    return names
+
+
+def _loaded_names(node: ast.AST) -> Set[str]:
+    return {child.id for child in ast.walk(node) if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load)}
+
+
+def _has_inplace(tree: ast.AST) -> bool:
+    return any(isinstance(node, ast.keyword) and node.arg == "inplace" for node in ast.walk(tree))
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Vectorizer(ast.NodeTransformer):
+    """Переписывает тело lambda/цикла по строкам в выражение над колонками base.
+
+    mode="row": аргумент - строка DataFrame (row['col'] -> base['col']),
+    mode="value": аргумент - значение Series (x + 1 -> base + 1, x.month -> base.dt.month).
+    """
+
+    def __init__(self, arg: str, base: ast.AST, mode: str):
+        self.arg = arg
+        self.base = base
+        self.mode = mode
+        self.references = 0
+
+    def _base(self) -> ast.AST:
+        self.references += 1
+        return ast.parse(ast.unparse(self.base), mode="eval").body
+
+    def _accessor(self, accessor: str) -> ast.AST:
+        return ast.Attribute(value=self._base(), attr=accessor, ctx=ast.Load())
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id == self.arg:
+            if self.mode == "row":
+                raise _Unsupported("row used as a whole")
+            return self._base()
+        return node
+
+    def visit_Subscript(self, node: ast.Subscript) -> ast.AST:
+        if self.mode == "row" and isinstance(node.value, ast.Name) and node.value.id == self.arg:
+            if not (isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)):
+                raise _Unsupported("dynamic row subscript")
+            return ast.Subscript(value=self._base(), slice=node.slice, ctx=ast.Load())
+        raise _Unsupported("subscript")
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        if isinstance(node.value, ast.Name) and node.value.id == self.arg:
+            if self.mode == "row":
+                return ast.Subscript(value=self._base(), slice=ast.Constant(value=node.attr), ctx=ast.Load())
+            if node.attr in DT_FIELDS:
+                return ast.Attribute(value=self._accessor("dt"), attr=node.attr, ctx=ast.Load())
+        raise _Unsupported("attribute")
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        func = node.func
+        if self.mode == "value" and isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) \
+                and func.value.id == self.arg and all(isinstance(a, ast.Constant) for a in node.args) and not node.keywords:
+            accessor = "dt" if func.attr in DT_METHODS else "str" if func.attr in STR_METHODS else None
+            if accessor:
+                return ast.Call(func=ast.Attribute(value=self._accessor(accessor), attr=func.attr, ctx=ast.Load()),
+                                args=node.args, keywords=[])
+        raise _Unsupported("call")
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        if not isinstance(node.op, ARITHMETIC_OPS + (ast.BitAnd, ast.BitOr)):
+            raise _Unsupported("operator")
+        return self.generic_visit(node)
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        if not isinstance(node.op, (ast.USub, ast.UAdd, ast.Invert)):
+            raise _Unsupported("operator")
+        return node
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        combined = node.values[0]
+        for value in node.values[1:]:
+            combined = ast.BinOp(left=combined, op=op, right=value)
+        return combined
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        # Цепочки a < x < b поэлементно не работают
+        if len(node.ops) != 1 or not isinstance(node.ops[0], COMPARE_OPS):
+            raise _Unsupported("comparison")
+        return self.generic_visit(node)
+
+    def visit_Constant(self, node: ast.Constant) -> ast.AST:
+        return node
+
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        # Конкретные операторы уже проверены в visit_BinOp/visit_UnaryOp/visit_Compare
+        if not isinstance(node, (ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.expr_context,
+                                 ast.operator, ast.unaryop, ast.boolop, ast.cmpop)):
+            raise _Unsupported(type(node).__name__)
+        return super().generic_visit(node)
+
+
+def _vectorize(expr: ast.AST, arg: str, base: ast.AST, mode: str) -> Tuple[ast.AST, int] | None:
+    """Векторизованная копия expr и число обращений к аргументу; None, если так нельзя"""
+    vectorizer = _Vectorizer(arg, base, mode)
+    try:
+        vectorized = vectorizer.visit(ast.parse(ast.unparse(expr), mode="eval").body)
+    except _Unsupported:
+        return None
+    return vectorized, vectorizer.references
+
+
+# ---------------------------------------------------------------------------
+# Правила. Каждое правило меняет дерево на месте и возвращает True, если что-то переписало.
+# ---------------------------------------------------------------------------
+
+class _RedundantToDatetime(ast.NodeTransformer):
+    """pd.to_datetime(df['date']) для колонок, которые уже datetime64 -> df['date']"""
+
+    def __init__(self, schema: Schema):
+        self.datetime_columns = {(frame, column) for frame, columns in schema.items()
+                                 for column, dtype in columns.items() if dtype.startswith("datetime64")}
+        self.applied = False
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        self.generic_visit(node)
+        if not _is_pd_call(node, "to_datetime") or len(node.args) != 1:
+            return node
+        if any(keyword.arg not in ("format", "errors") for keyword in node.keywords):
+            return node
+        arg = node.args[0]
+        for frame, column in self.datetime_columns:
+            if _column_of(arg, frame) == column:
+                self.applied = True
+                return arg
+        return node
+
+    def visit_Assign(self, node: ast.Assign) -> ast.AST | None:
+        self.generic_visit(node)
+        # df['date'] = df['date'] после снятия to_datetime ничего не делает
+        if len(node.targets) == 1 and self.applied and ast.unparse(node.targets[0]) == ast.unparse(node.value):
+            return None
+        return node
+
+
+def _redundant_to_datetime(tree: ast.Module, schema: Schema) -> bool:
+    transformer = _RedundantToDatetime(schema)
+    transformer.visit(tree)
+    if not tree.body:
+        tree.body.append(ast.Pass())
+    return transformer.applied
+
+
+class _VectorizeApply(ast.NodeTransformer):
+    """df.apply(lambda r: r['a'] * r['b'], axis=1) -> df['a'] * df['b'], s.apply(lambda x: x.month) -> s.dt.month"""
+
+    def __init__(self):
+        self.applied = False
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        self.generic_visit(node)
+        func = node.func
+        if not (isinstance(func, ast.Attribute) and func.attr in ("apply", "map") and _is_plain_reference(func.value)):
+            return node
+        if len(node.args) != 1 or not isinstance(node.args[0], ast.Lambda):
+            return node
+        lambda_node = node.args[0]
+        params = lambda_node.args
+        if len(params.args) != 1 or params.vararg or params.kwarg or params.kwonlyargs or params.defaults:
+            return node
+
+        keywords = {keyword.arg: keyword.value for keyword in node.keywords}
+        if func.attr == "apply" and set(keywords) == {"axis"}:
+            axis = keywords["axis"]
+            if not (isinstance(axis, ast.Constant) and axis.value in (1, "columns")):
+                return node
+            mode = "row"
+        elif not keywords:
+            mode = "value"
+        else:
+            return node
+
+        vectorized = _vectorize(lambda_node.body, params.args[0].arg, func.value, mode)
+        if vectorized is None or vectorized[1] == 0:
+            return node
+        self.applied = True
+        return vectorized[0]
+
+
+def _vectorize_apply(tree: ast.Module, schema: Schema) -> bool:
+    transformer = _VectorizeApply()
+    transformer.visit(tree)
+    return transformer.applied
+
+
+def _iterrows_loop(node: ast.AST) -> Tuple[ast.AST, str, str] | None:
+    """(фрейм, имя индекса, имя строки) для `for i, row in df.iterrows():`"""
+    if not isinstance(node, ast.For) or node.orelse:
+        return None
+    call = node.iter
+    if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == "iterrows"
+            and not call.args and not call.keywords and _is_plain_reference(call.func.value)):
+        return None
+    target = node.target
+    if not (isinstance(target, ast.Tuple) and len(target.elts) == 2 and all(isinstance(e, ast.Name) for e in target.elts)):
+        return None
+    return call.func.value, target.elts[0].id, target.elts[1].id
+
+
+def _accumulations(body: List[ast.stmt]) -> List[Tuple[str, ast.AST | None, ast.AST]] | None:
+    """[(аккумулятор, условие или None, слагаемое)] для тела из `acc += x` и `if cond: acc += x`"""
+    accumulations = []
+    for statement in body:
+        condition = None
+        inner = [statement]
+        if isinstance(statement, ast.If) and not statement.orelse:
+            condition, inner = statement.test, statement.body
+        for item in inner:
+            if not (isinstance(item, ast.AugAssign) and isinstance(item.op, ast.Add) and isinstance(item.target, ast.Name)):
+                return None
+            accumulations.append((item.target.id, condition, item.value))
+    return accumulations
+
+
+def _vectorize_iterrows(tree: ast.Module, schema: Schema) -> bool:
+    """for _, row in df.iterrows(): if cond: total += row['x'] -> total += df['x'][cond].sum()"""
+    for index, statement in enumerate(tree.body):
+        loop = _iterrows_loop(statement)
+        if loop is None:
+            continue
+        base, index_name, row_name = loop
+        accumulations = _accumulations(statement.body)
+        if not accumulations:
+            continue
+        later_names = set().union(*(_loaded_names(s) for s in tree.body[index + 1:]))
+        loop_body_names = set().union(*(_loaded_names(s) for s in statement.body))
+        accumulators = {accumulator for accumulator, _, _ in accumulations}
+        if index_name in loop_body_names or {index_name, row_name} & (later_names | accumulators):
+            continue
+        # Слагаемые не должны зависеть от аккумуляторов: тогда порядок итераций важен
+        if any(accumulators & _loaded_names(value) or (cond is not None and accumulators & _loaded_names(cond))
+               for _, cond, value in accumulations):
+            continue
+
+        replacement = []
+        for accumulator, condition, value in accumulations:
+            mask = None
+            if condition is not None:
+                vectorized_condition = _vectorize(condition, row_name, base, "row")
+                if vectorized_condition is None or vectorized_condition[1] == 0:
+                    break
+                mask = vectorized_condition[0]
+            vectorized_value = _vectorize(value, row_name, base, "row")
+            if vectorized_value is None:
+                break
+            value_expr, references = vectorized_value
+            if references:
+                series = value_expr if mask is None else ast.Subscript(value=value_expr, slice=mask, ctx=ast.Load())
+                term = ast.Call(func=ast.Attribute(value=series, attr="sum", ctx=ast.Load()), args=[], keywords=[])
+            else:
+                rows = base if mask is None else ast.Subscript(value=base, slice=mask, ctx=ast.Load())
+                term = ast.Call(func=ast.Name(id="len", ctx=ast.Load()), args=[rows], keywords=[])
+                if not (isinstance(value_expr, ast.Constant) and value_expr.value == 1):
+                    term = ast.BinOp(left=term, op=ast.Mult(), right=value_expr)
+            replacement.append(ast.AugAssign(target=ast.Name(id=accumulator, ctx=ast.Store()), op=ast.Add(), value=term))
+        else:
+            tree.body[index:index + 1] = replacement
+            return True
+    return False
+
+
+def _merge_parts(node: ast.AST) -> Tuple[ast.Call, str, str, Set[str]] | None:
+    """(вызов, левый фрейм, правый фрейм, ключи) для L.merge(R, on=...) и pd.merge(L, R, on=...)"""
+    if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Attribute) or node.func.attr != "merge":
+        return None
+    if _is_pd_call(node, "merge"):
+        frames = node.args[:2]
+        extra_args = node.args[2:]
+    else:
+        frames = [node.func.value] + node.args[:1]
+        extra_args = node.args[1:]
+    if len(frames) != 2 or extra_args or not all(isinstance(frame, ast.Name) for frame in frames):
+        return None
+    keywords = {keyword.arg: keyword.value for keyword in node.keywords}
+    how = keywords.get("how")
+    if how is not None and not (isinstance(how, ast.Constant) and how.value == "inner"):
+        return None
+    if set(keywords) - {"on", "how"} or "on" not in keywords:
+        return None
+    try:
+        on = ast.literal_eval(keywords["on"])
+    except ValueError:
+        return None
+    keys = {on} if isinstance(on, str) else set(on)
+    return node, frames[0].id, frames[1].id, keys
+
+
+def _conjuncts(node: ast.AST) -> List[ast.AST]:
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitAnd):
+        return _conjuncts(node.left) + _conjuncts(node.right)
+    return [node]
+
+
+def _and_all(nodes: List[ast.AST]) -> ast.AST:
+    combined = nodes[0]
+    for node in nodes[1:]:
+        combined = ast.BinOp(left=combined, op=ast.BitAnd(), right=node)
+    return combined
+
+
+class _RenameFrame(ast.NodeTransformer):
+    def __init__(self, old: str, new: str):
+        self.old, self.new = old, new
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        return ast.Name(id=self.new, ctx=node.ctx) if node.id == self.old else node
+
+
+def _filter_before_merge(tree: ast.Module, schema: Schema) -> bool:
+    """merged = users_df.merge(orders_df, on=...); x = merged[cond] -> фильтры каждой стороны до merge"""
+    body = tree.body
+    for i, statement in enumerate(body):
+        if not (isinstance(statement, ast.Assign) and len(statement.targets) == 1 and isinstance(statement.targets[0], ast.Name)):
+            continue
+        parts = _merge_parts(statement.value)
+        if parts is None:
+            continue
+        merge_call, left, right, keys = parts
+        merged = statement.targets[0].id
+        if left not in schema or right not in schema or left == right:
+            continue
+        # Схема верна, только пока исходные фреймы не перезаписаны
+        if any({left, right} & _stored_names(s) for s in body[:i]):
+            continue
+
+        users = [j for j in range(i + 1, len(body)) if merged in _loaded_names(body[j]) or merged in _stored_names(body[j])]
+        if not users:
+            continue
+        j = users[0]
+        filtering = body[j]
+        if not (isinstance(filtering, ast.Assign) and len(filtering.targets) == 1 and isinstance(filtering.targets[0], ast.Name)
+                and isinstance(filtering.value, ast.Subscript) and isinstance(filtering.value.value, ast.Name)
+                and filtering.value.value.id == merged):
+            continue
+        target = filtering.targets[0].id
+        # Иначе дальше в коде нужен полный merged, а мы бы отдали отфильтрованный
+        if target != merged and any(merged in _loaded_names(s) for s in body[j + 1:]):
+            continue
+
+        left_columns, right_columns = set(schema[left]), set(schema[right])
+        pushed = {left: [], right: []}
+        remaining = []
+        for conjunct in _conjuncts(filtering.value.slice):
+            references = sum(1 for node in ast.walk(conjunct) if isinstance(node, ast.Name) and node.id == merged)
+            columns = [_column_of(node, merged, left_columns | right_columns) for node in ast.walk(conjunct)]
+            columns = {column for column in columns if column is not None}
+            column_references = sum(1 for node in ast.walk(conjunct) if _column_of(node, merged, left_columns | right_columns))
+            # Каждое обращение к merged должно быть обращением к известной колонке и условие должно быть чистым
+            if not columns or references != column_references or not _is_pure(conjunct):
+                remaining.append(conjunct)
+            elif all(c in left_columns and (c not in right_columns or c in keys) for c in columns):
+                pushed[left].append(_RenameFrame(merged, left).visit(conjunct))
+            elif all(c in right_columns and c not in left_columns for c in columns):
+                pushed[right].append(_RenameFrame(merged, right).visit(conjunct))
+            else:
+                remaining.append(conjunct)
+        if not pushed[left] and not pushed[right]:
+            continue
+
+        def filtered(frame: str) -> ast.AST:
+            reference = ast.Name(id=frame, ctx=ast.Load())
+            if not pushed[frame]:
+                return reference
+            return ast.Subscript(value=reference, slice=_and_all(pushed[frame]), ctx=ast.Load())
+
+        if _is_pd_call(merge_call, "merge"):
+            merge_call.args[:2] = [filtered(left), filtered(right)]
+        else:
+            merge_call.func.value = filtered(left)
+            merge_call.args[0] = filtered(right)
+
+        if remaining:
+            filtering.value.slice = _and_all(remaining)
+        elif target == merged:
+            del body[j]
+        else:
+            filtering.value = ast.Name(id=merged, ctx=ast.Load())
+        return True
+    return False
+
+
+def _is_mask(node: ast.AST) -> bool:
+    if isinstance(node, ast.Compare):
+        return True
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        return _is_mask(node.left) and _is_mask(node.right)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+        return _is_mask(node.operand)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        return node.func.attr in PURE_MASK_METHODS
+    return False
+
+
+def _is_pure(node: ast.AST) -> bool:
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            if not (isinstance(child.func, ast.Attribute) and child.func.attr in PURE_MASK_METHODS):
+                return False
+        elif isinstance(child, (ast.Lambda, ast.NamedExpr, ast.Await, ast.Yield, ast.comprehension)):
+            return False
+    return True
+
+
+def _mask_slots(statement: ast.stmt) -> List[Tuple[ast.AST, str, int | None]]:
+    """(родитель, поле, позиция в кортеже) для масок в df[mask] и df.loc[mask, ...] одного оператора"""
+    slots = []
+    for node in ast.walk(statement):
+        if isinstance(node, ast.Lambda):
+            return []
+        if not isinstance(node, ast.Subscript):
+            continue
+        if isinstance(node.slice, ast.Tuple) and isinstance(node.value, ast.Attribute) and node.value.attr == "loc":
+            if node.slice.elts and _is_mask(node.slice.elts[0]):
+                slots.append((node.slice, "elts", 0))
+        elif _is_mask(node.slice):
+            slots.append((node, "slice", None))
+    return slots
+
+
+def _slot_value(slot: Tuple[ast.AST, str, int | None]) -> ast.AST:
+    parent, name, position = slot
+    value = getattr(parent, name)
+    return value if position is None else value[position]
+
+
+def _set_slot(slot: Tuple[ast.AST, str, int | None], value: ast.AST):
+    parent, name, position = slot
+    if position is None:
+        setattr(parent, name, value)
+    else:
+        getattr(parent, name)[position] = value
+
+
+def _hoist_repeated_masks(tree: ast.Module, schema: Schema) -> bool:
+    """Одинаковая маска в нескольких местах -> вычисляем ее один раз в mask_N"""
+    if _has_inplace(tree):
+        return False
+    body = tree.body
+    occurrences: Dict[str, List[Tuple[int, Tuple[ast.AST, str, int | None]]]] = {}
+    for index, statement in enumerate(body):
+        if not isinstance(statement, (ast.Assign, ast.AugAssign, ast.Expr)):
+            continue
+        for slot in _mask_slots(statement):
+            mask = _slot_value(slot)
+            if _is_pure(mask) and _loaded_names(mask):
+                occurrences.setdefault(ast.dump(mask), []).append((index, slot))
+
+    used_names = set().union(*(_loaded_names(s) | _stored_names(s) for s in body)) if body else set()
+    for key, places in occurrences.items():
+        if len(places) < 2:
+            continue
+        first, last = places[0][0], places[-1][0]
+        mask = _slot_value(places[0][1])
+        # Между первым и последним использованием фреймы маски не должны меняться
+        if any(_loaded_names(mask) & _stored_names(s) for s in body[first:last]):
+            continue
+        # Вложенные маски: внешнюю уже могли переписать через внутреннюю
+        if any(ast.dump(_slot_value(slot)) != key for _, slot in places):
+            continue
+        number = 1
+        while f"mask_{number}" in used_names:
+            number += 1
+        name = f"mask_{number}"
+        body.insert(first, ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=mask))
+        for _, slot in places:
+            _set_slot(slot, ast.Name(id=name, ctx=ast.Load()))
+        return True
+    return False
+
+
+# Порядок важен: снятие to_datetime упрощает выражения для векторизации,
+# а общие маски выносим последними, когда остальные правила уже отработали
+RULES: List[Tuple[str, Callable[[ast.Module, Schema], bool]]] = [
+    ("redundant_to_datetime", _redundant_to_datetime),
+    ("vectorize_apply", _vectorize_apply),
+    ("vectorize_iterrows", _vectorize_iterrows),
+    ("filter_before_merge", _filter_before_merge),
+    ("hoist_repeated_masks", _hoist_repeated_masks),
+]
+RULE_NAMES = [name for name, _ in RULES]
+# Одно правило может сработать несколько раз (несколько циклов, несколько масок)
+MAX_PASSES_PER_RULE = 5
+
+
+def apply_rule(code: str, rule: str, schema: Schema) -> str | None:
+    """Код после правила rule (все его срабатывания) или None, если переписывать нечего"""
+    rewrite = dict(RULES)[rule]
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    changed = False
+    for _ in range(MAX_PASSES_PER_RULE):
+        if not rewrite(tree, schema):
+            break
+        changed = True
+    if not changed:
+        return None
+    optimized = ast.unparse(ast.fix_missing_locations(tree))
+    return optimized if optimized != ast.unparse(ast.parse(code)) else None
+
+
+def optimize_code(code: str, schema: Schema, rules: List[str] | None = None) -> Tuple[str, List[str]]:
+    """Применяет правила по очереди без проверки результата; возвращает код и сработавшие правила"""
+    applied = []
+    for rule in rules or RULE_NAMES:
+        optimized = apply_rule(code, rule, schema)
+        if optimized is not None:
+            code = optimized
+            applied.append(rule)
+    return code, applied
+
+
+@dataclass
+class OptimizedCode:
+    code: str
+    applied: List[str] = field(default_factory=list)
+    rejected: List[str] = field(default_factory=list)
+
+
+@dataclass
+class RuleStats:
+    applied: int = 0
+    mismatched: int = 0
+    failed: int = 0
+    original_seconds: float = 0.0
+    optimized_seconds: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "applied": self.applied,
+            "mismatched": self.mismatched,
+            "failed": self.failed,
+            "sample_speedup": round(self.original_seconds / self.optimized_seconds, 2) if self.applied and self.optimized_seconds else None,
+        }
+
+
+class CodeOptimizer:
+    """Переписывает медленные паттерны в сгенерированном коде и проверяет каждое правило на выборке.
+
+    Правило принимается, только если результат на выборке данных совпал с исходным кодом;
+    решения кэшируются по тексту кода.
+    """
+
+    def __init__(self, execute_sample: Callable[[str], tuple], schema: Callable[[], Schema],
+                 cache_size: int = 1000, cache_ttl_seconds: float = 3600.0):
+        self.execute_sample = execute_sample
+        self.schema = schema
+        self._cache: TTLCache[OptimizedCode] = TTLCache(max_entries=cache_size, ttl_seconds=cache_ttl_seconds)
+        self._stats: Dict[str, RuleStats] = {rule: RuleStats() for rule in RULE_NAMES}
+        self._counters = {"optimized": 0, "unchanged": 0, "skipped": 0, "cache_hits": 0, "fallbacks": 0}
+        self._lock = threading.Lock()
+
+    def _timed(self, code: str) -> Tuple[Any, str | None, float]:
+        started = time.perf_counter()
+        result, error = self.execute_sample(code)
+        return result, error, time.perf_counter() - started
+
+    def optimize(self, code: str) -> OptimizedCode:
+        schema = self.schema()
+        cache_key = (code, repr(sorted((frame, sorted(columns.items())) for frame, columns in schema.items())))
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            with self._lock:
+                self._counters["cache_hits"] += 1
+            return cached
+
+        outcome = self._optimize(code, schema)
+        self._cache.set(cache_key, outcome)
+        return outcome
+
+    def _optimize(self, code: str, schema: Schema) -> OptimizedCode:
+        outcome = OptimizedCode(code=code)
+        rewrites = []
+        current = code
+        for rule in RULE_NAMES:
+            rewritten = apply_rule(current, rule, schema)
+            if rewritten is not None:
+                rewrites.append(rule)
+                current = rewritten
+        if not rewrites:
+            with self._lock:
+                self._counters["unchanged"] += 1
+            return outcome
+
+        baseline, error, baseline_seconds = self._timed(code)
+        if error is not None:
+            # Исходный код падает - его чинит code_repairer, оптимизировать нечего
+            with self._lock:
+                self._counters["skipped"] += 1
+            return outcome
+        expected = result_fingerprint(baseline)
+
+        # Правила проверяем по одному, чтобы одно неверное не отменяло остальные
+        for rule in rewrites:
+            candidate = apply_rule(outcome.code, rule, schema)
+            if candidate is None:
+                continue
+            result, error, seconds = self._timed(candidate)
+            matches = error is None and result_fingerprint(result) == expected
+            with self._lock:
+                stats = self._stats[rule]
+                if error is not None:
+                    stats.failed += 1
+                elif not matches:
+                    stats.mismatched += 1
+                else:
+                    stats.applied += 1
+                    stats.original_seconds += baseline_seconds
+                    stats.optimized_seconds += seconds
+            if matches:
+                outcome.code = candidate
+                outcome.applied.append(rule)
+            else:
+                logger.info(f"Optimizer rule '{rule}' rejected on sample: {error or 'result mismatch'}")
+                outcome.rejected.append(rule)
+
+        with self._lock:
+            self._counters["optimized" if outcome.applied else "unchanged"] += 1
+        if outcome.applied:
+            logger.info(f"Optimized generated code with rules: {', '.join(outcome.applied)}")
+        return outcome
+
+    def record_fallback(self, rules: List[str]):
+        """Оптимизированный код упал на полных данных, хотя прошел выборку"""
+        with self._lock:
+            self._counters["fallbacks"] += 1
+        logger.warning(f"Optimized code failed on full data, falling back to original (rules: {', '.join(rules)})")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self._counters, "rules": {rule: stats.to_dict() for rule, stats in self._stats.items()}}
@@ -0,0 +1,280 @@
+import ast
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+DATE_LITERAL_RE = re.compile(r"^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}(:\d{2})?)?$")
+
+# Классы ошибок, которые умеем чинить локально, без повторного вызова LLM
+ERROR_PATTERNS = [
+    ("datetime_comparison", re.compile(
+        r"not supported between instances of '(Timestamp|datetime\.date|datetime|date)' and 'str'"
+        r"|not supported between instances of 'str' and '(Timestamp|datetime\.date|datetime|date)'"
+        r"|Invalid comparison between dtype=datetime64")),
+    ("dt_accessor", re.compile(r"object has no attribute 'dt'|Can only use \.dt accessor")),
+    ("missing_result", re.compile(r"name 'result' is not defined")),
+    ("series_truth", re.compile(r"truth value of a Series is ambiguous|truth value of a DataFrame is ambiguous")),
+]
+
+
+def classify_error(error: str | None) -> str:
+    if not error:
+        return "none"
+    for error_class, pattern in ERROR_PATTERNS:
+        if pattern.search(error):
+            return error_class
+    return "other"
+
+
+def _is_date_literal(node: ast.AST) -> bool:
+    return isinstance(node, ast.Constant) and isinstance(node.value, str) and bool(DATE_LITERAL_RE.match(node.value))
+
+
+def _timestamp_call(node: ast.Constant) -> ast.Call:
+    return ast.Call(
+        func=ast.Attribute(value=ast.Name(id="pd", ctx=ast.Load()), attr="Timestamp", ctx=ast.Load()),
+        args=[ast.Constant(value=node.value)],
+        keywords=[]
+    )
+
+
+def _is_dt_date(node: ast.AST) -> bool:
+    return (isinstance(node, ast.Attribute) and node.attr == "date"
+            and isinstance(node.value, ast.Attribute) and node.value.attr == "dt")
+
+
+class _DatetimeComparisonFixer(ast.NodeTransformer):
+    """Строковые даты в сравнениях -> pd.Timestamp, .dt.date -> .dt.normalize()"""
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        self.generic_visit(node)
+        operands = [node.left] + node.comparators
+        if not any(_is_date_literal(op) for op in operands):
+            return node
+        fixed = []
+        for op in operands:
+            if _is_date_literal(op):
+                fixed.append(_timestamp_call(op))
+            elif _is_dt_date(op):
+                fixed.append(ast.Call(
+                    func=ast.Attribute(value=op.value, attr="normalize", ctx=ast.Load()),
+                    args=[], keywords=[]
+                ))
+            else:
+                fixed.append(op)
+        node.left, node.comparators = fixed[0], fixed[1:]
+        return node
+
+
+class _StripDtAccessor(ast.NodeTransformer):
+    """x.dt.month -> x.month для значений, которые уже являются Timestamp"""
+
+    def __init__(self, only_in_lambdas: bool):
+        self.only_in_lambdas = only_in_lambdas
+        self._lambda_depth = 0
+
+    def visit_Lambda(self, node: ast.Lambda) -> ast.AST:
+        self._lambda_depth += 1
+        self.generic_visit(node)
+        self._lambda_depth -= 1
+        return node
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        self.generic_visit(node)
+        if self.only_in_lambdas and not self._lambda_depth:
+            return node
+        if isinstance(node.value, ast.Attribute) and node.value.attr == "dt":
+            node.value = node.value.value
+        return node
+
+
+class _ParseBeforeDtAccessor(ast.NodeTransformer):
+    """x.dt -> pd.to_datetime(x).dt для колонок, которые еще не распарсены"""
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        self.generic_visit(node)
+        if node.attr == "dt" and not _is_to_datetime_call(node.value):
+            node.value = ast.Call(
+                func=ast.Attribute(value=ast.Name(id="pd", ctx=ast.Load()), attr="to_datetime", ctx=ast.Load()),
+                args=[node.value], keywords=[]
+            )
+        return node
+
+
+def _is_to_datetime_call(node: ast.AST) -> bool:
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and node.func.attr == "to_datetime")
+
+
+# Методы, которые над колонкой возвращают булеву Series
+_SERIES_PREDICATES = {"isin", "between", "isna", "notna", "isnull", "notnull",
+                      "contains", "startswith", "endswith", "duplicated"}
+
+
+def _is_elementwise(node: ast.AST) -> bool:
+    """Операнд, который в сгенерированном коде дает Series, а не питоновский bool"""
+    if isinstance(node, (ast.Compare, ast.Subscript)):
+        return True
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        return node.func.attr in _SERIES_PREDICATES
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        return _is_elementwise(node.left) or _is_elementwise(node.right)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+        return _is_elementwise(node.operand)
+    return False
+
+
+class _ElementwiseBoolOps(ast.NodeTransformer):
+    """and/or/not над Series -> &, |, ~
+
+    Питоновские bool не трогаем: ~False == -1 истинно, и `if not df.empty:`
+    молча поменял бы смысл вместо ошибки.
+    """
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        if not any(_is_elementwise(value) for value in node.values):
+            return node
+        op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+        combined = node.values[0]
+        for value in node.values[1:]:
+            combined = ast.BinOp(left=combined, op=op, right=value)
+        return combined
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not) and _is_elementwise(node.operand):
+            return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+        return node
+
+
+def _assigns_result(tree: ast.Module) -> bool:
+    for node in ast.walk(tree):
+        targets = []
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            targets = [node.target]
+        for target in targets:
+            if isinstance(target, ast.Name) and target.id == "result":
+                return True
+    return False
+
+
+def _ensure_result(tree: ast.Module) -> ast.Module:
+    if not tree.body or _assigns_result(tree):
+        return tree
+    last = tree.body[-1]
+    if isinstance(last, ast.Expr):
+        tree.body[-1] = ast.Assign(targets=[ast.Name(id="result", ctx=ast.Store())], value=last.value)
+    elif isinstance(last, ast.Assign) and len(last.targets) == 1 and isinstance(last.targets[0], ast.Name):
+        tree.body.append(ast.Assign(
+            targets=[ast.Name(id="result", ctx=ast.Store())],
+            value=ast.Name(id=last.targets[0].id, ctx=ast.Load())
+        ))
+    return tree
+
+
+def _rewrite(code: str, *transformers: Callable[[ast.Module], ast.Module]) -> str | None:
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    for transform in transformers:
+        tree = transform(tree)
+    fixed = ast.unparse(ast.fix_missing_locations(tree))
+    return fixed if fixed != ast.unparse(ast.parse(code)) else None
+
+
+def _visitor(transformer_factory: Callable[[], ast.NodeTransformer]) -> Callable[[ast.Module], ast.Module]:
+    return lambda tree: transformer_factory().visit(tree)
+
+
+# Кандидаты исправлений для каждого класса ошибок, в порядке от самого узкого
+LOCAL_FIXES: Dict[str, List[List[Callable[[ast.Module], ast.Module]]]] = {
+    "datetime_comparison": [[_visitor(_DatetimeComparisonFixer), _ensure_result]],
+    "dt_accessor": [
+        [_visitor(lambda: _StripDtAccessor(only_in_lambdas=True)), _ensure_result],
+        [_visitor(_ParseBeforeDtAccessor), _ensure_result],
+        [_visitor(lambda: _StripDtAccessor(only_in_lambdas=False)), _ensure_result],
+    ],
+    "missing_result": [[_ensure_result]],
+    "series_truth": [[_visitor(_ElementwiseBoolOps), _ensure_result]],
+}
+
+
+def local_fix_candidates(code: str, error: str | None) -> List[str]:
+    candidates = []
+    for transformers in LOCAL_FIXES.get(classify_error(error), []):
+        fixed = _rewrite(code, *transformers)
+        if fixed and fixed not in candidates:
+            candidates.append(fixed)
+    return candidates
+
+
+@dataclass
+class LocalRepair:
+    code: str
+    result: Any
+    error_class: str
+
+
+@dataclass
+class RepairStats:
+    failures: int = 0
+    local_fixed: int = 0
+    llm_attempts: int = 0
+    llm_fixed: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        attempts = self.local_fixed + self.llm_attempts
+        return {
+            "failures": self.failures,
+            "local_fixed": self.local_fixed,
+            "llm_attempts": self.llm_attempts,
+            "llm_fixed": self.llm_fixed,
+            "llm_calls_saved": self.local_fixed,
+            "local_success_rate": round(self.local_fixed / self.failures, 3) if self.failures else None,
+            "llm_success_rate": round(self.llm_fixed / self.llm_attempts, 3) if self.llm_attempts else None,
+            "repair_success_rate": round((self.local_fixed + self.llm_fixed) / attempts, 3) if attempts else None,
+        }
+
+
+class CodeRepairer:
+    """Чинит типовые ошибки сгенерированного кода локально; остальное уходит в LLM"""
+
+    def __init__(self, execute: Callable[[str], tuple]):
+        self.execute = execute
+        self._stats: Dict[str, RepairStats] = {}
+        self._lock = threading.Lock()
+
+    def repair_locally(self, code: str, error: str | None) -> LocalRepair | None:
+        error_class = classify_error(error)
+        with self._lock:
+            self._stats.setdefault(error_class, RepairStats()).failures += 1
+
+        for candidate in local_fix_candidates(code, error):
+            result, candidate_error = self.execute(candidate)
+            if candidate_error is None:
+                logger.info(f"Local repair succeeded for error class '{error_class}'")
+                with self._lock:
+                    self._stats[error_class].local_fixed += 1
+                return LocalRepair(code=candidate, result=result, error_class=error_class)
+            logger.info(f"Local repair candidate failed for '{error_class}': {candidate_error}")
+
+        return None
+
+    def record_llm_repair(self, error_class: str, success: bool):
+        with self._lock:
+            stats = self._stats.setdefault(error_class, RepairStats())
+            stats.llm_attempts += 1
+            if success:
+                stats.llm_fixed += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {error_class: stats.to_dict() for error_class, stats in self._stats.items()}
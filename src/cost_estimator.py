@@ -0,0 +1,307 @@
+import ast
+import math
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Единица стоимости - одна строка векторной операции pandas (по замерам ~20 нс).
+# Python на каждую строку или группу дороже на порядки, поэтому его вес больше
+VECTOR_ROW_COST = 1.0
+GROUPBY_ROW_COST = 3.0
+MERGE_ROW_COST = 4.0
+PYTHON_ROW_COST = 100.0
+ITERROWS_ROW_COST = 2000.0
+PYTHON_GROUP_COST = 10000.0
+# Постоянные накладные расходы одного вызова pandas (~50 мкс): на малых данных они главные
+CALL_OVERHEAD_COST = 5000.0
+
+# Грубые предположения о размере результата, когда его нельзя вывести из кода
+FILTER_SELECTIVITY = 0.5
+GROUP_RATIO = 0.1
+UNIQUE_RATIO = 0.5
+DEFAULT_LOOP_ITERATIONS = 10
+WHILE_LOOP_ITERATIONS = 100
+TOP_REASONS = 3
+
+MERGE_METHODS = {"merge", "join"}
+GROUPING_METHODS = {"groupby", "resample", "rolling", "expanding"}
+PYTHON_CALLBACK_METHODS = {"apply", "map", "applymap", "transform", "agg", "aggregate", "filter", "pipe"}
+ROW_ITERATORS = {"iterrows": ITERROWS_ROW_COST, "itertuples": PYTHON_ROW_COST, "items": PYTHON_ROW_COST}
+REDUCTIONS = {"sum", "mean", "median", "count", "nunique", "min", "max", "std", "var", "size", "agg", "aggregate",
+              "idxmax", "idxmin", "first", "last", "prod", "any", "all", "quantile"}
+SHRINKING_METHODS = {"unique", "drop_duplicates", "value_counts"}
+MASK_METHODS = {"isin", "between", "isna", "notna", "isnull", "notnull", "contains", "startswith", "endswith"}
+LIMIT_METHODS = {"head", "tail", "nlargest", "nsmallest"}
+SORT_METHODS = {"sort_values", "sort_index", "rank"}
+
+
+@dataclass
+class CostEstimate:
+    """Статическая оценка стоимости кода: cost в условных строках векторных операций"""
+    cost: float
+    reasons: List[str] = field(default_factory=list)
+    tables: Dict[str, int] = field(default_factory=dict)
+
+
+def _receiver(node: ast.AST) -> ast.AST | None:
+    """Объект, у которого вызывается метод: df для df.groupby(...)"""
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        return node.func.value
+    return None
+
+
+def _method(node: ast.AST) -> str | None:
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    return None
+
+
+def _keyword(node: ast.Call, name: str) -> ast.AST | None:
+    return next((keyword.value for keyword in node.keywords if keyword.arg == name), None)
+
+
+def _is_callback(node: ast.AST | None) -> bool:
+    """lambda или функция, а не имя агрегата вроде 'sum'"""
+    return node is not None and not isinstance(node, (ast.Constant, ast.List, ast.Dict, ast.Tuple))
+
+
+def _is_mask(node: ast.AST) -> bool:
+    if isinstance(node, ast.Compare):
+        return True
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        return True
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+        return True
+    return _method(node) in MASK_METHODS
+
+
+class _CostVisitor(ast.NodeVisitor):
+    """Суммирует стоимость операций кода, зная размеры таблиц и переменных.
+
+    Тело цикла учитывается с множителем, равным числу итераций, поэтому цикл по
+    пользователям с фильтром заказов внутри стоит users x orders.
+    """
+
+    def __init__(self, table_rows: Dict[str, int]):
+        self.sizes: Dict[str, float] = {name: float(rows) for name, rows in table_rows.items()}
+        self.multiplier = 1.0
+        self.items: List[Tuple[float, str]] = []
+
+    def _add(self, cost: float, what: str):
+        if cost > 0:
+            self.items.append((cost * self.multiplier, what if self.multiplier == 1 else f"{what} в цикле x{self.multiplier:.3g}"))
+
+    def rows(self, node: ast.AST | None) -> float | None:
+        """Оценка числа строк фрейма или Series, который дает выражение; None - скаляр или неизвестно"""
+        if node is None:
+            return None
+        if isinstance(node, ast.Name):
+            return self.sizes.get(node.id)
+        if isinstance(node, ast.Attribute):
+            return self.rows(node.value)
+        if isinstance(node, ast.Subscript):
+            rows = self.rows(node.value)
+            if rows is None:
+                return None
+            if _is_mask(node.slice):
+                return rows * FILTER_SELECTIVITY
+            return rows
+        if isinstance(node, ast.BinOp):
+            sizes = [rows for rows in (self.rows(node.left), self.rows(node.right)) if rows is not None]
+            return max(sizes) if sizes else None
+        if isinstance(node, ast.Compare):
+            return self.rows(node.left)
+        if isinstance(node, ast.Call):
+            return self._call_rows(node)
+        return None
+
+    def _merge_sides(self, node: ast.Call) -> Tuple[float | None, float | None]:
+        receiver = _receiver(node)
+        if isinstance(receiver, ast.Name) and receiver.id == "pd":
+            left, right = (node.args + [None, None])[:2]
+        else:
+            left, right = receiver, (node.args[0] if node.args else _keyword(node, "right"))
+        return self.rows(left), self.rows(right)
+
+    def _is_cross(self, node: ast.Call) -> bool:
+        how = _keyword(node, "how")
+        return isinstance(how, ast.Constant) and how.value == "cross"
+
+    def _is_grouped(self, node: ast.AST | None) -> bool:
+        while node is not None:
+            if _method(node) in GROUPING_METHODS:
+                return True
+            if isinstance(node, ast.Call):
+                node = _receiver(node)
+            elif isinstance(node, (ast.Attribute, ast.Subscript)):
+                node = node.value
+            else:
+                return False
+        return False
+
+    def _call_rows(self, node: ast.Call) -> float | None:
+        method = _method(node)
+        receiver = _receiver(node)
+        if method in MERGE_METHODS:
+            left, right = self._merge_sides(node)
+            if left is None or right is None:
+                return left or right
+            return left * right if self._is_cross(node) else max(left, right)
+        if method == "concat" and node.args and isinstance(node.args[0], (ast.List, ast.Tuple)):
+            sizes = [self.rows(item) for item in node.args[0].elts]
+            return sum(size for size in sizes if size is not None) or None
+        rows = self.rows(receiver)
+        if rows is None:
+            return None
+        if method in REDUCTIONS:
+            return rows * GROUP_RATIO if self._is_grouped(receiver) else None
+        if method in SHRINKING_METHODS:
+            return rows * UNIQUE_RATIO
+        if method in LIMIT_METHODS:
+            limit = node.args[0] if node.args else _keyword(node, "n")
+            return min(rows, float(limit.value) if isinstance(limit, ast.Constant) and isinstance(limit.value, int) else 5.0)
+        if method == "query":
+            return rows * FILTER_SELECTIVITY
+        return rows
+
+    def visit_Call(self, node: ast.Call):
+        method = _method(node)
+        receiver = _receiver(node)
+        if method in MERGE_METHODS:
+            left, right = self._merge_sides(node)
+            if left is not None and right is not None:
+                if self._is_cross(node):
+                    self._add(left * right * MERGE_ROW_COST + CALL_OVERHEAD_COST, f"cross join {left:.0f} x {right:.0f}")
+                else:
+                    self._add((left + right) * MERGE_ROW_COST + CALL_OVERHEAD_COST, f"{method} {left:.0f} + {right:.0f} строк")
+        elif method is not None:
+            rows = self.rows(receiver)
+            if rows is not None:
+                self._method_cost(node, method, receiver, rows)
+        self.generic_visit(node)
+
+    def _method_cost(self, node: ast.Call, method: str, receiver: ast.AST, rows: float):
+        callback = node.args[0] if node.args else _keyword(node, "func")
+        if method in PYTHON_CALLBACK_METHODS and _is_callback(callback):
+            if self._is_grouped(receiver):
+                groups = max(1.0, rows * GROUP_RATIO)
+                self._add(groups * PYTHON_GROUP_COST + CALL_OVERHEAD_COST, f"groupby.{method} с Python функцией, ~{groups:.0f} групп")
+            else:
+                self._add(rows * PYTHON_ROW_COST + CALL_OVERHEAD_COST, f"{method} с Python функцией по {rows:.0f} строкам")
+        elif method in GROUPING_METHODS:
+            self._add(rows * GROUPBY_ROW_COST + CALL_OVERHEAD_COST, f"{method} по {rows:.0f} строкам")
+        elif method in SORT_METHODS:
+            self._add(rows * math.log2(max(rows, 2)) * VECTOR_ROW_COST + CALL_OVERHEAD_COST, f"{method} {rows:.0f} строк")
+        elif method not in ROW_ITERATORS:
+            self._add(rows * VECTOR_ROW_COST + CALL_OVERHEAD_COST, f"{method} по {rows:.0f} строкам")
+
+    def visit_Subscript(self, node: ast.Subscript):
+        rows = self.rows(node.value)
+        if rows is not None and _is_mask(node.slice):
+            self._add(rows * VECTOR_ROW_COST + CALL_OVERHEAD_COST, f"фильтр {rows:.0f} строк")
+        self.generic_visit(node)
+
+    def visit_Compare(self, node: ast.Compare):
+        rows = self.rows(node.left)
+        if rows is not None:
+            self._add(rows * VECTOR_ROW_COST, f"сравнение по {rows:.0f} строкам")
+        self.generic_visit(node)
+
+    def visit_Assign(self, node: ast.Assign):
+        self.visit(node.value)
+        rows = self.rows(node.value)
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                if rows is None:
+                    self.sizes.pop(target.id, None)
+                else:
+                    self.sizes[target.id] = rows
+            else:
+                self.visit(target)
+
+    def _iterations(self, node: ast.AST) -> float:
+        """Число итераций цикла по итерируемому выражению"""
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            return float(len(node.elts))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "range":
+            bound = node.args[-1] if len(node.args) == 1 else None
+            if isinstance(bound, ast.Constant) and isinstance(bound.value, int):
+                return float(bound.value)
+            return self.rows(bound) or DEFAULT_LOOP_ITERATIONS
+        if _method(node) in ROW_ITERATORS:
+            return self.rows(_receiver(node)) or DEFAULT_LOOP_ITERATIONS
+        if _method(node) in GROUPING_METHODS:
+            rows = self.rows(_receiver(node))
+            return rows * GROUP_RATIO if rows else DEFAULT_LOOP_ITERATIONS
+        return self.rows(node) or DEFAULT_LOOP_ITERATIONS
+
+    def _loop(self, iterable: ast.AST, body: List[ast.AST]):
+        self.visit(iterable)
+        iterations = max(1.0, self._iterations(iterable))
+        method = _method(iterable)
+        if method in ROW_ITERATORS:
+            self._add(iterations * ROW_ITERATORS[method], f"{method} по {iterations:.0f} строкам")
+        elif method in GROUPING_METHODS:
+            self._add(iterations * PYTHON_GROUP_COST, f"цикл по ~{iterations:.0f} группам")
+        else:
+            self._add(iterations * PYTHON_ROW_COST, f"цикл на {iterations:.0f} итераций")
+        outer = self.multiplier
+        self.multiplier = outer * iterations
+        try:
+            for statement in body:
+                self.visit(statement)
+        finally:
+            self.multiplier = outer
+
+    def visit_For(self, node: ast.For):
+        self._loop(node.iter, node.body + node.orelse)
+
+    def visit_While(self, node: ast.While):
+        outer = self.multiplier
+        self.multiplier = outer * WHILE_LOOP_ITERATIONS
+        try:
+            self.generic_visit(node)
+        finally:
+            self.multiplier = outer
+
+    def _comprehension(self, node: ast.AST, elements: List[ast.AST]):
+        generators = node.generators
+        if not generators:
+            return
+        # Вложенные генераторы перемножаются: [... for a in x for b in y]
+        first, rest = generators[0], generators[1:]
+        nested = ast.ListComp(elt=ast.Tuple(elts=elements, ctx=ast.Load()), generators=rest) if rest else None
+        self._loop(first.iter, [*first.ifs, nested] if nested else [*first.ifs, *elements])
+
+    def visit_ListComp(self, node):
+        self._comprehension(node, [node.elt])
+
+    visit_SetComp = visit_ListComp
+    visit_GeneratorExp = visit_ListComp
+
+    def visit_DictComp(self, node: ast.DictComp):
+        self._comprehension(node, [node.key, node.value])
+
+
+def estimate_cost(code: str, table_rows: Dict[str, int]) -> CostEstimate:
+    """Оценивает стоимость сгенерированного кода по его AST и размерам таблиц.
+
+    Учитываются merge/join (cross join - произведение размеров), groupby, apply и
+    map с Python функциями, iterrows и циклы; тело цикла умножается на число итераций.
+    Код с синтаксической ошибкой получает нулевую оценку - ошибку покажет выполнение.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return CostEstimate(cost=0.0, reasons=["синтаксическая ошибка"], tables=dict(table_rows))
+    visitor = _CostVisitor(table_rows)
+    visitor.visit(tree)
+    cost = sum(item_cost for item_cost, _ in visitor.items)
+    top = sorted(visitor.items, key=lambda item: item[0], reverse=True)[:TOP_REASONS]
+    return CostEstimate(
+        cost=cost,
+        reasons=[f"{what}: {item_cost:.2g}" for item_cost, what in top],
+        tables={name: int(rows) for name, rows in table_rows.items()},
+    )
@@ -1,30 +1,267 @@
+import fcntl
+import io
+import os
+import threading
+import time
+import numpy as np
 import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, List, Tuple
 import logging
+import traceback
+from .shared_snapshot import SharedSnapshotStore
+from .query_profiler import QueryProfiler
+from .admission_control import AdmissionController
+from .ingest import MAX_REPORTED_ERRORS, TABLE_KEYS, AppendableTable, IngestError, coerce_rows
 
 logger = logging.getLogger(__name__)
 
+GENERATED_CODE_FILENAME = "<generated>"
+
+DATA_FILES = {'users_df': 'data/users.csv', 'orders_df': 'data/orders.csv'}
+# Журнал принятых через ingest строк: дописывается к исходным CSV при загрузке
+INGEST_FILES = {'users_df': 'data/ingested_users.csv', 'orders_df': 'data/ingested_orders.csv'}
+DATE_COLUMNS = {'users_df': ['registration_date', 'last_login_date'], 'orders_df': ['order_date']}
+# Размер выборки, на которой оптимизатор сверяет переписанный код с исходным
+SAMPLE_ROWS = 500
+
 class DataProcessor:
-    def __init__(self):
+    def __init__(self, snapshot_store: SharedSnapshotStore | None = None, profiler: QueryProfiler | None = None,
+                 admission: AdmissionController | None = None):
         self.users_df = None
         self.orders_df = None
+        self.snapshot_store = snapshot_store
+        self.profiler = profiler
+        self.admission = admission
+        self.snapshot = None
+        self._frames: Dict[str, pd.DataFrame] = {}
+        # Производные от данных значения (схема, справочники); сбрасываются при смене снапшота
+        self._derived: Dict[str, Any] = {}
+        self._ingest_lock = threading.Lock()
+        self._appendable: Dict[str, AppendableTable] | None = None
+        # Множества первичных ключей для проверки повторов: (фрейм, для которого построено, ключи)
+        self._known_keys: Dict[str, Tuple[pd.DataFrame, set]] = {}
+        # Сколько байт журнала ingest уже в фреймах: без общего снапшота строки других воркеров дочитываются отсюда
+        self._journal_offsets: Dict[str, int] = {}
         self._load_data()
     
     def _load_data(self):
         try:
-            self.users_df = pd.read_csv('data/users.csv')
-            self.orders_df = pd.read_csv('data/orders.csv')
-            
-            self.users_df['registration_date'] = pd.to_datetime(self.users_df['registration_date'])
-            self.users_df['last_login_date'] = pd.to_datetime(self.users_df['last_login_date'])
-            self.orders_df['order_date'] = pd.to_datetime(self.orders_df['order_date'])
+            if self.snapshot_store is not None:
+                # Общий для всех воркеров снапшот: CSV парсит только тот, кто публикует версию
+                self.snapshot = self.snapshot_store.load(self._source_key(), self._read_frames)
+                self._use_frames(self.snapshot.frames)
+            else:
+                self._use_frames(self._read_frames())
             
         except Exception:
             logger.exception("Failed to load data")
             raise
     
+    def _read_frames(self) -> Dict[str, pd.DataFrame]:
+        users_df = pd.read_csv(DATA_FILES['users_df'])
+        orders_df = pd.read_csv(DATA_FILES['orders_df'])
+        
+        users_df['registration_date'] = pd.to_datetime(users_df['registration_date'])
+        users_df['last_login_date'] = pd.to_datetime(users_df['last_login_date'])
+        orders_df['order_date'] = pd.to_datetime(orders_df['order_date'])
+        
+        frames = {'users_df': users_df, 'orders_df': orders_df}
+        for name in INGEST_FILES:
+            ingested, self._journal_offsets[name] = self._read_journal(name, frames[name])
+            if ingested is not None:
+                frames[name] = pd.concat([frames[name], ingested], ignore_index=True)
+        return frames
+    
+    def _read_journal(self, name: str, reference: pd.DataFrame, start: int = 0) -> Tuple[pd.DataFrame | None, int]:
+        """Строки журнала с байта start в типах reference и смещение конца прочитанного"""
+        path = INGEST_FILES[name]
+        if not os.path.exists(path):
+            return None, 0
+        with open(path, "rb") as f:
+            header = f.readline()
+            f.seek(max(start, len(header)))
+            data = f.read()
+        # Недописанную другим процессом строку оставляем до следующего раза
+        data = data[:data.rfind(b"\n") + 1]
+        end = max(start, len(header)) + len(data)
+        if not data:
+            return None, end
+        ingested = pd.read_csv(io.BytesIO(header + data))
+        for column in DATE_COLUMNS[name]:
+            ingested[column] = pd.to_datetime(ingested[column], format="ISO8601").astype(reference[column].dtype)
+        return ingested.astype(reference.dtypes.to_dict()), end
+    
+    def _journal_changed(self) -> bool:
+        return any((os.path.getsize(path) if os.path.exists(path) else 0) != self._journal_offsets.get(name, 0)
+                   for name, path in INGEST_FILES.items())
+    
+    def _catch_up_journal(self) -> bool:
+        """Без общего снапшота: дочитывает строки, которые другие воркеры дописали в журнал"""
+        new_rows = {}
+        for name, path in INGEST_FILES.items():
+            offset = self._journal_offsets.get(name, 0)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size < offset:
+                # Журнал удален или урезан - строим данные заново
+                logger.warning(f"Ingest journal {path} shrank from {offset} to {size} bytes, reloading data")
+                self._appendable = None
+                self._use_frames(self._read_frames())
+                return True
+            if size > offset:
+                rows, self._journal_offsets[name] = self._read_journal(name, self._frames[name], offset)
+                if rows is not None and len(rows):
+                    new_rows[name] = rows
+        if not new_rows:
+            return False
+        logger.info(f"Picked up rows ingested by other workers: {({name: len(df) for name, df in new_rows.items()})}")
+        self._append_local(new_rows)
+        return True
+    
+    @contextmanager
+    def _journal_lock(self):
+        """Межпроцессная блокировка журнала ingest для режима без общего снапшота"""
+        path = os.path.join(os.path.dirname(INGEST_FILES['users_df']), "ingest.lock")
+        with open(path, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _use_frames(self, frames: Dict[str, pd.DataFrame]):
+        # Одна ссылка на согласованную пару фреймов: выполнение берет ее целиком
+        self._frames = frames
+        self.users_df = frames['users_df']
+        self.orders_df = frames['orders_df']
+        self._derived = {}
+    
+    def _source_key(self) -> str:
+        paths = list(DATA_FILES.values()) + [path for path in INGEST_FILES.values() if os.path.exists(path)]
+        stats = [(path, os.stat(path)) for path in paths]
+        return ";".join(f"{path}:{stat.st_mtime_ns}:{stat.st_size}" for path, stat in stats)
+    
+    def refresh_snapshot(self) -> bool:
+        """Подхватывает новую версию общего снапшота: опубликованную другим воркером
+        или построенную заново, если исходные CSV изменились"""
+        if self.snapshot is None:
+            # Без общего снапшота общий только журнал ingest: --workers N отвечают по одним данным
+            if not self._journal_changed():
+                return False
+            with self._ingest_lock:
+                return self._catch_up_journal()
+        source_key = self._source_key()
+        if source_key != self.snapshot.source_key:
+            # Первый заметивший воркер перечитывает CSV и публикует версию, остальные к ней подключаются
+            previous = self.snapshot
+            self.snapshot = self.snapshot_store.load(source_key, self._read_frames)
+            if self.snapshot.version != previous.version:
+                previous.close()
+                self._use_frames(self.snapshot.frames)
+                return True
+            return False
+        if self.snapshot.refresh():
+            self._use_frames(self.snapshot.frames)
+            return True
+        return False
+    
+    def ingest(self, batches: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Проверяет и дописывает новые строки таблиц; пакет принимается целиком или отклоняется.
+
+        Строки с уже известным первичным ключом пропускаются, поэтому повтор пакета безопасен.
+        Запросы видят либо данные до пакета, либо после него, но не промежуточное состояние.
+        """
+        unknown = sorted(set(batches) - set(TABLE_KEYS))
+        if unknown:
+            raise IngestError(f"Неизвестные таблицы: {', '.join(unknown)}")
+        started = time.perf_counter()
+        # Журнал и снапшот пишут все воркеры - сериализуем их файловой блокировкой и до проверки
+        # повторов подхватываем чужие строки, иначе ретрай пакета на другом воркере задвоится
+        lock = self.snapshot_store.locked() if self.snapshot is not None else self._journal_lock()
+        with self._ingest_lock, lock:
+            if self.snapshot is not None:
+                self.refresh_snapshot()
+            else:
+                self._catch_up_journal()
+            frames = self._frames
+            new_rows, summary = {}, {}
+            # Пользователей добавляем первыми: заказы пакета могут ссылаться на них
+            for table in ('users_df', 'orders_df'):
+                if not batches.get(table):
+                    continue
+                typed = coerce_rows(table, batches[table], frames[table])
+                keys = self._keys(table, frames[table])
+                known = np.array([value in keys for value in typed[TABLE_KEYS[table]].tolist()], dtype=bool)
+                new_rows[table] = typed[~known]
+                summary[table] = {"accepted": int((~known).sum()), "duplicates": int(known.sum())}
+            
+            if 'orders_df' in new_rows:
+                user_ids = self._keys('users_df', frames['users_df'])
+                batch_user_ids = set(new_rows['users_df']['user_id']) if 'users_df' in new_rows else set()
+                orphans = [(int(i), user_id) for i, user_id in new_rows['orders_df']['user_id'].items()
+                           if user_id not in user_ids and user_id not in batch_user_ids]
+                if orphans:
+                    raise IngestError("orders_df: заказы ссылаются на неизвестных пользователей", [
+                        {"table": "orders_df", "row": i, "column": "user_id", "error": f"нет пользователя {user_id}"}
+                        for i, user_id in orphans[:MAX_REPORTED_ERRORS]
+                    ])
+            
+            new_rows = {table: df for table, df in new_rows.items() if len(df)}
+            if new_rows:
+                self._append_journal(new_rows)
+                if self.snapshot is not None:
+                    self.snapshot_store.append(new_rows, self._source_key())
+                    self.refresh_snapshot()
+                    self._remember_keys(frames, new_rows)
+                else:
+                    self._append_local(new_rows)
+        
+        rows = sum(len(df) for df in new_rows.values())
+        logger.info(f"Ingested {rows} rows in {time.perf_counter() - started:.3f}s: {summary}")
+        return {
+            "tables": summary,
+            "rows": rows,
+            "total_rows": {name: len(df) for name, df in self._frames.items()},
+            "snapshot_version": self.snapshot.version if self.snapshot is not None else None,
+        }
+    
+    def _append_local(self, new_rows: Dict[str, pd.DataFrame]):
+        frames = self._frames
+        if self._appendable is None:
+            # Один раз переносим фреймы в таблицы с запасом емкости
+            self._appendable = {name: AppendableTable(df) for name, df in frames.items()}
+        for table, df in new_rows.items():
+            self._appendable[table].append(df)
+        self._use_frames({**frames, **{table: self._appendable[table].frame() for table in new_rows}})
+        self._remember_keys(frames, new_rows)
+    
+    def _remember_keys(self, previous: Dict[str, pd.DataFrame], new_rows: Dict[str, pd.DataFrame]):
+        for table in TABLE_KEYS:
+            # Ключи новых строк добавляем к уже построенному множеству, а не пересчитываем его;
+            # у таблиц без новых строк множество просто переезжает на новый фрейм
+            keys = self._keys(table, previous[table])
+            if table in new_rows:
+                keys.update(new_rows[table][TABLE_KEYS[table]])
+            self._known_keys[table] = (self._frames[table], keys)
+    
+    def _keys(self, table: str, frame: pd.DataFrame) -> set:
+        cached = self._known_keys.get(table)
+        if cached is None or cached[0] is not frame:
+            cached = self._known_keys[table] = (frame, set(frame[TABLE_KEYS[table]]))
+        return cached[1]
+    
+    def _append_journal(self, new_rows: Dict[str, pd.DataFrame]):
+        for table, df in new_rows.items():
+            path = INGEST_FILES[table]
+            write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+            df.to_csv(path, mode="a", header=write_header, index=False, date_format="%Y-%m-%dT%H:%M:%S")
+            self._journal_offsets[table] = os.path.getsize(path)
+    
     def get_data_schema(self) -> str:
+        return self._cached('data_schema', self._build_data_schema)
+    
+    def _build_data_schema(self) -> str:
         return f"""
 users_df columns: {list(self.users_df.columns)}
 users_df dtypes: {dict(self.users_df.dtypes)}
@@ -34,8 +271,68 @@ orders_df columns: {list(self.orders_df.columns)}
 orders_df dtypes: {dict(self.orders_df.dtypes)}
 orders_df sample: {self.orders_df.head(2).to_dict('records')}
         """
+
+    def _cached(self, key: str, compute):
+        if key not in self._derived:
+            self._derived[key] = compute()
+        return self._derived[key]
+    
+    def get_compact_schema(self) -> str:
+        return self._cached('compact_schema', self._build_compact_schema)
+    
+    def _build_compact_schema(self) -> str:
+        users_columns = ", ".join(f"{name} ({dtype})" for name, dtype in self.users_df.dtypes.items())
+        orders_columns = ", ".join(f"{name} ({dtype})" for name, dtype in self.orders_df.dtypes.items())
+        return f"users_df: {users_columns}\norders_df: {orders_columns}"
     
-    def execute_pandas_query(self, code: str) -> Tuple[Any, str | None]:
+    def get_regions(self) -> list[str]:
+        return self._cached('regions', lambda: sorted(self.users_df['region'].dropna().unique().tolist()))
+    
+    def get_statuses(self) -> list[str]:
+        return self._cached('statuses', lambda: sorted(self.orders_df['status'].dropna().unique().tolist()))
+    
+    def get_columns(self) -> Dict[str, Dict[str, str]]:
+        return self._cached('columns', lambda: {
+            name: {column: str(dtype) for column, dtype in df.dtypes.items()}
+            for name, df in (('users_df', self.users_df), ('orders_df', self.orders_df))
+        })
+    
+    def get_sample_frames(self) -> Dict[str, pd.DataFrame]:
+        return self._cached('sample_frames', self._build_sample_frames)
+    
+    def _build_sample_frames(self) -> Dict[str, pd.DataFrame]:
+        orders = self.orders_df
+        if len(orders) > SAMPLE_ROWS:
+            orders = orders.sample(SAMPLE_ROWS, random_state=0).sort_index()
+        # Берем пользователей из выборки заказов, чтобы merge по user_id не был пустым
+        users = self.users_df
+        if len(users) > SAMPLE_ROWS:
+            sampled = users.index.isin(users.sample(SAMPLE_ROWS // 2, random_state=0).index)
+            users = users[users['user_id'].isin(orders['user_id']) | sampled]
+        return {'users_df': users.copy(), 'orders_df': orders.copy()}
+    
+    def execute_on_sample(self, code: str) -> Tuple[Any, str | None]:
+        return self.execute_pandas_query(code, frames=self.get_sample_frames())
+    
+    def execute_pandas_query(self, code: str, frames: Dict[str, pd.DataFrame] | None = None) -> Tuple[Any, str | None]:
+        # Профилируем и допускаем по стоимости только выполнения на полных данных,
+        # прогоны на выборке оптимизатора дешевые и не в счет
+        def execute():
+            return self._execute(code, frames)
+        
+        def profile():
+            return self.profiler.profile(code, rows_touched, execute)
+        
+        run = execute
+        if frames is None and self.profiler is not None:
+            rows_touched = sum(len(df) for name, df in self._frames.items() if name in code)
+            run = profile
+        if frames is None and self.admission is not None:
+            table_rows = {name: len(df) for name, df in self._frames.items()}
+            return self.admission.execute(code, table_rows, run)
+        return run()
+    
+    def _execute(self, code: str, frames: Dict[str, pd.DataFrame] | None) -> Tuple[Any, str | None]:
         try:
             dangerous_patterns = ['import', '__', 'exec', 'eval', 'open', 'file', 'os', 'sys', 'subprocess']
             code_lower = code.lower()
@@ -43,9 +340,11 @@ orders_df sample: {self.orders_df.head(2).to_dict('records')}
                 if pattern in code_lower:
                     return None, f"Dangerous operation detected: {pattern}"
             
+            # Сгенерированный код может менять фреймы на месте, а колонки снапшота - read-only mmap
+            frames = frames or self._frames
             local_vars = {
-                'users_df': self.users_df.copy(),
-                'orders_df': self.orders_df.copy(),
+                'users_df': frames['users_df'].copy(),
+                'orders_df': frames['orders_df'].copy(),
                 'pd': pd,
                 'datetime': datetime,
                 'len': len,
@@ -56,7 +355,7 @@ orders_df sample: {self.orders_df.head(2).to_dict('records')}
                 'set': set
             }
             
-            exec(code, {"__builtins__": {}}, local_vars)
+            exec(compile(code, GENERATED_CODE_FILENAME, 'exec'), {"__builtins__": {}}, local_vars)
             
             if 'result' in local_vars:
                 return local_vars['result'], None
@@ -70,4 +369,15 @@ orders_df sample: {self.orders_df.head(2).to_dict('records')}
                 return "Code executed successfully but no result found", None
                 
         except Exception as e:
-            return None, str(e)
\ No newline at end of file
+            return None, self._format_error(code, e)
+
+    def _format_error(self, code: str, error: Exception) -> str:
+        message = f"{type(error).__name__}: {error}"
+        # Добавляем строку сгенерированного кода, на которой упало выполнение
+        frames = [frame for frame in traceback.extract_tb(error.__traceback__) if frame.filename == GENERATED_CODE_FILENAME]
+        if frames:
+            lineno = frames[-1].lineno
+            lines = code.splitlines()
+            if lineno and 0 < lineno <= len(lines):
+                message += f" (строка {lineno}: {lines[lineno - 1].strip()})"
+        return message
\ No newline at end of file
@@ -1,9 +1,12 @@
 import os
 import json
 from langsmith import Client
-from langchain.smith import run_on_dataset
+from langchain.smith import RunEvalConfig, run_on_dataset
 from langchain_openai import ChatOpenAI
+from langsmith.evaluation import EvaluationResult, run_evaluator
 from .analytics_agent import AnalyticsAgent
+from .answer_evaluator import AnswerEvaluator as AnswerJudge
+from .reference_answers import ReferenceChecker
 import time
 import logging
 
@@ -14,6 +17,21 @@ class AnswerEvaluator:
         self.client = Client(api_key=langsmith_api_key)
         self.openai_api_key = openai_api_key
         self.llm = ChatOpenAI(model="gpt-4o-mini", api_key=openai_api_key)
+        self._analyst = None
+        self._judge = None
+    
+    @property
+    def analyst(self) -> AnalyticsAgent:
+        # Один агент на всю оценку: данные и эталонные расчеты не пересчитываются на каждый пример
+        if self._analyst is None:
+            self._analyst = AnalyticsAgent(self.openai_api_key)
+        return self._analyst
+    
+    @property
+    def judge(self) -> AnswerJudge:
+        if self._judge is None:
+            self._judge = AnswerJudge(self.openai_api_key, reference_checker=ReferenceChecker(self.analyst.data_processor))
+        return self._judge
         
     def extract_user_request(self, input_data):
         if isinstance(input_data, dict):
@@ -42,7 +60,7 @@ class AnswerEvaluator:
     
     def process_input(self, input_data):
         try:
-            analyst = AnalyticsAgent(self.openai_api_key)
+            analyst = self.analyst
             user_request = self.extract_user_request(input_data)
             
             from .analytics_agent import AnalyticsState
@@ -83,16 +101,32 @@ class AnswerEvaluator:
                 "success": False
             }
     
+    def correctness(self, run, example) -> EvaluationResult:
+        """Корректность: эталонный расчет для канонических вопросов, LLM судья для остальных"""
+        user_request = self.extract_user_request(example.inputs)
+        outputs = run.outputs or {}
+        result = self.judge._evaluate_correctness(user_request, outputs.get("answer", ""),
+                                                  str(outputs.get("execution_result", "")),
+                                                  outputs.get("answer_reasoning", ""))
+        score = result.score / 5 if result.score is not None else None
+        return EvaluationResult(key="correctness", score=score, comment=result.reasoning)
+    
+    def evaluation_config(self) -> RunEvalConfig:
+        # Критерий accuracy (LLM судья на каждый пример) заменен на correctness с эталонными расчетами.
+        # helpfulness - критерий, а не EvaluatorType; process_input отдает несколько ключей, судье нужен answer
+        return RunEvalConfig(
+            evaluators=[RunEvalConfig.Criteria(criteria="helpfulness")],
+            custom_evaluators=[run_evaluator(self.correctness)],
+            input_key="input",
+            prediction_key="answer",
+            eval_llm=self.llm
+        )
+    
     def run_evaluation(self, dataset_name: str, project_name: str = "analytics-bot-eval"):
-        evaluation_config = {
-            "criteria": ["helpfulness", "accuracy"],
-            "llm": self.llm
-        }
-        
         run_on_dataset(
             client=self.client,
             dataset_name=dataset_name,
             llm_or_chain_factory=self.process_input,
-            evaluation_config=evaluation_config,
+            evaluation=self.evaluation_config(),
             project_name=project_name
-        )
\ No newline at end of file
+        )
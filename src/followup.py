@@ -0,0 +1,202 @@
+import ast
+import calendar
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+from .ttl_cache import TTLCache
+import logging
+
+logger = logging.getLogger(__name__)
+
+MONTH_STEMS = [
+    ("январ", 1), ("феврал", 2), ("март", 3), ("апрел", 4), ("июн", 6),
+    ("июл", 7), ("август", 8), ("сентябр", 9), ("октябр", 10), ("ноябр", 11), ("декабр", 12),
+]
+# У мая слишком короткая основа, поэтому распознаем его только в этих формах
+MAY_FORMS = {"май", "мая", "мае", "маю"}
+MONTH_NAMES = ["январь", "февраль", "март", "апрель", "май", "июнь",
+               "июль", "август", "сентябрь", "октябрь", "ноябрь", "декабрь"]
+SLOT_LABELS = (("month", "месяц"), ("year", "год"), ("region", "регион"), ("status", "статус"))
+
+STATUS_STEMS = {
+    "completed": ("завершен", "выполнен", "оплачен", "успешн", "completed"),
+    "canceled": ("отмен", "canceled", "cancelled"),
+    "pending": ("ожида", "pending", "обработк"),
+}
+
+REGION_ALIASES = {
+    "Санкт-Петербург": ("спб", "питер", "петербург"),
+}
+
+FILLER_WORDS = {
+    "а", "и", "за", "для", "в", "во", "по", "только", "теперь", "тогда", "что", "насчет", "как", "там",
+    "тоже", "также", "еще", "же", "год", "года", "году", "месяц", "регион", "регионе", "городе", "статус",
+    "статусом", "со", "с", "заказов", "заказы", "пользователей", "посчитай", "покажи",
+}
+FOLLOWUP_MARKERS = ("а", "и", "теперь", "тогда", "что", "только")
+MAX_FOLLOWUP_TOKENS = 8
+
+DATE_LITERAL_RE = re.compile(r"^(\d{4})-(\d{2})(?:-(\d{2}))?$")
+TOKEN_RE = re.compile(r"[a-zа-я0-9]+")
+
+
+@dataclass
+class ConversationTurn:
+    # Исходный вопрос и все подставленные с тех пор слоты, а не цепочка уточнений
+    query: str
+    pandas_code: str
+    params: Dict[str, Any] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.time)
+
+
+class ConversationStore:
+    """Последний запрос с кодом для каждого отправителя, с ограничением размера и TTL"""
+
+    def __init__(self, max_senders: int = 10000, ttl_seconds: float = 1800.0, clock: Callable[[], float] = time.monotonic):
+        self._turns: TTLCache[ConversationTurn] = TTLCache(max_entries=max_senders, ttl_seconds=ttl_seconds, clock=clock)
+
+    def get(self, sender: str) -> ConversationTurn | None:
+        return self._turns.get(sender)
+
+    def remember(self, sender: str, query: str, pandas_code: str, params: Dict[str, Any] | None = None):
+        self._turns.set(sender, ConversationTurn(query=query, pandas_code=pandas_code, params=dict(params or {})))
+
+    def forget(self, sender: str):
+        self._turns.pop(sender)
+
+
+def _tokens(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+def region_stems(region: str) -> Tuple[str, ...]:
+    first_word = region.lower().replace("ё", "е").split("-")[0]
+    return (first_word[:max(4, min(len(first_word) - 1, 5))],) + REGION_ALIASES.get(region, ())
+
+
+def _match_month(token: str) -> int | None:
+    if token in MAY_FORMS:
+        return 5
+    for stem, month in MONTH_STEMS:
+        if token.startswith(stem):
+            return month
+    return None
+
+
+def parse_followup(text: str, regions: Iterable[str], statuses: Iterable[str]) -> Dict[str, Any] | None:
+    """Слоты уточнения ("а за май?", "а только для Москвы?") или None, если это не уточнение"""
+    tokens = _tokens(text)
+    if not tokens or len(tokens) > MAX_FOLLOWUP_TOKENS or tokens[0] not in FOLLOWUP_MARKERS:
+        return None
+
+    slots: Dict[str, Any] = {}
+    for token in tokens:
+        month = _match_month(token)
+        if month:
+            if slots.setdefault("month", month) != month:
+                return None
+            continue
+        if token.isdigit() and len(token) == 4:
+            slots["year"] = int(token)
+            continue
+        region = next((r for r in regions if token.startswith(region_stems(r))), None)
+        if region:
+            if slots.setdefault("region", region) != region:
+                return None
+            continue
+        status = next((s for s in statuses if token.startswith(STATUS_STEMS.get(s, (s,)))), None)
+        if status:
+            if slots.setdefault("status", status) != status:
+                return None
+            continue
+        if token in FILLER_WORDS:
+            continue
+        # Незнакомое слово - значит вопрос меняется сильнее, чем подстановкой параметров
+        return None
+
+    return slots or None
+
+
+def _date_constants(tree: ast.AST) -> List[ast.Constant]:
+    return [node for node in ast.walk(tree)
+            if isinstance(node, ast.Constant) and isinstance(node.value, str) and DATE_LITERAL_RE.match(node.value)]
+
+
+def _month_comparisons(tree: ast.AST) -> List[ast.Constant]:
+    """Целые константы в сравнениях вида x.dt.month == 6"""
+    constants = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Compare):
+            continue
+        operands = [node.left] + node.comparators
+        if any(isinstance(op, ast.Attribute) and op.attr == "month" for op in operands):
+            constants += [op for op in operands if isinstance(op, ast.Constant) and isinstance(op.value, int)]
+    return constants
+
+
+def _string_constants(tree: ast.AST, values: Iterable[str]) -> List[ast.Constant]:
+    values = set(values)
+    return [node for node in ast.walk(tree) if isinstance(node, ast.Constant) and node.value in values]
+
+
+def followup_query(query: str, params: Dict[str, Any]) -> str:
+    """Исходный вопрос с текущими параметрами - текст запроса для графа, форматтера и оценки"""
+    if not params:
+        return query
+    parts = []
+    for slot, label in SLOT_LABELS:
+        if slot in params:
+            value = MONTH_NAMES[params[slot] - 1] if slot == "month" else params[slot]
+            parts.append(f"{label} - {value}")
+    return f"{query}\nУточнение: {', '.join(parts)}"
+
+
+def _shift_date(value: str, year: int, month: int) -> str:
+    old_year, old_month, old_day = DATE_LITERAL_RE.match(value).groups()
+    if old_day is None:
+        return f"{year:04d}-{month:02d}"
+    old_last_day = calendar.monthrange(int(old_year), int(old_month))[1]
+    new_last_day = calendar.monthrange(year, month)[1]
+    day = new_last_day if int(old_day) == old_last_day else min(int(old_day), new_last_day)
+    return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def rewrite_code(code: str, slots: Dict[str, Any], regions: Iterable[str], statuses: Iterable[str]) -> str | None:
+    """Подставляет слоты в прошлый код через AST; None, если подстановка неоднозначна"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+
+    if "month" in slots or "year" in slots:
+        dates = _date_constants(tree)
+        month_numbers = _month_comparisons(tree)
+        periods = {tuple(int(part) for part in DATE_LITERAL_RE.match(node.value).groups()[:2]) for node in dates}
+        # Все даты в коде должны относиться к одному месяцу, иначе непонятно, что менять
+        if len(periods) > 1 or len({node.value for node in month_numbers}) > 1 or not (dates or month_numbers):
+            return None
+        old_year, old_month = next(iter(periods)) if periods else (None, month_numbers[0].value)
+        if any(node.value != old_month for node in month_numbers):
+            return None
+        if "year" in slots and not dates:
+            return None
+        new_year = slots.get("year", old_year)
+        new_month = slots.get("month", old_month)
+        for node in dates:
+            node.value = _shift_date(node.value, new_year, new_month)
+        for node in month_numbers:
+            node.value = new_month
+
+    for slot, values in (("region", regions), ("status", statuses)):
+        if slot not in slots:
+            continue
+        constants = _string_constants(tree, values)
+        # Подменяем только если в коде ровно одно значение этого параметра
+        if len({node.value for node in constants}) != 1:
+            return None
+        for node in constants:
+            node.value = slots[slot]
+
+    return ast.unparse(tree)
@@ -0,0 +1,145 @@
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+from .shared_snapshot import GROWTH_FACTOR, MIN_CAPACITY
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Первичные ключи таблиц: строки с уже известным ключом считаются повтором и пропускаются
+TABLE_KEYS = {'users_df': 'user_id', 'orders_df': 'order_id'}
+# Имена таблиц в API ingest
+TABLE_ALIASES = {'users': 'users_df', 'orders': 'orders_df'}
+NULLABLE_COLUMNS = {'users_df': {'last_login_date'}, 'orders_df': set()}
+ORDER_STATUSES = ('completed', 'canceled', 'pending')
+MAX_BATCH_ROWS = 10000
+MAX_REPORTED_ERRORS = 50
+
+
+class IngestError(ValueError):
+    """Пакет отклонен целиком; errors - проблемы по строкам"""
+
+    def __init__(self, message: str, errors: List[Dict[str, Any]] | None = None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+def _is_string_column(dtype) -> bool:
+    return (isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_object_dtype(dtype)
+            or pd.api.types.is_string_dtype(dtype))
+
+
+def coerce_rows(table: str, rows: List[Dict[str, Any]], reference: pd.DataFrame) -> pd.DataFrame:
+    """Проверяет строки пакета и приводит их к колонкам и типам reference"""
+    if not isinstance(rows, list):
+        raise IngestError(f"{table}: ожидался список строк")
+    if len(rows) > MAX_BATCH_ROWS:
+        raise IngestError(f"{table}: не больше {MAX_BATCH_ROWS} строк за пакет, получено {len(rows)}")
+
+    columns = list(reference.columns)
+    nullable = NULLABLE_COLUMNS.get(table, set())
+    errors: List[Dict[str, Any]] = []
+
+    def fail(row: int, column: str | None, message: str):
+        errors.append({"table": table, "row": row, "column": column, "error": message})
+
+    for i, row in enumerate(rows):
+        if not isinstance(row, dict):
+            fail(i, None, "ожидался объект")
+            continue
+        for column in sorted(set(row) - set(columns)):
+            fail(i, column, "неизвестная колонка")
+        for column in columns:
+            if row.get(column) is None and column not in nullable:
+                fail(i, column, "обязательное поле")
+    if errors:
+        raise IngestError(f"{table}: пакет не прошел проверку", errors[:MAX_REPORTED_ERRORS])
+
+    raw = pd.DataFrame({column: pd.Series([row.get(column) for row in rows], dtype=object) for column in columns})
+    typed = {}
+    for column in columns:
+        values, dtype = raw[column], reference[column].dtype
+        present = values.notna()
+        if pd.api.types.is_datetime64_dtype(dtype):
+            converted = pd.to_datetime(values, errors="coerce", format="ISO8601").astype(dtype)
+            bad, expected = present & converted.isna(), "дата в формате ISO 8601"
+        elif pd.api.types.is_bool_dtype(dtype):
+            converted = values.map(lambda value: value if isinstance(value, bool) else None)
+            bad, expected = present & converted.isna(), "true или false"
+        elif pd.api.types.is_numeric_dtype(dtype):
+            numeric = values.map(lambda value: value if isinstance(value, (int, float)) and not isinstance(value, bool) else None)
+            converted = pd.to_numeric(numeric, errors="coerce")
+            bad, expected = present & converted.isna(), "число"
+            if pd.api.types.is_integer_dtype(dtype):
+                bad |= converted.notna() & (converted % 1 != 0)
+                expected = "целое число"
+        else:
+            converted = values.map(lambda value: value.strip() if isinstance(value, str) else None)
+            bad, expected = present & (converted.isna() | (converted == "")), "непустая строка"
+        for i in np.flatnonzero(bad.to_numpy()):
+            fail(int(i), column, f"ожидается {expected}, получено {values.iloc[i]!r}")
+        typed[column] = converted
+
+    if errors:
+        raise IngestError(f"{table}: пакет не прошел проверку", errors[:MAX_REPORTED_ERRORS])
+    frame = pd.DataFrame(typed)
+    for column in columns:
+        dtype = reference[column].dtype
+        if not _is_string_column(dtype) and not pd.api.types.is_datetime64_dtype(dtype):
+            frame[column] = frame[column].astype(dtype)
+
+    key = TABLE_KEYS.get(table)
+    if key is not None:
+        for i in np.flatnonzero(frame[key].duplicated().to_numpy()):
+            fail(int(i), key, "ключ повторяется в пакете")
+    if table == 'orders_df':
+        for i in np.flatnonzero((frame['order_amount'] < 0).to_numpy()):
+            fail(int(i), 'order_amount', "сумма не может быть отрицательной")
+        for i in np.flatnonzero((~frame['status'].isin(ORDER_STATUSES)).to_numpy()):
+            fail(int(i), 'status', f"статус должен быть одним из {', '.join(ORDER_STATUSES)}")
+    if errors:
+        raise IngestError(f"{table}: пакет не прошел проверку", errors[:MAX_REPORTED_ERRORS])
+    return frame
+
+
+class AppendableTable:
+    """Таблица в памяти процесса, к которой строки дописываются без пересборки.
+
+    Колонки - numpy массивы с запасом емкости (при нехватке емкость удваивается);
+    frame() отдает DataFrame поверх read-only срезов [:rows], поэтому уже выданные
+    фреймы не видят последующих дописываний. Типы колонок те же, что у исходного
+    фрейма: строки остаются object, иначе groupby и схема для LLM зависели бы от того,
+    был ли ingest.
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        self.rows = len(frame)
+        capacity = max(MIN_CAPACITY, self.rows * GROWTH_FACTOR)
+        self._arrays: Dict[str, np.ndarray] = {}
+        for name, series in frame.items():
+            values = series.to_numpy(dtype=object) if _is_string_column(series.dtype) else series.to_numpy()
+            array = np.empty(capacity, dtype=values.dtype)
+            array[:self.rows] = values
+            self._arrays[name] = array
+
+    def append(self, frame: pd.DataFrame):
+        needed = self.rows + len(frame)
+        for name, array in self._arrays.items():
+            values = frame[name].to_numpy().astype(array.dtype)
+            if needed > len(array):
+                grown = np.empty(max(needed, len(array) * GROWTH_FACTOR), dtype=array.dtype)
+                grown[:self.rows] = array[:self.rows]
+                array = grown
+            # Пишем за концом выданных срезов: читатели прежних фреймов этих ячеек не видят
+            array[self.rows:needed] = values
+            self._arrays[name] = array
+        self.rows = needed
+
+    def frame(self) -> pd.DataFrame:
+        data = {}
+        for name, array in self._arrays.items():
+            view = array[:self.rows]
+            view.flags.writeable = False
+            data[name] = view
+        return pd.DataFrame(data, copy=False)
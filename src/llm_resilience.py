@@ -0,0 +1,245 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, TypeVar
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Общий пул для всех LLM вызовов: основной запрос и его хедж идут в отдельных потоках
+_EXECUTOR_WORKERS = 32
+_executor = ThreadPoolExecutor(max_workers=_EXECUTOR_WORKERS, thread_name_prefix="llm-call")
+# Брошенный по таймауту вызов нельзя прервать: поток занят, пока не сработает таймаут клиента.
+# Пока таких вызовов много, хеджи не отправляем, чтобы зависший upstream не выел весь пул
+_MAX_ABANDONED = _EXECUTOR_WORKERS // 2
+_abandoned = 0
+_abandoned_lock = threading.Lock()
+
+
+class LLMCallTimeout(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def deadline_after(seconds: float | None) -> float | None:
+    return time.monotonic() + seconds if seconds else None
+
+
+def remaining_time(deadline: float | None) -> float | None:
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def abandoned_calls() -> int:
+    with _abandoned_lock:
+        return _abandoned
+
+
+def _abandon(futures) -> int:
+    """Отменяет еще не начатые вызовы, начатые учитывает до их завершения"""
+    global _abandoned
+    count = 0
+    for future in futures:
+        if future.cancel():
+            continue
+        count += 1
+        with _abandoned_lock:
+            _abandoned += 1
+        future.add_done_callback(_release_abandoned)
+    return count
+
+
+def _release_abandoned(_future):
+    global _abandoned
+    with _abandoned_lock:
+        _abandoned -= 1
+
+
+class LatencyTracker:
+    """Скользящее окно задержек одного типа вызова"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """closed -> open после N ошибок подряд -> half_open после reset_timeout"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            return self._state() != "open"
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            state = self._state()
+            if state == "half_open" or (state == "closed" and self._failures >= self.failure_threshold):
+                logger.warning(f"Circuit breaker opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+
+
+class ResilientCaller:
+    """Дедлайны, хеджирование, ретраи с джиттером и circuit breaker для одного места вызова LLM"""
+
+    def __init__(self, name: str, breaker: CircuitBreaker | None = None, call_timeout: float = 30.0,
+                 hedge_quantile: float = 0.95, default_hedge_delay: float | None = 10.0,
+                 max_attempts: int = 2, backoff_base: float = 0.5, backoff_max: float = 4.0,
+                 fallback_timeout: float = 10.0):
+        self.name = name
+        self.breaker = breaker or CircuitBreaker()
+        self.call_timeout = call_timeout
+        self.hedge_quantile = hedge_quantile
+        self.default_hedge_delay = default_hedge_delay
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Бюджет к моменту fallback обычно уже исчерпан, поэтому у него свой короткий лимит
+        self.fallback_timeout = fallback_timeout
+        self.latency = LatencyTracker()
+        self._counters = {"calls": 0, "hedges": 0, "hedge_wins": 0, "retries": 0, "timeouts": 0, "failures": 0, "fallbacks": 0,
+                          "abandoned": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._counters[key] += n
+
+    def hedge_delay(self) -> float | None:
+        p = self.latency.percentile(self.hedge_quantile)
+        return p if p is not None else self.default_hedge_delay
+
+    def call(self, primary: Callable[[], T], fallback: Callable[[], T] | None = None, deadline: float | None = None) -> T:
+        self._count("calls")
+        last_error: Exception | None = None
+
+        if not self.breaker.allow():
+            last_error = CircuitOpenError(f"Circuit open for {self.name}")
+        else:
+            for attempt in range(self.max_attempts):
+                timeout = self.call_timeout
+                left = remaining_time(deadline)
+                if left is not None:
+                    timeout = min(timeout, left)
+                if timeout <= 0:
+                    last_error = last_error or LLMCallTimeout(f"Request budget exhausted before {self.name}")
+                    break
+
+                started = time.monotonic()
+                try:
+                    result = self._hedged(primary, timeout)
+                except Exception as e:
+                    last_error = e
+                    self._count("timeouts" if isinstance(e, LLMCallTimeout) else "failures")
+                    self.breaker.record_failure()
+                    logger.warning(f"LLM call '{self.name}' failed (attempt {attempt + 1}/{self.max_attempts}): {e!r}")
+                    if attempt + 1 < self.max_attempts and self.breaker.allow():
+                        self._count("retries")
+                        self._sleep_backoff(attempt, deadline)
+                        continue
+                    break
+
+                self.latency.record(time.monotonic() - started)
+                self.breaker.record_success()
+                return result
+
+        if fallback is None:
+            raise last_error
+        self._count("fallbacks")
+        logger.warning(f"Using fallback for '{self.name}': {last_error!r}")
+        future = _executor.submit(fallback)
+        done, _ = wait([future], timeout=self.fallback_timeout)
+        if not done:
+            self._count("abandoned", _abandon([future]))
+            raise LLMCallTimeout(f"Fallback for '{self.name}' exceeded {self.fallback_timeout:.2f}s") from last_error
+        return future.result()
+
+    def _sleep_backoff(self, attempt: int, deadline: float | None):
+        # Full jitter: случайная пауза от 0 до экспоненциального потолка
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        left = remaining_time(deadline)
+        if left is not None:
+            delay = min(delay, max(0.0, left))
+        time.sleep(delay)
+
+    def _hedged(self, fn: Callable[[], T], timeout: float) -> T:
+        started = time.monotonic()
+        primary = _executor.submit(fn)
+        pending = {primary}
+        hedge_delay = self.hedge_delay()
+
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, _ = wait(pending, timeout=hedge_delay)
+            if not done and abandoned_calls() >= _MAX_ABANDONED:
+                logger.warning(f"Skipping hedge for '{self.name}': {abandoned_calls()} abandoned LLM calls in flight")
+            elif not done:
+                self._count("hedges")
+                logger.info(f"LLM call '{self.name}' slower than {hedge_delay:.2f}s, sending hedged request")
+                pending.add(_executor.submit(fn))
+
+        error: Exception | None = None
+        while pending:
+            left = timeout - (time.monotonic() - started)
+            if left <= 0:
+                break
+            done, pending = wait(pending, timeout=left, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self._count("hedge_wins")
+                    self._count("abandoned", _abandon(pending))
+                    return future.result()
+                error = future.exception()
+
+        if error is not None and not pending:
+            raise error
+        self._count("abandoned", _abandon(pending))
+        raise LLMCallTimeout(f"LLM call '{self.name}' exceeded {timeout:.2f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+        p95 = self.latency.percentile(0.95)
+        return {**counters, "p95_seconds": round(p95, 3) if p95 is not None else None, "breaker": self.breaker.state}
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Размер страницы для перевода /proc/self/statm в байты
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss_bytes() -> int | None:
+    """Текущий RSS процесса (только Linux); ru_maxrss для этого не годится - он только растет"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class EventLoopLagMonitor:
+    """Задержка event loop: на сколько позже запланированного просыпается спящая корутина.
+
+    Если обработчик блокирует loop синхронным кодом, все остальные запросы воркера
+    (включая быстрые /, /stats и прием вебхуков) ждут столько же.
+    """
+
+    def __init__(self, interval: float = 0.1, window_seconds: float = 300.0):
+        self.interval = interval
+        self._samples: deque = deque(maxlen=max(1, int(window_seconds / interval)))
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+        self.max_lag = 0.0
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - scheduled)
+            with self._lock:
+                self._samples.append((time.monotonic(), lag))
+                self.max_lag = max(self.max_lag, lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self, seconds: float | None = None) -> Dict[str, Any]:
+        """Перцентили задержки за последние seconds секунд (по умолчанию - за все окно)"""
+        since = time.monotonic() - seconds if seconds else float("-inf")
+        with self._lock:
+            lags = [lag for at, lag in self._samples if at >= since]
+            max_lag = self.max_lag
+        rss = current_rss_bytes()
+        return {
+            "pid": os.getpid(),
+            "samples": len(lags),
+            "p50_ms": round(_percentile(lags, 0.5) * 1000, 2) if lags else None,
+            "p95_ms": round(_percentile(lags, 0.95) * 1000, 2) if lags else None,
+            "p99_ms": round(_percentile(lags, 0.99) * 1000, 2) if lags else None,
+            "window_max_ms": round(max(lags) * 1000, 2) if lags else None,
+            "max_ms": round(max_lag * 1000, 2),
+            "rss_mb": round(rss / 2 ** 20, 1) if rss is not None else None,
+            "threads": threading.active_count(),
+        }
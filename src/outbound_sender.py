@@ -0,0 +1,364 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Twilio принимает тело сообщения до 1600 символов
+MAX_MESSAGE_LENGTH = 1600
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Строку в 'sending' умершего процесса возвращаем в очередь сразу, живого, но зависшего - через столько
+STALE_SENDING_SECONDS = 300
+# Отправленные строки нужны только для статистики; старше этого удаляются
+SENT_RETENTION_SECONDS = 24 * 3600
+PRUNE_INTERVAL_SECONDS = 60
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TokenBucket:
+    """Лимит отправки; с outbox токены лежат в его SQLite и делятся между всеми воркерами"""
+
+    def __init__(self, rate: float, capacity: float | None = None, outbox: "Outbox | None" = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.outbox = outbox
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Забирает токен и возвращает 0 или сколько ждать до следующего"""
+        if self.outbox is not None:
+            return self.outbox.take_token(self.rate, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, stop: threading.Event | None = None):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            if stop is not None and stop.wait(wait):
+                return
+            if stop is None:
+                time.sleep(wait)
+
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Режет длинный ответ по абзацам, строкам, предложениям или пробелам"""
+    chunks = []
+    rest = text.strip()
+    while len(rest) > limit:
+        window = rest[:limit]
+        cut = -1
+        for separator in ("\n\n", "\n", ". ", " "):
+            cut = window.rfind(separator)
+            if cut > limit // 2:
+                cut += len(separator)
+                break
+        if cut <= limit // 2:
+            cut = limit
+        chunks.append(rest[:cut].strip())
+        rest = rest[cut:].strip()
+    if rest:
+        chunks.append(rest)
+    return chunks
+
+
+class Outbox:
+    """Персистентная очередь исходящих сообщений в SQLite: переживает рестарт процесса"""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                to_number TEXT NOT NULL,
+                body TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                claimed_at REAL,
+                claimed_by INTEGER,
+                sent_at REAL,
+                last_error TEXT
+            )
+        """)
+        if "claimed_by" not in {row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")}:
+            try:
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN claimed_by INTEGER")
+            except sqlite3.OperationalError:
+                # Колонку одновременно добавил другой воркер
+                pass
+        # Проверка "нет ли у получателя более раннего куска" и выборка готовых строк идут по индексам
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_recipient ON outbox (to_number, status, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_limit (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._lock = threading.Lock()
+
+    def enqueue(self, to_number: str, chunks: List[str]) -> List[int]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            ids = [
+                self._conn.execute(
+                    "INSERT INTO outbox (to_number, body, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                    (to_number, chunk, now, now)
+                ).lastrowid
+                for chunk in chunks
+            ]
+            self._conn.execute("COMMIT")
+        return ids
+
+    def _reclaim_expired(self):
+        """Возвращает в очередь 'sending' строки умерших или зависших процессов.
+
+        Пока такая строка висит, все следующие куски ее получателя ждут.
+        """
+        owners = [pid for (pid,) in self._conn.execute(
+            "SELECT DISTINCT claimed_by FROM outbox WHERE status = 'sending' AND claimed_by IS NOT NULL")]
+        dead = [pid for pid in owners if not _pid_alive(pid)]
+        reclaimed = self._conn.execute(
+            f"UPDATE outbox SET status = 'pending' WHERE status = 'sending' "
+            f"AND (claimed_at < ? OR claimed_by IN ({', '.join('?' * len(dead))}))",
+            (time.time() - STALE_SENDING_SECONDS, *dead)
+        ).rowcount
+        if reclaimed:
+            logger.warning(f"Returned {reclaimed} message(s) left in 'sending' by dead or stuck workers {dead} to the queue")
+
+    def claim_next(self) -> Dict[str, Any] | None:
+        # Следующий готовый кусок; более поздние куски того же получателя ждут более ранних
+        with self._lock:
+            self._reclaim_expired()
+            row = self._conn.execute("""
+                SELECT id, to_number, body, attempts, created_at FROM outbox o
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                  AND NOT EXISTS (
+                      SELECT 1 FROM outbox p
+                      WHERE p.to_number = o.to_number AND p.id < o.id AND p.status IN ('pending', 'sending')
+                  )
+                ORDER BY id LIMIT 1
+            """, (time.time(),)).fetchone()
+            if row is None:
+                return None
+            claimed = self._conn.execute(
+                "UPDATE outbox SET status = 'sending', claimed_at = ?, claimed_by = ? WHERE id = ? AND status = 'pending'",
+                (time.time(), os.getpid(), row[0])
+            ).rowcount
+        if not claimed:
+            return None
+        return dict(zip(("id", "to_number", "body", "attempts", "created_at"), row))
+
+    def mark_sent(self, message_id: int, attempts: int):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'sent', attempts = ?, sent_at = ? WHERE id = ?",
+                               (attempts, time.time(), message_id))
+
+    def mark_retry(self, message_id: int, attempts: int, delay: float, error: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (attempts, time.time() + delay, error, message_id)
+            )
+
+    def mark_failed(self, message_id: int, attempts: int, error: str):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                               (attempts, error, message_id))
+
+    def prune_sent(self, retention_seconds: float = SENT_RETENTION_SECONDS) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?",
+                                      (time.time() - retention_seconds,)).rowcount
+
+    def take_token(self, rate: float, capacity: float) -> float:
+        """Общий для всех процессов token bucket: 0, если токен взят, иначе сколько ждать"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tokens, updated_at FROM rate_limit WHERE id = 1").fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                wait = 0.0
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / rate
+                self._conn.execute("INSERT OR REPLACE INTO rate_limit (id, tokens, updated_at) VALUES (1, ?, ?)",
+                                   (tokens, now))
+            finally:
+                self._conn.execute("COMMIT")
+        return wait
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+    def next_due_in(self) -> float | None:
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class TwilioOutboundSender:
+    """Доставка ответов через Twilio REST API: лимит сообщений в секунду, ретраи 429/5xx,
+    разбиение длинных ответов и персистентный outbox"""
+
+    def __init__(self, account_sid: str, auth_token: str, from_number: str, base_url: str = "https://api.twilio.com",
+                 messages_per_second: float = 1.0, outbox_path: str = "data/outbox.sqlite3", max_attempts: int = 8,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, request_timeout: float = 10.0):
+        self.account_sid = account_sid
+        self.from_number = from_number
+        self.url = f"{base_url.rstrip('/')}/2010-04-01/Accounts/{account_sid}/Messages.json"
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.request_timeout = request_timeout
+
+        self.session = requests.Session()
+        self.session.auth = (account_sid, auth_token)
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+        self.outbox = Outbox(outbox_path)
+        # С --workers N у каждого воркера свой отправитель, но лимит Twilio общий
+        self.rate_limiter = TokenBucket(messages_per_second, outbox=self.outbox)
+        self._latencies = deque(maxlen=1000)
+        self._counters = {"sent": 0, "failed": 0, "retries": 0}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, name="twilio-outbox", daemon=True)
+        self._worker.start()
+
+    def send(self, to_number: str, message: str) -> List[int]:
+        chunks = split_message(message)
+        ids = self.outbox.enqueue(to_number, chunks)
+        self._wakeup.set()
+        return ids
+
+    def _run(self):
+        pruned_at = 0.0
+        while not self._stop.is_set():
+            if time.monotonic() - pruned_at > PRUNE_INTERVAL_SECONDS:
+                pruned_at = time.monotonic()
+                try:
+                    self.outbox.prune_sent()
+                except sqlite3.Error:
+                    logger.exception("Failed to prune sent messages from the outbox")
+            item = self.outbox.claim_next()
+            if item is None:
+                due_in = self.outbox.next_due_in()
+                self._wakeup.wait(timeout=min(due_in, 1.0) if due_in is not None else 1.0)
+                self._wakeup.clear()
+                continue
+            self.rate_limiter.acquire(self._stop)
+            self._deliver(item)
+
+    def _deliver(self, item: Dict[str, Any]):
+        attempts = item["attempts"] + 1
+        retry_after = None
+        try:
+            response = self.session.post(self.url, data={
+                "From": f"whatsapp:{self.from_number}",
+                "To": f"whatsapp:{item['to_number']}",
+                "Body": item["body"],
+            }, timeout=self.request_timeout)
+            status, error = response.status_code, response.text[:500]
+            retry_after = response.headers.get("Retry-After")
+        except requests.RequestException as e:
+            status, error = None, repr(e)
+
+        if status is not None and 200 <= status < 300:
+            latency = time.time() - item["created_at"]
+            self.outbox.mark_sent(item["id"], attempts)
+            with self._lock:
+                self._counters["sent"] += 1
+                self._counters["retries"] += attempts - 1
+                self._latencies.append(latency)
+            logger.info(f"Delivered message {item['id']} to {item['to_number']} in {latency:.2f}s after {attempts} attempt(s)")
+            return
+
+        retryable = status is None or status in RETRYABLE_STATUSES
+        if not retryable or attempts >= self.max_attempts:
+            self.outbox.mark_failed(item["id"], attempts, f"{status}: {error}")
+            with self._lock:
+                self._counters["failed"] += 1
+            logger.error(f"Giving up on message {item['id']} to {item['to_number']} after {attempts} attempt(s): {status} {error}")
+            return
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1)))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        self.outbox.mark_retry(item["id"], attempts, delay, f"{status}: {error}")
+        logger.warning(f"Message {item['id']} delivery failed with {status}, retrying in {delay:.2f}s")
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Ждет, пока outbox опустеет; True, если успели"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            counts = self.outbox.counts()
+            if not counts.get("pending") and not counts.get("sending"):
+                return True
+            time.sleep(0.02)
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            latencies = sorted(self._latencies)
+
+        def percentile(q: float) -> float | None:
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))], 3) if latencies else None
+
+        return {
+            **counters,
+            "outbox": self.outbox.counts(),
+            "latency_p50_seconds": percentile(0.5),
+            "latency_p95_seconds": percentile(0.95),
+        }
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._worker.join(timeout=5)
+        self.session.close()
+        self.outbox.close()
@@ -0,0 +1,315 @@
+import ast
+import glob
+import hashlib
+import json
+import logging.handlers
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from .loop_monitor import current_rss_bytes
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_LOG_PATH = "data/slow_queries.jsonl"
+MEMORY_MODES = ("rss", "tracemalloc")
+REPORT_ORDER_KEYS = ("total_wall_seconds", "max_wall_seconds", "mean_wall_seconds", "total_cpu_seconds",
+                     "max_peak_memory_bytes", "executions")
+# Как часто замерять RSS во время выполнения; пик короче интервала может не попасть в замер
+RSS_SAMPLE_SECONDS = 0.005
+
+
+def worker_log_path(path: str) -> str:
+    """Свой файл журнала на процесс: ротация одного файла из --workers N процессов гоняется"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{ext}"
+
+
+def log_files(path: str) -> List[str]:
+    """Журнал path и журналы воркеров (path с pid) вместе с ротированными частями .1, .2, ..."""
+    root, ext = os.path.splitext(path)
+    files = []
+    for base in [path] + sorted(glob.glob(f"{glob.escape(root)}.*{glob.escape(ext)}")):
+        files += sorted(glob.glob(f"{glob.escape(base)}.*"), reverse=True) + [base]
+    return files
+
+
+class _RssPeakSampler:
+    """Пик текущего RSS процесса за время выполнения, замеры в фоновом потоке.
+
+    ru_maxrss для этого не годится: это максимум за всю жизнь процесса, и после
+    первого тяжелого запроса прирост почти всегда 0.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self.before = current_rss_bytes()
+        self.peak = self.before
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self) -> "_RssPeakSampler":
+        if self.before is not None:
+            self._thread = threading.Thread(target=self._run, name="rss-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+
+    @property
+    def available(self) -> bool:
+        return self.before is not None
+
+    @property
+    def growth(self) -> int:
+        return max(0, self.peak - self.before) if self.before is not None else 0
+
+
+class _LiteralPlaceholders(ast.NodeTransformer):
+    """Константы -> плейсхолдеры: 'июнь' и 'май' одного запроса дают одну форму кода"""
+
+    def visit_Constant(self, node: ast.Constant) -> ast.AST:
+        if isinstance(node.value, bool) or node.value is None:
+            return node
+        if isinstance(node.value, (int, float)):
+            return ast.Name(id="NUM", ctx=ast.Load())
+        if isinstance(node.value, str):
+            return ast.Name(id="STR", ctx=ast.Load())
+        return node
+
+    def visit_Subscript(self, node: ast.Subscript) -> ast.AST:
+        # Имена колонок - часть формы запроса, их не заменяем
+        node.value = self.visit(node.value)
+        if not (isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)):
+            node.slice = self.visit(node.slice)
+        return node
+
+
+def normalize_code(code: str) -> str:
+    try:
+        tree = _LiteralPlaceholders().visit(ast.parse(code))
+        return ast.unparse(tree)
+    except SyntaxError:
+        return " ".join(code.split())
+
+
+def code_hash(code: str) -> str:
+    return hashlib.sha1(normalize_code(code).encode("utf-8")).hexdigest()[:12]
+
+
+@dataclass
+class ExecutionProfile:
+    code_hash: str
+    wall_seconds: float
+    cpu_seconds: float
+    peak_memory_bytes: int
+    memory_source: str
+    rows_touched: int
+    result_rows: int | None
+    error: str | None
+    code: str
+    timestamp: float = field(default_factory=time.time)
+
+
+@dataclass
+class ShapeStats:
+    normalized_code: str
+    executions: int = 0
+    errors: int = 0
+    slow: int = 0
+    total_wall_seconds: float = 0.0
+    max_wall_seconds: float = 0.0
+    total_cpu_seconds: float = 0.0
+    max_peak_memory_bytes: int = 0
+    max_rows_touched: int = 0
+
+    def add(self, profile: ExecutionProfile, slow: bool):
+        self.executions += 1
+        self.errors += profile.error is not None
+        self.slow += slow
+        self.total_wall_seconds += profile.wall_seconds
+        self.max_wall_seconds = max(self.max_wall_seconds, profile.wall_seconds)
+        self.total_cpu_seconds += profile.cpu_seconds
+        self.max_peak_memory_bytes = max(self.max_peak_memory_bytes, profile.peak_memory_bytes)
+        self.max_rows_touched = max(self.max_rows_touched, profile.rows_touched)
+
+    def to_dict(self, shape_hash: str) -> Dict[str, Any]:
+        return {
+            "code_hash": shape_hash,
+            "executions": self.executions,
+            "errors": self.errors,
+            "slow": self.slow,
+            "total_wall_seconds": round(self.total_wall_seconds, 4),
+            "mean_wall_seconds": round(self.total_wall_seconds / self.executions, 4),
+            "max_wall_seconds": round(self.max_wall_seconds, 4),
+            "total_cpu_seconds": round(self.total_cpu_seconds, 4),
+            "max_peak_memory_bytes": self.max_peak_memory_bytes,
+            "max_rows_touched": self.max_rows_touched,
+            "normalized_code": self.normalized_code,
+        }
+
+
+def top_shapes(shapes: Dict[str, ShapeStats], top_n: int, order_by: str = "total_wall_seconds") -> List[Dict[str, Any]]:
+    if order_by not in REPORT_ORDER_KEYS:
+        raise ValueError(f"order_by must be one of {REPORT_ORDER_KEYS}, got {order_by!r}")
+    rows = [stats.to_dict(shape_hash) for shape_hash, stats in shapes.items()]
+    return sorted(rows, key=lambda row: row[order_by], reverse=True)[:top_n]
+
+
+def _result_rows(result: Any) -> int | None:
+    if result is None or isinstance(result, (str, bytes)):
+        return None
+    try:
+        return len(result)
+    except TypeError:
+        return None
+
+
+class QueryProfiler:
+    """Профиль каждого выполнения сгенерированного кода и журнал медленных запросов.
+
+    Все выполнения агрегируются в памяти по нормализованной форме кода; выполнения
+    дольше порога дописываются в ротируемый JSONL, у каждого процесса свой файл
+    (log_path с pid). Режим памяти "rss" - прирост пика текущего RSS процесса (только
+    Linux, захватывает и параллельные выполнения); "tracemalloc" точнее, но
+    сериализует профилируемые выполнения: пик tracemalloc общий на процесс.
+    """
+
+    def __init__(self, slow_threshold_seconds: float = 0.5, log_path: str | None = DEFAULT_SLOW_LOG_PATH,
+                 memory_mode: str = "rss", max_log_bytes: int = 10 * 1024 * 1024, log_backups: int = 3):
+        if memory_mode not in MEMORY_MODES:
+            raise ValueError(f"memory_mode must be one of {MEMORY_MODES}, got {memory_mode!r}")
+        self.slow_threshold_seconds = slow_threshold_seconds
+        self.memory_mode = memory_mode
+        self.log_path = worker_log_path(log_path) if log_path else None
+        self._shapes: Dict[str, ShapeStats] = {}
+        self._lock = threading.Lock()
+        self._tracemalloc_lock = threading.Lock()
+        self._slow_log = None
+        if log_path:
+            # Отдельный логгер без propagate: в журнал попадают только строки JSON
+            self._slow_log = logging.getLogger(f"{__name__}.slow.{id(self)}")
+            self._slow_log.propagate = False
+            self._slow_log.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(self.log_path, maxBytes=max_log_bytes, backupCount=log_backups,
+                                                           encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._slow_log.addHandler(handler)
+
+    def close(self):
+        if self._slow_log is not None:
+            for handler in list(self._slow_log.handlers):
+                self._slow_log.removeHandler(handler)
+                handler.close()
+
+    def profile(self, code: str, rows_touched: int, run: Callable[[], Tuple[Any, str | None]]) -> Tuple[Any, str | None]:
+        if self.memory_mode == "tracemalloc":
+            with self._tracemalloc_lock:
+                return self._profile(code, rows_touched, run)
+        return self._profile(code, rows_touched, run)
+
+    def _profile(self, code: str, rows_touched: int, run: Callable[[], Tuple[Any, str | None]]) -> Tuple[Any, str | None]:
+        tracing = self.memory_mode == "tracemalloc"
+        memory_source = self.memory_mode
+        if tracing:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+            wall_started, cpu_started = time.perf_counter(), time.thread_time()
+            result, error = run()
+            wall, cpu = time.perf_counter() - wall_started, time.thread_time() - cpu_started
+            peak_memory = max(0, tracemalloc.get_traced_memory()[1] - memory_before)
+            if started_tracing:
+                tracemalloc.stop()
+        else:
+            with _RssPeakSampler() as sampler:
+                wall_started, cpu_started = time.perf_counter(), time.thread_time()
+                result, error = run()
+                wall, cpu = time.perf_counter() - wall_started, time.thread_time() - cpu_started
+            peak_memory = sampler.growth
+            if not sampler.available:
+                memory_source = "unavailable"
+
+        profile = ExecutionProfile(
+            code_hash=code_hash(code), wall_seconds=round(wall, 6), cpu_seconds=round(cpu, 6),
+            peak_memory_bytes=peak_memory, memory_source=memory_source, rows_touched=rows_touched,
+            result_rows=_result_rows(result), error=error, code=code
+        )
+        self.record(profile)
+        return result, error
+
+    def record(self, profile: ExecutionProfile):
+        slow = profile.wall_seconds >= self.slow_threshold_seconds
+        with self._lock:
+            shape = self._shapes.get(profile.code_hash)
+            if shape is None:
+                shape = self._shapes[profile.code_hash] = ShapeStats(normalized_code=normalize_code(profile.code))
+            shape.add(profile, slow)
+        if slow:
+            logger.warning(f"Slow generated code {profile.code_hash}: {profile.wall_seconds:.3f}s wall, "
+                           f"{profile.cpu_seconds:.3f}s CPU, {profile.rows_touched} rows")
+            if self._slow_log is not None:
+                self._slow_log.info(json.dumps(asdict(profile), ensure_ascii=False))
+
+    def report(self, top_n: int = 10, order_by: str = "total_wall_seconds") -> Dict[str, Any]:
+        with self._lock:
+            shapes = {key: ShapeStats(**asdict(value)) for key, value in self._shapes.items()}
+        return {
+            "slow_threshold_seconds": self.slow_threshold_seconds,
+            "shapes": len(shapes),
+            "executions": sum(shape.executions for shape in shapes.values()),
+            "top": top_shapes(shapes, top_n, order_by),
+        }
+
+
+def load_slow_log(path: str = DEFAULT_SLOW_LOG_PATH) -> Iterable[ExecutionProfile]:
+    """Записи журналов всех воркеров вместе с ротированными файлами"""
+    for file_path in log_files(path):
+        try:
+            with open(file_path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        yield ExecutionProfile(**json.loads(line))
+        except FileNotFoundError:
+            continue
+
+
+def report_from_log(path: str = DEFAULT_SLOW_LOG_PATH, top_n: int = 10, order_by: str = "total_wall_seconds") -> List[Dict[str, Any]]:
+    shapes: Dict[str, ShapeStats] = {}
+    for profile in load_slow_log(path):
+        shape = shapes.setdefault(profile.code_hash, ShapeStats(normalized_code=normalize_code(profile.code)))
+        shape.add(profile, slow=True)
+    return top_shapes(shapes, top_n, order_by)
+
+
+if __name__ == "__main__":
+    # python -m src.query_profiler [slow_queries.jsonl] [top_n]
+    log_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SLOW_LOG_PATH
+    top_n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rows = report_from_log(log_path, top_n)
+    if not rows:
+        print(f"В {log_path} нет медленных запросов")
+    for i, row in enumerate(rows, 1):
+        print(f"{i}. {row['code_hash']}: выполнений {row['executions']}, всего {row['total_wall_seconds']:.3f}s, "
+              f"макс {row['max_wall_seconds']:.3f}s, CPU {row['total_cpu_seconds']:.3f}s, "
+              f"память до {row['max_peak_memory_bytes'] / 1024 / 1024:.1f} MB, строк до {row['max_rows_touched']}")
+        print("   " + row["normalized_code"].replace("\n", "\n   "))
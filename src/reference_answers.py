@@ -0,0 +1,437 @@
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Tuple
+
+import pandas as pd
+from .data_processor import DataProcessor
+from .followup import region_stems
+import logging
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"[a-zа-я0-9]+")
+# Даты убираем до извлечения чисел, иначе "2024-06-01" даст 2024, 6 и 1, а "с 1 по 30 июня" - 1 и 30
+DATE_RE = re.compile(
+    r"\b\d{4}-\d{2}-\d{2}\b|\b\d{1,2}\.\d{1,2}\.\d{2,4}\b"
+    r"|\b\d{1,2}(?:\s*(?:-|–|—|по|и)\s*\d{1,2})?\s+(?:январ|феврал|март|апрел|ма[йя]|июн|июл|август|сентябр|октябр|ноябр|декабр)[а-я]*",
+    re.IGNORECASE,
+)
+# Номера пунктов списка ("1. Москва - 15") - не данные
+LIST_MARKER_RE = re.compile(r"^\s*\d{1,2}[.)](?=\s)", re.MULTILINE)
+# Те же номера внутри строки: "Топ-3: 1. Новосибирск - 19, 2. Казань - 15" (перед меткой, после начала или разделителя)
+INLINE_MARKER_RE = re.compile(r"(?:^|[:;,(])\s*(\d{1,2})[.)]\s+$", re.MULTILINE)
+# 1 234 567,89 (пробелы, в т.ч. неразрывные, между тысячами) | 1234.5 | -12,5; затем % или множитель.
+# Минус только вплотную к цифрам: в "Москва - 15" тире - разделитель
+NUMBER_RE = re.compile(
+    r"(?<![\w.,])(?P<sign>[-−])?(?P<number>\d{1,3}(?:[   ]\d{3})+(?:[.,]\d+)?|\d+(?:[.,]\d+)?)"
+    r"(?:\s?(?P<percent>%)|\s?(?P<scale>тыс|млн|млрд)\b\.?)?"
+)
+SCALES = {"тыс": 1e3, "млн": 1e6, "млрд": 1e9}
+# Между двумя вхождениями одной метки ("Санкт-Петербург" = "санкт" + "петербург") нет данных
+LABEL_GAP_RE = re.compile(r"[\s\-–—]*")
+# Относительный допуск поверх округления, с которым число записано в ответе
+DEFAULT_REL_TOL = 0.005
+
+JUNE_START, JUNE_END = pd.Timestamp("2024-06-01"), pd.Timestamp("2024-07-01")
+
+
+def normalize_question(text: str) -> str:
+    return " ".join(TOKEN_RE.findall(text.lower().replace("ё", "е")))
+
+
+def _blank(match: re.Match) -> str:
+    # Замена той же длины сохраняет позиции чисел относительно меток в исходном тексте
+    return " " * len(match.group())
+
+
+@dataclass
+class ExtractedNumber:
+    value: float
+    # Половина единицы последнего записанного разряда: "34%" покрывает 33.5..34.5
+    rounding: float
+    percent: bool = False
+    start: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.value:g}{'%' if self.percent else ''}"
+
+
+def extract_numbers(text: str) -> List[ExtractedNumber]:
+    """Числа из русскоязычного ответа: разделители тысяч, десятичная запятая, %, тыс/млн"""
+    numbers = []
+    cleaned = LIST_MARKER_RE.sub(_blank, DATE_RE.sub(_blank, text or ""))
+    for match in NUMBER_RE.finditer(cleaned):
+        raw = re.sub(r"[   ]", "", match.group("number")).replace(",", ".")
+        decimals = len(raw.split(".")[1]) if "." in raw else 0
+        scale = SCALES.get(match.group("scale") or "", 1.0)
+        value = float(raw) * scale * (-1 if match.group("sign") else 1)
+        numbers.append(ExtractedNumber(value=value, rounding=0.5 * 10 ** -decimals * scale,
+                                       percent=match.group("percent") is not None, start=match.start()))
+    return numbers
+
+
+def label_patterns(regions: List[str]) -> Dict[str, re.Pattern]:
+    """Метки, к которым в ответе привязываются числа: регионы (в любом падеже) и дни июня"""
+    patterns = {
+        region: re.compile(r"(?<![а-яa-z])(?:" + "|".join(map(re.escape, region_stems(region))) + r")[а-я]*")
+        for region in regions
+    }
+    for day in range(1, 31):
+        patterns[f"{day} июня"] = re.compile(
+            rf"(?<![\d.,\-])0?{day}(?:\s+июн[а-я]*|\.06(?:\.(?:20)?24)?(?![\d,%]))|\b2024-06-{day:02d}\b"
+        )
+    return patterns
+
+
+@dataclass
+class Binding:
+    """Числа ответа, разложенные по меткам"""
+    # Все числа вне самих меток ("5" в "5 июня" - часть метки)
+    numbers: List[ExtractedNumber]
+    found: set = field(default_factory=set)
+    bound: Dict[str, ExtractedNumber] = field(default_factory=dict)
+    # Числа, не привязанные к метке: итоги, вступление, второе число у той же метки
+    free: List[ExtractedNumber] = field(default_factory=list)
+
+
+def find_labels(text: str, patterns: Dict[str, re.Pattern]) -> List[Tuple[int, int, str]]:
+    lowered = (text or "").lower().replace("ё", "е")
+    found = sorted((match.start(), match.end(), label) for label, pattern in patterns.items()
+                   for match in pattern.finditer(lowered))
+    merged: List[Tuple[int, int, str]] = []
+    for start, end, label in found:
+        if merged and start < merged[-1][1]:
+            continue
+        if merged and merged[-1][2] == label and LABEL_GAP_RE.fullmatch(lowered[merged[-1][1]:start]):
+            merged[-1] = (merged[-1][0], end, label)
+        else:
+            merged.append((start, end, label))
+    return merged
+
+
+def bind_numbers(text: str, patterns: Dict[str, re.Pattern]) -> Binding:
+    """Привязывает к каждой метке ближайшее число между ней и соседней меткой.
+
+    Направление ("Москва - 15" или "15 в Москве") выбирается по тому, при каком
+    из двух вариантов число получает больше меток.
+    """
+    labels = find_labels(text, patterns)
+    markers = {match.start(1) for match in (INLINE_MARKER_RE.search(text, max(0, start - 12), start)
+                                            for start, _, _ in labels) if match}
+    numbers = [number for number in extract_numbers(text) if number.start not in markers
+               and not any(start <= number.start < end for start, end, _ in labels)]
+    binding = Binding(numbers=numbers, found={label for _, _, label in labels})
+    if not labels:
+        binding.free = list(numbers)
+        return binding
+
+    edges = [-1] + [end for _, end, _ in labels]
+    starts = [start for start, _, _ in labels] + [len(text) + 1]
+    after, before = {}, {}
+    for i in range(len(labels)):
+        following = [number for number in numbers if labels[i][1] <= number.start < starts[i + 1]]
+        preceding = [number for number in numbers if edges[i] <= number.start < labels[i][0]]
+        if following:
+            after[i] = following[0]
+        if preceding:
+            before[i] = preceding[-1]
+    label_first = len(after) >= len(before)
+    for i, number in sorted((after if label_first else before).items()):
+        binding.bound.setdefault(labels[i][2], number)
+    bound = {id(number) for number in binding.bound.values()}
+    binding.free = [number for number in numbers if id(number) not in bound]
+    return binding
+
+
+@dataclass
+class ExpectedNumber:
+    label: str
+    value: float
+    # Проценты храним в процентах; в ответе допустимы и "34,2%", и доля 0.342
+    percent: bool = False
+    # Значение ищется рядом с меткой (регион, день), а не где угодно в ответе
+    anchored: bool = False
+    # Необязательные числа (итог, числитель и знаменатель доли) не штрафуются ни за отсутствие, ни за упоминание
+    required: bool = True
+
+    def matches(self, number: ExtractedNumber, rel_tol: float = DEFAULT_REL_TOL) -> bool:
+        candidates = [(number.value, number.rounding)]
+        if self.percent and not number.percent:
+            candidates.append((number.value * 100, number.rounding * 100))
+        return any(abs(value - self.value) <= max(rel_tol * abs(self.value), rounding, 1e-9)
+                   for value, rounding in candidates)
+
+    def __str__(self) -> str:
+        return f"{self.label}={round(self.value, 2):g}{'%' if self.percent else ''}"
+
+
+@dataclass
+class ReferenceCheck:
+    variant: str
+    matched: List[str] = field(default_factory=list)
+    missing: List[str] = field(default_factory=list)
+    # Число стоит у нужной метки, но не совпадает с эталоном
+    wrong: List[str] = field(default_factory=list)
+    # Числа ответа, не совпавшие ни с одним ожидаемым значением
+    unexpected: List[str] = field(default_factory=list)
+    # Метки, для которых число не удалось однозначно найти - решает LLM судья
+    undecided: List[str] = field(default_factory=list)
+
+    @property
+    def decided(self) -> bool:
+        return not self.undecided
+
+    @property
+    def share(self) -> float:
+        total = len(self.matched) + len(self.missing) + len(self.wrong) + len(self.unexpected) + len(self.undecided)
+        return len(self.matched) / total if total else 1.0
+
+    @property
+    def score(self) -> int:
+        return score_from_share(self.share)
+
+    @property
+    def reasoning(self) -> str:
+        total = len(self.matched) + len(self.missing) + len(self.wrong) + len(self.undecided)
+        text = f"Сверено с эталонным расчетом ({self.variant}): совпало {len(self.matched)} из {total} чисел"
+        for title, items in (("не найдены", self.missing), ("неверны", self.wrong),
+                             ("лишние числа", self.unexpected), ("не удалось сопоставить", self.undecided)):
+            if items:
+                text += f"; {title}: " + ", ".join(items[:5]) + ("..." if len(items) > 5 else "")
+        return text
+
+
+def score_numbers(variant: str, expected: List[ExpectedNumber], binding: Binding,
+                  rel_tol: float = DEFAULT_REL_TOL, ignored: List[float] | None = None) -> ReferenceCheck:
+    """Значения с меткой сверяются с числом у этой метки, остальные - с любым свободным числом.
+
+    Каждое число ответа закрывает не больше одного ожидаемого: пять одинаковых значений требуют пяти чисел.
+    """
+    check = ReferenceCheck(variant=variant)
+    anchored = any(item.anchored for item in expected)
+    free = list(binding.free if anchored else binding.numbers)
+    for item in expected:
+        if item.anchored:
+            number = binding.bound.get(item.label)
+            if number is None:
+                if item.required:
+                    # Метки в ответе распознаны, а этой нет - значение пропущено; иначе формат ответа нам незнаком
+                    unknown = item.label in binding.found or not binding.bound
+                    (check.undecided if unknown else check.missing).append(str(item))
+            elif item.matches(number, rel_tol):
+                if item.required:
+                    check.matched.append(item.label)
+            else:
+                check.wrong.append(f"{item.label}: {number} вместо {round(item.value, 2):g}")
+            continue
+        hit = next((number for number in free if item.matches(number, rel_tol)), None)
+        if hit is not None:
+            free.remove(hit)
+            if item.required:
+                check.matched.append(item.label)
+        elif item.required:
+            check.missing.append(str(item))
+
+    if anchored:
+        labels = {item.label for item in expected if item.anchored}
+        check.unexpected += [f"{label}: {number}" for label, number in binding.bound.items() if label not in labels]
+    check.unexpected += [str(number) for number in free if not _ignorable(number, ignored or [])]
+    return check
+
+
+def _ignorable(number: ExtractedNumber, ignored: List[float]) -> bool:
+    # Год и числа из самого вопроса ("топ-3", "2024") - не часть ответа
+    year = not number.percent and number.rounding == 0.5 and 2000 <= number.value <= 2100
+    return year or number.value in ignored
+
+
+def score_from_share(share: float) -> int:
+    if share >= 1.0:
+        return 5
+    if share >= 0.75:
+        return 4
+    if share >= 0.5:
+        return 3
+    return 2 if share > 0 else 1
+
+
+# Эталонные расчеты канонических вопросов. Неоднозначные метрики ("активный", "LTV")
+# перечислены в нескольких трактовках; ответ сверяется с наиболее близкой из них.
+Variants = Dict[str, List[ExpectedNumber]]
+
+
+def _june(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    return df[(df[column] >= JUNE_START) & (df[column] < JUNE_END)]
+
+
+def _per_region(counts: pd.Series, total: bool = True) -> List[ExpectedNumber]:
+    expected = [ExpectedNumber(str(region), float(value), anchored=True) for region, value in counts.items()]
+    return expected + ([_context("итого", counts.sum())] if total else [])
+
+
+def _context(label: str, value: float) -> ExpectedNumber:
+    return ExpectedNumber(label, float(value), required=False)
+
+
+def _percent(label: str, part: float, whole: float) -> List[ExpectedNumber]:
+    """Доля и ее числитель со знаменателем ("51,4% - 36 из 70")"""
+    share = ExpectedNumber(label, float(100.0 * part / whole) if whole else 0.0, percent=True)
+    return [share, _context("числитель", part), _context("знаменатель", whole)]
+
+
+def _active_users_by_region(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    completed_buyers = _june(orders[orders['status'] == 'completed'], 'order_date')['user_id']
+    registered = users[users['registration_date'] < JUNE_END]
+    return {
+        "вход в июне": _per_region(_june(users, 'last_login_date').groupby('region')['user_id'].nunique()),
+        "is_active": _per_region(registered[registered['is_active']].groupby('region')['user_id'].nunique()),
+        "заказ в июне": _per_region(users[users['user_id'].isin(completed_buyers)].groupby('region')['user_id'].nunique()),
+    }
+
+
+def _registration_conversion(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    registered = _june(users, 'registration_date')
+    variants = {}
+    for name, statuses in (("completed заказы", ['completed']), ("любые заказы", None)):
+        buyers = orders if statuses is None else orders[orders['status'].isin(statuses)]
+        converted = registered['user_id'].isin(buyers['user_id']).sum()
+        variants[name] = _percent("конверсия", converted, len(registered))
+    return variants
+
+
+def _average_check_by_region(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    june_orders = _june(orders, 'order_date').merge(users[['user_id', 'region']], on='user_id')
+    return {
+        "completed заказы": _per_region(june_orders[june_orders['status'] == 'completed'].groupby('region')['order_amount'].mean(), total=False),
+        "все заказы": _per_region(june_orders.groupby('region')['order_amount'].mean(), total=False),
+    }
+
+
+def _june_registrations_without_orders(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    registered = _june(users, 'registration_date')
+    variants = {}
+    for name, statuses in (("любые заказы", None), ("completed заказы", ['completed'])):
+        relevant = orders if statuses is None else orders[orders['status'].isin(statuses)]
+        after = relevant.merge(registered[['user_id', 'registration_date']], on='user_id')
+        after = after[after['order_date'] >= after['registration_date']]
+        variants[name] = [ExpectedNumber("без заказов", float((~registered['user_id'].isin(after['user_id'])).sum())),
+                          _context("зарегистрировано", len(registered))]
+    return variants
+
+
+def _top_regions_by_registrations(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    counts = _june(users, 'registration_date')['region'].value_counts()
+    # Регионы за пределами топ-3 с их числами в ответе - лишние
+    return {"регистрации в июне": _per_region(counts.head(3), total=False)}
+
+
+def _canceled_share(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    june_orders = _june(orders, 'order_date')
+    return {"доля от всех заказов": _percent("доля отмененных", (june_orders['status'] == 'canceled').sum(), len(june_orders))}
+
+
+def _ltv_per_user(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    revenue_orders = _june(orders[orders['status'] == 'completed'], 'order_date')
+    june_users = _june(users, 'registration_date')['user_id']
+    revenue = float(revenue_orders['order_amount'].sum())
+    june_cohort_revenue = float(revenue_orders[revenue_orders['user_id'].isin(june_users)]['order_amount'].sum())
+    buyers = revenue_orders['user_id'].nunique()
+    return {
+        "на покупателя": [ExpectedNumber("LTV", revenue / buyers), _context("выручка", revenue), _context("покупатели", buyers)],
+        "на пользователя": [ExpectedNumber("LTV", revenue / users['user_id'].nunique()), _context("выручка", revenue),
+                            _context("пользователи", users['user_id'].nunique())],
+        "на зарегистрированного в июне": [ExpectedNumber("LTV", june_cohort_revenue / len(june_users)),
+                                          _context("выручка", june_cohort_revenue), _context("зарегистрировано", len(june_users))],
+    }
+
+
+def _repeat_purchase_share(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    variants = {}
+    for name, statuses in (("completed заказы", ['completed']), ("любые заказы", None)):
+        relevant = _june(orders if statuses is None else orders[orders['status'].isin(statuses)], 'order_date')
+        per_user = relevant.groupby('user_id').size()
+        variants[name] = _percent("повторные покупки", (per_user >= 2).sum(), len(per_user))
+    return variants
+
+
+def _daily_registrations(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    per_day = _june(users, 'registration_date').groupby(users['registration_date'].dt.day).size()
+    expected = [ExpectedNumber(f"{day} июня", float(count), anchored=True) for day, count in per_day.items()]
+    # Дни без регистраций ответ может не упоминать, а может показать с нулем
+    expected += [ExpectedNumber(f"{day} июня", 0.0, anchored=True, required=False)
+                 for day in range(1, 31) if day not in per_day.index]
+    return {"регистрации по дням": expected + [_context("итого", per_day.sum())]}
+
+
+def _visitors_without_purchases(users: pd.DataFrame, orders: pd.DataFrame) -> Variants:
+    visitors = _june(users, 'last_login_date')['user_id']
+    variants = {}
+    for name, statuses in (("completed заказы", ['completed']), ("любые заказы", None)):
+        relevant = _june(orders if statuses is None else orders[orders['status'].isin(statuses)], 'order_date')
+        variants[name] = [ExpectedNumber("без покупок", float((~visitors.isin(relevant['user_id'])).sum())),
+                          _context("заходили", len(visitors))]
+    return variants
+
+
+REFERENCES: List[Tuple[str, Callable[[pd.DataFrame, pd.DataFrame], Variants]]] = [
+    ("Посчитай количество активных пользователей по регионам за июнь 2024", _active_users_by_region),
+    ("Какая конверсия пользователей из регистрации в покупку за июнь?", _registration_conversion),
+    ("Выведи средний чек заказа по каждому региону за июнь", _average_check_by_region),
+    ("Сколько пользователей не делали заказы после регистрации в июне?", _june_registrations_without_orders),
+    ("Покажи топ-3 региона по количеству регистраций за июнь", _top_regions_by_registrations),
+    ("Какая доля отмененных заказов за июнь 2024?", _canceled_share),
+    ("Посчитай LTV (lifetime value) на пользователя за июнь", _ltv_per_user),
+    ("Какой процент пользователей сделал повторные покупки в июне?", _repeat_purchase_share),
+    ("Выведи динамику регистраций по дням за июнь", _daily_registrations),
+    ("Сколько пользователей за июнь заходили на сайт, но не совершили покупок?", _visitors_without_purchases),
+]
+
+
+class ReferenceChecker:
+    """Оценка корректности без LLM: числа ответа сверяются с эталонным pandas расчетом.
+
+    Эталоны считаются на текущих фреймах data_processor и кэшируются до смены снапшота.
+    Для вопросов вне набора check() возвращает None, а если числа не удалось привязать
+    к меткам - проверку с undecided; в обоих случаях ответ оценивает LLM судья.
+    """
+
+    def __init__(self, data_processor: DataProcessor, rel_tol: float = DEFAULT_REL_TOL):
+        self.data_processor = data_processor
+        self.rel_tol = rel_tol
+        self._lock = threading.Lock()
+        self._references = {normalize_question(question): compute for question, compute in REFERENCES}
+        self._frames: Tuple[pd.DataFrame, pd.DataFrame] | None = None
+        self._expected: Dict[str, Variants] = {}
+        self._patterns: Dict[str, re.Pattern] = {}
+
+    def has_reference(self, question: str) -> bool:
+        return normalize_question(question) in self._references
+
+    def expected(self, question: str) -> Variants | None:
+        key = normalize_question(question)
+        compute = self._references.get(key)
+        if compute is None:
+            return None
+        frames = (self.data_processor.users_df, self.data_processor.orders_df)
+        with self._lock:
+            if self._frames is None or any(current is not cached for current, cached in zip(frames, self._frames)):
+                self._frames, self._expected = frames, {}
+                self._patterns = label_patterns(sorted(frames[0]['region'].dropna().unique()))
+            if key not in self._expected:
+                self._expected[key] = compute(*frames)
+            return self._expected[key]
+
+    def check(self, question: str, answer: str) -> ReferenceCheck | None:
+        try:
+            variants = self.expected(question)
+        except Exception:
+            logger.exception(f"Reference computation failed for {question!r}")
+            return None
+        if not variants:
+            return None
+
+        binding = bind_numbers(answer, self._patterns)
+        ignored = [number.value for number in extract_numbers(question)]
+        checks = [score_numbers(variant, expected, binding, self.rel_tol, ignored) for variant, expected in variants.items()]
+        return max(checks, key=lambda check: (check.share, check.decided))
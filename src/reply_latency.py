@@ -0,0 +1,42 @@
+import threading
+from collections import deque
+from typing import Any, Deque, Dict
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RollingLatency:
+    """Скользящая оценка времени до ответа по типу запроса.
+
+    Прогноз - квантиль quantile последних window замеров типа: по нему бот решает,
+    стоит ли сразу отправить "считаю…". Пока замеров меньше min_samples, прогноз
+    равен default_seconds, поэтому на холодном старте подтверждение уходит.
+    """
+
+    def __init__(self, window: int = 100, quantile: float = 0.75, min_samples: int = 5, default_seconds: float = 10.0):
+        self.window = window
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.default_seconds = default_seconds
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, query_type: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(query_type, deque(maxlen=self.window)).append(seconds)
+
+    def predict(self, query_type: str) -> float:
+        with self._lock:
+            samples = sorted(self._samples.get(query_type, ()))
+        if len(samples) < self.min_samples:
+            return self.default_seconds
+        return samples[min(len(samples) - 1, int(self.quantile * len(samples)))]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            types = list(self._samples)
+        return {
+            query_type: {"samples": len(self._samples[query_type]), "predicted_seconds": round(self.predict(query_type), 3)}
+            for query_type in types
+        }
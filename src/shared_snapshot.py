@@ -0,0 +1,313 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Строковые колонки хранятся кодами, но воркеру отдаются декодированными в object:
+# Categorical меняет результат groupby (пустые категории) и схему для LLM
+# Формат манифеста; версии в старом формате при загрузке публикуются заново
+FORMAT_VERSION = 2
+# Колонки пишутся с запасом емкости: дописанные строки ложатся в хвост тех же файлов,
+# а при нехватке места таблицы переписываются в новое поколение с удвоенной емкостью
+MIN_CAPACITY = 1024
+GROWTH_FACTOR = 2
+
+
+def default_snapshot_dir() -> str:
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "vividmoney-snapshot")
+
+
+def codes_dtype(n_categories: int) -> np.dtype:
+    # Тот же тип кодов, что выбрал бы pandas, чтобы from_codes не копировал массив
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedSnapshot:
+    """Набор DataFrame поверх read-only mmap файлов одной версии снапшота"""
+
+    def __init__(self, store: "SharedSnapshotStore", version: str, frames: Dict[str, pd.DataFrame], source_key: str):
+        self.store = store
+        self.version = version
+        self.frames = frames
+        # Файлы, из которых построена версия; DataProcessor сверяет с ними текущие CSV
+        self.source_key = source_key
+
+    def refresh(self) -> bool:
+        """Переключается на текущую версию, если ее опубликовали; True - снапшот сменился"""
+        current = self.store.current_version()
+        if current is None or current == self.version:
+            return False
+        old_version = self.version
+        self.frames = self.store._attach(current)
+        self.version = current
+        self.source_key = self.store._manifest(current).get("source_key")
+        self.store._release(old_version)
+        logger.info(f"Switched data snapshot {old_version} -> {current}")
+        return True
+
+    def close(self):
+        self.store._release(self.version)
+        self.frames = {}
+
+
+class SharedSnapshotStore:
+    """Типизированный колоночный снапшот в /dev/shm, общий для всех воркеров uvicorn.
+
+    Первый воркер публикует версию под файловой блокировкой, остальные подключаются
+    к ней через mmap без копирования. Каждый подключенный процесс держит lease-файл
+    версии; старая версия удаляется, когда на нее не осталось живых lease.
+
+    Файлы колонок лежат в поколении (g1, g2, ...) и общие для нескольких версий:
+    append() дописывает строки за концом последней версии и публикует манифест
+    с большим числом строк. Читатели старых версий смотрят только на свой префикс.
+    """
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory or default_snapshot_dir()
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+
+    @contextmanager
+    def locked(self):
+        """Межпроцессная блокировка стора; повторный вход из того же потока не блокирует"""
+        with self._thread_lock:
+            if self._lock_depth:
+                self._lock_depth += 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth -= 1
+                return
+            with open(os.path.join(self.directory, "lock"), "a+") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._lock_depth = 1
+                try:
+                    yield
+                finally:
+                    self._lock_depth = 0
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def current_version(self) -> str | None:
+        try:
+            with open(os.path.join(self.directory, "CURRENT")) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _manifest(self, version: str) -> Dict:
+        with open(os.path.join(self.directory, version, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self, source_key: str, loader: Callable[[], Dict[str, pd.DataFrame]]) -> SharedSnapshot:
+        """Подключается к опубликованной версии для source_key или публикует новую"""
+        with self.locked():
+            version = self.current_version()
+            if version is None or not self._matches(self._manifest(version), source_key):
+                version = self._publish(loader(), source_key)
+            frames = self._attach(version)
+        return SharedSnapshot(self, version, frames, source_key)
+
+    @staticmethod
+    def _matches(manifest: Dict, source_key: str) -> bool:
+        return manifest.get("format") == FORMAT_VERSION and manifest.get("source_key") == source_key
+
+    def publish(self, frames: Dict[str, pd.DataFrame], source_key: str) -> str:
+        with self.locked():
+            return self._publish(frames, source_key)
+
+    def _next_name(self, prefix: str) -> str:
+        existing = [int(name[1:]) for name in os.listdir(self.directory) if name.startswith(prefix) and name[1:].isdigit()]
+        return f"{prefix}{max(existing, default=0) + 1}"
+
+    def _publish(self, frames: Dict[str, pd.DataFrame], source_key: str) -> str:
+        generation = self._next_name("g")
+        tmp_dir = tempfile.mkdtemp(prefix=".publish-", dir=self.directory)
+
+        manifest = {"format": FORMAT_VERSION, "source_key": source_key, "generation": generation, "tables": {}}
+        for table, df in frames.items():
+            capacity = max(MIN_CAPACITY, len(df) * GROWTH_FACTOR)
+            columns = []
+            for i, (name, series) in enumerate(df.items()):
+                file_name = f"{table}.{i}.bin"
+                column = {"name": name, "file": file_name}
+                if isinstance(series.dtype, pd.CategoricalDtype) or series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+                    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+                    values = codes.astype(codes_dtype(len(uniques)))
+                    column.update(kind="strings", dtype=values.dtype.str, categories=[str(v) for v in uniques])
+                elif pd.api.types.is_datetime64_dtype(series.dtype):
+                    values = series.to_numpy().view("int64")
+                    column.update(kind="datetime", dtype=str(series.dtype))
+                else:
+                    values = series.to_numpy()
+                    column.update(kind="numeric", dtype=values.dtype.str)
+                with open(os.path.join(tmp_dir, file_name), "wb") as f:
+                    np.ascontiguousarray(values).tofile(f)
+                    # Хвост емкости - дырка в файле: tmpfs не выделяет под нее память до записи
+                    f.truncate(capacity * values.dtype.itemsize)
+                columns.append(column)
+            manifest["tables"][table] = {"rows": len(df), "capacity": capacity, "columns": columns}
+
+        os.rename(tmp_dir, os.path.join(self.directory, generation))
+        return self._write_version(manifest)
+
+    def _write_version(self, manifest: Dict[str, Any]) -> str:
+        version = self._next_name("v")
+        manifest = {**manifest, "version": version}
+        tmp_dir = tempfile.mkdtemp(prefix=".publish-", dir=self.directory)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.makedirs(os.path.join(tmp_dir, "leases"))
+        os.rename(tmp_dir, os.path.join(self.directory, version))
+
+        # Атомарно переключаем указатель на новую версию
+        pointer_tmp = os.path.join(self.directory, f".CURRENT.{os.getpid()}")
+        with open(pointer_tmp, "w") as f:
+            f.write(version)
+        os.replace(pointer_tmp, os.path.join(self.directory, "CURRENT"))
+        logger.info(f"Published data snapshot {version} to {self.directory}")
+
+        self._collect_garbage()
+        return version
+
+    def append(self, frames: Dict[str, pd.DataFrame], source_key: str) -> str:
+        """Дописывает строки к текущей версии и публикует новую; возвращает ее имя.
+
+        Пишутся только новые строки, если им хватает емкости колонок и типа кодов
+        строковых колонок; иначе таблицы целиком переписываются в новое поколение.
+        """
+        with self.locked():
+            version = self.current_version()
+            if version is None:
+                raise RuntimeError("Нет опубликованного снапшота для дописывания")
+            manifest = self._manifest(version)
+            planned = self._plan_append(manifest, frames)
+            if planned is None:
+                current = self._map_frames(manifest)
+                merged = {table: pd.concat([df, frames[table]], ignore_index=True) if table in frames else df
+                          for table, df in current.items()}
+                logger.info(f"Snapshot capacity exhausted, rewriting tables of {version}")
+                return self._publish(merged, source_key)
+
+            generation_dir = os.path.join(self.directory, manifest["generation"])
+            for table, columns in planned.items():
+                spec = manifest["tables"][table]
+                for column, values in zip(spec["columns"], columns):
+                    with open(os.path.join(generation_dir, column["file"]), "r+b") as f:
+                        f.seek(spec["rows"] * values.dtype.itemsize)
+                        values.tofile(f)
+                spec["rows"] += len(frames[table])
+            return self._write_version({**manifest, "source_key": source_key})
+
+    def _plan_append(self, manifest: Dict[str, Any], frames: Dict[str, pd.DataFrame]) -> Dict[str, List[np.ndarray]] | None:
+        """Кодирует новые строки в типы колонок версии; None - не помещаются в текущее поколение"""
+        if manifest.get("format") != FORMAT_VERSION:
+            return None
+        planned = {}
+        for table, df in frames.items():
+            spec = manifest["tables"].get(table)
+            if spec is None or spec["rows"] + len(df) > spec["capacity"] or \
+                    [column["name"] for column in spec["columns"]] != list(df.columns):
+                return None
+            columns = []
+            for column in spec["columns"]:
+                series = df[column["name"]]
+                if column["kind"] == "strings":
+                    categories = column["categories"]
+                    known = set(categories)
+                    categories.extend(value for value in pd.unique(series.dropna().astype(str)) if value not in known)
+                    if np.dtype(column["dtype"]) != codes_dtype(len(categories)):
+                        return None
+                    values = pd.Categorical(series.astype(object), categories=categories).codes.astype(column["dtype"])
+                elif column["kind"] == "datetime":
+                    values = pd.to_datetime(series).to_numpy().astype(column["dtype"]).view("int64")
+                else:
+                    values = series.to_numpy().astype(column["dtype"])
+                columns.append(np.ascontiguousarray(values))
+            planned[table] = columns
+        return planned
+
+    def _attach(self, version: str) -> Dict[str, pd.DataFrame]:
+        open(os.path.join(self.directory, version, "leases", str(os.getpid())), "w").close()
+        return self._map_frames(self._manifest(version))
+
+    def _map_frames(self, manifest: Dict[str, Any]) -> Dict[str, pd.DataFrame]:
+        generation_dir = os.path.join(self.directory, manifest["generation"])
+        frames = {}
+        for table, spec in manifest["tables"].items():
+            rows = spec["rows"]
+            data = {}
+            for column in spec["columns"]:
+                path = os.path.join(generation_dir, column["file"])
+                if column["kind"] == "datetime":
+                    values = np.memmap(path, dtype="int64", mode="r", shape=(rows,)) if rows else np.empty(0, "int64")
+                    data[column["name"]] = values.view(column["dtype"])
+                    continue
+                values = np.memmap(path, dtype=column["dtype"], mode="r", shape=(rows,)) if rows else np.empty(0, column["dtype"])
+                if column["kind"] == "strings":
+                    # Код -1 (пропуск) попадает на последний элемент - NaN, как после read_csv
+                    data[column["name"]] = np.array(column["categories"] + [np.nan], dtype=object)[values]
+                else:
+                    data[column["name"]] = values
+            frames[table] = pd.DataFrame(data, copy=False)
+        return frames
+
+    def _release(self, version: str):
+        try:
+            os.remove(os.path.join(self.directory, version, "leases", str(os.getpid())))
+        except FileNotFoundError:
+            pass
+        with self.locked():
+            self._collect_garbage()
+
+    def _collect_garbage(self):
+        """Удаляет неактуальные версии без живых lease и поколения без версий (под блокировкой)"""
+        current = self.current_version()
+        referenced = set()
+        for name in os.listdir(self.directory):
+            if not (name.startswith("v") and name[1:].isdigit()):
+                continue
+            if name != current:
+                leases_dir = os.path.join(self.directory, name, "leases")
+                live: List[str] = []
+                for lease in os.listdir(leases_dir) if os.path.isdir(leases_dir) else []:
+                    if lease.isdigit() and _pid_alive(int(lease)):
+                        live.append(lease)
+                    else:
+                        os.remove(os.path.join(leases_dir, lease))
+                if not live:
+                    # Уже смапленные страницы остаются доступны процессам и после unlink
+                    shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                    logger.info(f"Removed data snapshot {name}")
+                    continue
+            try:
+                referenced.add(self._manifest(name).get("generation"))
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+        for name in os.listdir(self.directory):
+            if name.startswith("g") and name[1:].isdigit() and name not in referenced:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
@@ -0,0 +1,161 @@
+import json
+import math
+import re
+import sys
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+DATA_LABEL = "data"
+DEFAULT_MODEL_PATH = "data/smalltalk_model.json"
+DEFAULT_TRAINING_PATH = "data/smalltalk_queries.jsonl"
+
+TOKEN_RE = re.compile(r"[a-zа-я0-9]+")
+
+# Основы слов, при которых сообщение всегда уходит в анализ данных
+DATA_KEYWORD_STEMS = (
+    "сколько", "посчит", "счита", "выруч", "заказ", "регион", "пользоват", "средн", "конверс",
+    "доля", "доли", "процент", "чек", "отмен", "регистрац", "ltv", "топ", "сумм", "динамик",
+    "актив", "москв", "казан", "новосиб", "екатерин", "петербург", "спб", "июн", "мая", "май", "июл",
+    "продаж", "товар", "деньг", "денег", "доход", "прибыл", "оборот", "клиент", "покуп", "город", "категор", "сравн",
+)
+
+TEMPLATES = {
+    "greeting": "Привет! Я AI-аналитик: отвечаю на вопросы по данным пользователей и заказов. Например: «Сколько заказов было в июне?»",
+    "thanks": "Пожалуйста! Если нужно что-то еще посчитать - просто спросите.",
+    "capabilities": (
+        "Я считаю метрики по данным пользователей и заказов: количество и активность пользователей, "
+        "регистрации, заказы и выручку, средний чек, конверсию, LTV, разбивку по регионам и датам. "
+        "Просто задайте вопрос, например: «Какой средний чек по регионам за июнь?»"
+    ),
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+def extract_features(text: str) -> List[str]:
+    tokens = tokenize(text)
+    features = [f"w:{token}" for token in tokens]
+    features += [f"b:{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+    for token in tokens:
+        padded = f"^{token}$"
+        features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    features.append(f"len:{min(len(tokens), 6)}")
+    return features
+
+
+class SmallTalkClassifier:
+    """Multinomial naive Bayes по словам, биграммам и символьным триграммам.
+
+    Отвечает шаблоном только на уверенно распознанный small talk без цифр, все
+    слова которого встречались в примерах small talk: на 100 примерах незнакомое
+    слово ("как там продажи?") скорее означает вопрос к данным. Все остальное
+    отдает в основной граф.
+    """
+
+    def __init__(self, class_log_prior: Dict[str, float], feature_log_prob: Dict[str, Dict[str, float]],
+                 unseen_log_prob: Dict[str, float], threshold: float = 0.9, max_tokens: int = 8):
+        self.class_log_prior = class_log_prior
+        self.feature_log_prob = feature_log_prob
+        self.unseen_log_prob = unseen_log_prob
+        self.threshold = threshold
+        self.max_tokens = max_tokens
+        self.smalltalk_words = {
+            feature[2:] for label, log_probs in feature_log_prob.items() if label in TEMPLATES
+            for feature in log_probs if feature.startswith("w:")
+        }
+
+    @classmethod
+    def train(cls, examples: Iterable[Tuple[str, str]], alpha: float = 0.5, **kwargs) -> "SmallTalkClassifier":
+        class_counts = Counter()
+        feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        vocabulary = set()
+        for text, label in examples:
+            class_counts[label] += 1
+            features = extract_features(text)
+            feature_counts[label].update(features)
+            vocabulary.update(features)
+
+        total = sum(class_counts.values())
+        class_log_prior = {label: math.log(count / total) for label, count in class_counts.items()}
+        feature_log_prob, unseen_log_prob = {}, {}
+        for label in class_counts:
+            denominator = sum(feature_counts[label].values()) + alpha * (len(vocabulary) + 1)
+            feature_log_prob[label] = {
+                feature: math.log((count + alpha) / denominator) for feature, count in feature_counts[label].items()
+            }
+            unseen_log_prob[label] = math.log(alpha / denominator)
+        return cls(class_log_prior, feature_log_prob, unseen_log_prob, **kwargs)
+
+    def predict_proba(self, text: str) -> Dict[str, float]:
+        features = extract_features(text)
+        scores = {}
+        for label, prior in self.class_log_prior.items():
+            log_probs = self.feature_log_prob[label]
+            unseen = self.unseen_log_prob[label]
+            scores[label] = prior + sum(log_probs.get(feature, unseen) for feature in features)
+        top = max(scores.values())
+        exp_scores = {label: math.exp(score - top) for label, score in scores.items()}
+        norm = sum(exp_scores.values())
+        return {label: value / norm for label, value in exp_scores.items()}
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        proba = self.predict_proba(text)
+        label = max(proba, key=proba.get)
+        return label, proba[label]
+
+    def route(self, text: str) -> str:
+        """Метка small talk, если отвечаем шаблоном, иначе DATA_LABEL"""
+        tokens = tokenize(text)
+        if not tokens or len(tokens) > self.max_tokens or any(token.isdigit() for token in tokens):
+            return DATA_LABEL
+        if any(token.startswith(DATA_KEYWORD_STEMS) or token not in self.smalltalk_words for token in tokens):
+            return DATA_LABEL
+        label, probability = self.predict(text)
+        if label != DATA_LABEL and label in TEMPLATES and probability >= self.threshold:
+            return label
+        return DATA_LABEL
+
+    def answer(self, text: str) -> str | None:
+        label = self.route(text)
+        return TEMPLATES.get(label)
+
+    def to_dict(self) -> Dict:
+        return {
+            "class_log_prior": self.class_log_prior,
+            "feature_log_prob": self.feature_log_prob,
+            "unseen_log_prob": self.unseen_log_prob,
+            "threshold": self.threshold,
+            "max_tokens": self.max_tokens,
+        }
+
+    def save(self, path: str = DEFAULT_MODEL_PATH):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_MODEL_PATH) -> "SmallTalkClassifier | None":
+        try:
+            with open(path, encoding="utf-8") as f:
+                return cls(**json.load(f))
+        except FileNotFoundError:
+            logger.warning(f"Small talk model not found at {path}, all messages go to the LLM")
+            return None
+
+
+def load_examples(path: str = DEFAULT_TRAINING_PATH) -> List[Tuple[str, str]]:
+    with open(path, encoding="utf-8") as f:
+        return [(row["text"], row["label"]) for row in map(json.loads, f) if row.get("text")]
+
+
+if __name__ == "__main__":
+    # python -m src.smalltalk_classifier [training.jsonl] [model.json]
+    training_path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_TRAINING_PATH
+    model_path = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_MODEL_PATH
+    examples = load_examples(training_path)
+    SmallTalkClassifier.train(examples).save(model_path)
+    print(f"Обучено на {len(examples)} примерах, модель сохранена в {model_path}")
@@ -0,0 +1,107 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CandidateRun:
+    index: int
+    code: str
+    result: Any = None
+    error: str | None = None
+    elapsed: float = 0.0
+    fingerprint: str | None = None
+
+
+@dataclass
+class CandidateOutcome:
+    code: str
+    result: Any
+    error: str | None
+    agreement: float | None
+    valid_count: int
+    total: int
+    runs: List[CandidateRun] = field(default_factory=list)
+
+
+def _normalize(value: Any) -> Any:
+    if hasattr(value, "to_dict"):
+        try:
+            return _normalize(value.to_dict(orient="records"))
+        except (TypeError, ValueError):
+            return _normalize(value.to_dict())
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        try:
+            return _normalize(value.item())
+        except (TypeError, ValueError):
+            pass
+    if isinstance(value, dict):
+        return {str(k): _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        # Округляем, чтобы 25.4 и 25.400000001 считались одним ответом
+        return float(f"{value:.6g}")
+    return str(value)
+
+
+def result_fingerprint(result: Any) -> str:
+    return json.dumps(_normalize(result), sort_keys=True, ensure_ascii=False, default=str)
+
+
+def run_candidates(execute: Callable[[str], tuple], codes: List[str], max_workers: int | None = None) -> CandidateOutcome:
+    """Выполняет варианты кода параллельно и выбирает результат большинства.
+
+    Как только один результат набирает строгое большинство голосов, остальные
+    варианты не дожидаемся. Иначе побеждает самая большая группа совпадающих
+    результатов, при равенстве - вариант с меньшим индексом.
+    """
+    runs = [CandidateRun(index=i, code=code) for i, code in enumerate(codes)]
+    votes: Dict[str, List[CandidateRun]] = {}
+    finished: List[CandidateRun] = []
+    majority = len(codes) // 2 + 1
+
+    def _run(run: CandidateRun) -> CandidateRun:
+        started = time.perf_counter()
+        run.result, run.error = execute(run.code)
+        run.elapsed = time.perf_counter() - started
+        if run.error is None:
+            run.fingerprint = result_fingerprint(run.result)
+        return run
+
+    pool = ThreadPoolExecutor(max_workers=max_workers or len(codes))
+    try:
+        futures = [pool.submit(_run, run) for run in runs]
+        for future in as_completed(futures):
+            run = future.result()
+            finished.append(run)
+            if run.error is not None:
+                continue
+            group = votes.setdefault(run.fingerprint, [])
+            group.append(run)
+            if len(group) >= majority:
+                break
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    valid_count = sum(len(group) for group in votes.values())
+
+    if not votes:
+        first = runs[0]
+        return CandidateOutcome(code=first.code, result=None, error=first.error or "No valid candidate",
+                                agreement=None, valid_count=0, total=len(codes), runs=finished)
+
+    winner = max(votes.values(), key=lambda group: (len(group), -min(run.index for run in group)))
+    chosen = min(winner, key=lambda run: run.index)
+    agreement = len(winner) / valid_count
+    logger.info(f"Candidate agreement: {len(winner)}/{valid_count} valid of {len(codes)} (chosen #{chosen.index})")
+
+    return CandidateOutcome(code=chosen.code, result=chosen.result, error=None, agreement=round(agreement, 3),
+                            valid_count=valid_count, total=len(codes), runs=finished)
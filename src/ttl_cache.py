@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, TypeVar
+
+V = TypeVar("V")
+
+_MISSING = object()
+
+
+class TTLCache(Generic[V]):
+    """Ограниченный LRU словарь, записи в котором живут не дольше ttl_seconds"""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600.0, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._data: "OrderedDict[Hashable, tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> V | Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: V):
+        with self._lock:
+            self._data[key] = (self.clock() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            self._evict()
+
+    def add(self, key: Hashable, value: V) -> bool:
+        """Атомарно добавляет ключ, если его еще нет; False - ключ уже есть"""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > self.clock():
+                return False
+            self._data[key] = (self.clock() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            self._evict()
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> V | Any:
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+            if entry is _MISSING or entry[0] <= self.clock():
+                return default
+            return entry[1]
+
+    def _evict(self):
+        now = self.clock()
+        # С начала лежат давно не использованные записи: выкидываем протухшие и лишние сверх лимита
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now and len(self._data) <= self.max_entries:
+                break
+            del self._data[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._evict()
+            return len(self._data)
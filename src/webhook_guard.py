@@ -0,0 +1,270 @@
+import asyncio
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict
+
+from .ttl_cache import TTLCache
+import logging
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+")
+# Очередь отправителя, занятая дольше этого, считается брошенной (воркер упал посреди ответа)
+STALE_LANE_SECONDS = 600.0
+LANE_POLL_SECONDS = 0.05
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    # Один файл на всех воркерах uvicorn, как у outbox
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MessageDeduplicator:
+    """Индекс принятых MessageSid: ретраи Twilio не запускают пайплайн повторно.
+
+    MessageSid занимается на время обработки (first_seen) и отмечается готовым после
+    ответа (finish). Ретрай сообщения, чей воркер умер, не дойдя до finish, снова
+    принимается. С path индекс лежит в SQLite и общий для всех воркеров.
+    """
+
+    def __init__(self, max_entries: int = 50000, ttl_seconds: float = 24 * 3600.0, path: str | None = None):
+        self.ttl_seconds = ttl_seconds
+        self._seen: TTLCache[bool] = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self._conn = None
+        self._lock = threading.Lock()
+        if path:
+            self._conn = _connect(path)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS webhook_messages (
+                    message_sid TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    owner_pid INTEGER NOT NULL,
+                    received_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS webhook_messages_received ON webhook_messages (received_at)")
+        self.duplicates = 0
+
+    def first_seen(self, message_sid: str | None) -> bool:
+        if not message_sid:
+            return True
+        if self._claim(message_sid):
+            return True
+        self.duplicates += 1
+        logger.info(f"Duplicate webhook delivery for {message_sid}, skipping")
+        return False
+
+    def _claim(self, message_sid: str) -> bool:
+        if self._conn is None:
+            return self._seen.add(message_sid, True)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM webhook_messages WHERE received_at < ?", (now - self.ttl_seconds,))
+                row = self._conn.execute("SELECT status, owner_pid FROM webhook_messages WHERE message_sid = ?",
+                                         (message_sid,)).fetchone()
+                if row is not None and (row[0] == "done" or _pid_alive(row[1])):
+                    return False
+                if row is not None:
+                    logger.warning(f"Worker {row[1]} died while handling {message_sid}, processing the retry")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO webhook_messages (message_sid, status, owner_pid, received_at) "
+                    "VALUES (?, 'processing', ?, ?)",
+                    (message_sid, os.getpid(), now)
+                )
+                return True
+            finally:
+                self._conn.execute("COMMIT")
+
+    def finish(self, message_sid: str | None):
+        if message_sid and self._conn is not None:
+            with self._lock:
+                self._conn.execute("UPDATE webhook_messages SET status = 'done' WHERE message_sid = ?", (message_sid,))
+
+
+@dataclass
+class LaneTicket:
+    sender: str
+    seq: int
+    lanes: "SenderLanes" = field(repr=False)
+
+    def is_superseded(self) -> bool:
+        """True, если отправитель уже прислал более новое сообщение и отмена включена"""
+        return self.lanes.cancel_superseded and self.lanes._latest_seq(self.sender, self.seq) != self.seq
+
+
+class _Lane:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class SenderLanes:
+    """Последовательная обработка сообщений одного отправителя.
+
+    Сообщения разных отправителей идут параллельно, одного - строго по порядку.
+    С cancel_superseded=True устаревшие вопросы прерываются на ближайшей
+    контрольной точке, если тот же отправитель прислал новый.
+
+    С path номера сообщений выдает SQLite, и порядок с отменой соблюдаются между
+    воркерами: сообщение ждет, пока воркеры с более ранними сообщениями того же
+    отправителя не закончат (или не умрут).
+    """
+
+    def __init__(self, cancel_superseded: bool = False, path: str | None = None):
+        self.cancel_superseded = cancel_superseded
+        self._lanes: Dict[str, _Lane] = {}
+        self._latest: Dict[str, int] = {}
+        self._seq = itertools.count(1)
+        self._conn = None
+        self._lock = threading.Lock()
+        if path:
+            self._conn = _connect(path)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS lane_tickets (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT NOT NULL,
+                    owner_pid INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lane_tickets_sender ON lane_tickets (sender, seq)")
+        self.cancelled = 0
+
+    def ticket(self, sender: str) -> LaneTicket:
+        if self._conn is None:
+            seq = next(self._seq)
+        else:
+            with self._lock:
+                seq = self._conn.execute("INSERT INTO lane_tickets (sender, owner_pid, created_at) VALUES (?, ?, ?)",
+                                         (sender, os.getpid(), time.time())).lastrowid
+        self._latest[sender] = seq
+        return LaneTicket(sender=sender, seq=seq, lanes=self)
+
+    def _latest_seq(self, sender: str, default: int) -> int:
+        if self._conn is None:
+            return self._latest.get(sender, default)
+        with self._lock:
+            row = self._conn.execute("SELECT MAX(seq) FROM lane_tickets WHERE sender = ?", (sender,)).fetchone()
+        return row[0] if row[0] is not None else default
+
+    def _has_earlier_ticket(self, ticket: LaneTicket) -> bool:
+        """Есть ли более раннее сообщение отправителя в другом живом воркере"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, owner_pid, created_at FROM lane_tickets WHERE sender = ? AND seq < ?",
+                (ticket.sender, ticket.seq)
+            ).fetchall()
+            abandoned = [seq for seq, pid, created_at in rows
+                         if not _pid_alive(pid) or time.time() - created_at > STALE_LANE_SECONDS]
+            if abandoned:
+                logger.warning(f"Dropping abandoned lane tickets {abandoned} of {ticket.sender}")
+                self._conn.executemany("DELETE FROM lane_tickets WHERE seq = ?", [(seq,) for seq in abandoned])
+        return len(rows) > len(abandoned)
+
+    @asynccontextmanager
+    async def lane(self, ticket: LaneTicket):
+        lane = self._lanes.setdefault(ticket.sender, _Lane())
+        lane.users += 1
+        try:
+            async with lane.lock:
+                if self._conn is not None:
+                    # Запросы к SQLite могут ждать блокировку до busy_timeout - не на event loop
+                    while await asyncio.to_thread(self._has_earlier_ticket, ticket):
+                        await asyncio.sleep(LANE_POLL_SECONDS)
+                yield ticket
+        finally:
+            lane.users -= 1
+            if self._conn is not None:
+                await asyncio.to_thread(self._release, ticket)
+            if lane.users == 0:
+                # Никто больше не ждет - освобождаем память под отправителя
+                del self._lanes[ticket.sender]
+                if self._latest.get(ticket.sender) == ticket.seq:
+                    del self._latest[ticket.sender]
+
+    def _release(self, ticket: LaneTicket):
+        with self._lock:
+            self._conn.execute("DELETE FROM lane_tickets WHERE seq = ?", (ticket.seq,))
+
+    def record_cancelled(self, ticket: LaneTicket):
+        self.cancelled += 1
+        logger.info(f"Message #{ticket.seq} from {ticket.sender} superseded by a newer one, cancelled")
+
+    def stats(self) -> Dict[str, int]:
+        return {"active_senders": len(self._lanes), "cancelled": self.cancelled}
+
+
+@dataclass
+class _LastQuestion:
+    text: str
+    replied: bool = False
+
+
+class ResendTracker:
+    """Повторные отправки того же вопроса: новый MessageSid, тот же отправитель и текст.
+
+    Счетчики ведутся по режиму ответа (например, "single" и "staged"), чтобы сравнить
+    долю повторов до и после поэтапной доставки. resends_before_reply - повторы, пока
+    пользователь еще не получил ни одного сообщения в ответ.
+    """
+
+    def __init__(self, window_seconds: float = 600.0, max_entries: int = 50000):
+        self._last: TTLCache[_LastQuestion] = TTLCache(max_entries=max_entries, ttl_seconds=window_seconds)
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(WORD_RE.findall(text.casefold()))
+
+    def observe(self, sender: str, body: str, mode: str) -> bool:
+        """Учитывает сообщение; True, если это повтор предыдущего вопроса отправителя"""
+        text = self.normalize(body)
+        with self._lock:
+            previous = self._last.get(sender)
+            resend = previous is not None and previous.text == text
+            counters = self._counters.setdefault(mode, {"messages": 0, "resends": 0, "resends_before_reply": 0})
+            counters["messages"] += 1
+            if resend:
+                counters["resends"] += 1
+                counters["resends_before_reply"] += not previous.replied
+                logger.info(f"Resend of the same question from {sender} ({'before' if not previous.replied else 'after'} reply)")
+            else:
+                self._last.set(sender, _LastQuestion(text))
+        return resend
+
+    def replied(self, sender: str):
+        with self._lock:
+            previous = self._last.get(sender)
+            if previous is not None:
+                previous.replied = True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                mode: {**counters, "resend_rate": round(counters["resends"] / counters["messages"], 4)}
+                for mode, counters in self._counters.items()
+            }
@@ -1,31 +1,167 @@
-from twilio.rest import Client
+import threading
+import time
 from twilio.twiml.messaging_response import MessagingResponse
-from .analytics_agent import AnalyticsAgent, AnalyticsState
-from .answer_evaluator import AnswerEvaluator
+from .llm_resilience import deadline_after
+from .smalltalk_classifier import DATA_LABEL, TEMPLATES
+from .followup import ConversationStore, followup_query, parse_followup, rewrite_code
+from .reply_latency import RollingLatency
 import logging
-from twilio.base.exceptions import TwilioRestException
+from typing import TYPE_CHECKING, Any, Callable, Dict
+
+# langgraph, langchain, openai, pandas и requests импортируются только при первом
+# обращении к компонентам бота: импорт app.py не должен задерживать холодный старт
+if TYPE_CHECKING:
+    from .analytics_agent import AnalyticsAgent, AnalyticsState
+    from .answer_evaluator import AnswerEvaluator
+    from .data_processor import DataProcessor
+    from .outbound_sender import TwilioOutboundSender
+    from .admission_control import AdmissionController
+    from .query_profiler import QueryProfiler
 
 logger = logging.getLogger(__name__)
 
+ACK_MESSAGE = "Считаю… Ответ пришлю следующим сообщением."
+EVALUATION_HEADER = "Eval (автоматическая оценка соответствия ответа запросу):"
+
 class WhatsAppBot:
-    def __init__(self, account_sid: str, auth_token: str, phone_number: str, openai_api_key: str):
-        self.client = Client(account_sid, auth_token)
+    def __init__(self, account_sid: str, auth_token: str, phone_number: str, openai_api_key: str, num_candidates: int = 1, request_budget: float | None = 60.0,
+                 twilio_api_base: str = "https://api.twilio.com", messages_per_second: float = 1.0, outbox_path: str = "data/outbox.sqlite3",
+                 data_processor: "DataProcessor | None" = None, shared_snapshot_dir: str | None = None,
+                 query_profiler: "QueryProfiler | None" = None, admission_controller: "AdmissionController | None" = None,
+                 ack_threshold_seconds: float = 5.0, evaluation_followup: bool = True,
+                 reply_latency: RollingLatency | None = None):
+        self.account_sid = account_sid
+        self.auth_token = auth_token
         self.phone_number = phone_number
-        self.analytics_agent = AnalyticsAgent(openai_api_key)
-        self.answer_evaluator = AnswerEvaluator(openai_api_key)
+        self.openai_api_key = openai_api_key
+        self.num_candidates = num_candidates
+        self.request_budget = request_budget
+        self.twilio_api_base = twilio_api_base
+        self.messages_per_second = messages_per_second
+        self.outbox_path = outbox_path
+        self.shared_snapshot_dir = shared_snapshot_dir
+        self.query_profiler = query_profiler
+        self.admission_controller = admission_controller
+        self.ack_threshold_seconds = ack_threshold_seconds
+        self.evaluation_followup = evaluation_followup
+        self.reply_latency = reply_latency or RollingLatency()
+        self.conversations = ConversationStore()
+        
+        self._data_processor = data_processor
+        self._analytics_agent = None
+        self._answer_evaluator = None
+        self._outbound = None
+        self._init_lock = threading.RLock()
+    
+    def _get_or_create(self, attr: str, factory: Callable[[], Any]) -> Any:
+        # Двойная проверка: первые параллельные запросы не строят компонент дважды
+        value = getattr(self, attr)
+        if value is None:
+            with self._init_lock:
+                value = getattr(self, attr)
+                if value is None:
+                    started = time.monotonic()
+                    value = factory()
+                    setattr(self, attr, value)
+                    logger.info(f"Initialized {attr.lstrip('_')} in {time.monotonic() - started:.2f}s")
+        return value
+    
+    @property
+    def data_processor(self) -> "DataProcessor":
+        def create():
+            from .data_processor import DataProcessor
+            from .shared_snapshot import SharedSnapshotStore
+            store = SharedSnapshotStore(self.shared_snapshot_dir) if self.shared_snapshot_dir else None
+            return DataProcessor(snapshot_store=store, profiler=self.query_profiler, admission=self.admission_controller)
+        return self._get_or_create("_data_processor", create)
+    
+    @property
+    def analytics_agent(self) -> "AnalyticsAgent":
+        def create():
+            from .analytics_agent import AnalyticsAgent
+            return AnalyticsAgent(self.openai_api_key, num_candidates=self.num_candidates, data_processor=self.data_processor)
+        return self._get_or_create("_analytics_agent", create)
+    
+    @property
+    def answer_evaluator(self) -> "AnswerEvaluator":
+        def create():
+            from .answer_evaluator import AnswerEvaluator
+            from .reference_answers import ReferenceChecker
+            return AnswerEvaluator(self.openai_api_key, reference_checker=ReferenceChecker(self.data_processor))
+        return self._get_or_create("_answer_evaluator", create)
     
-    def handle_message(self, from_number: str, message_body: str) -> str:
+    @property
+    def outbound(self) -> "TwilioOutboundSender":
+        def create():
+            from .outbound_sender import TwilioOutboundSender
+            return TwilioOutboundSender(
+                self.account_sid, self.auth_token, self.phone_number,
+                base_url=self.twilio_api_base,
+                messages_per_second=self.messages_per_second,
+                outbox_path=self.outbox_path
+            )
+        return self._get_or_create("_outbound", create)
+    
+    def _initial_state(self, query: str, deadline: float | None) -> "AnalyticsState":
+        from .analytics_agent import AnalyticsState
+        return AnalyticsState(user_query=query, deadline=deadline)
+    
+    def warmup(self) -> Dict[str, float]:
+        """Строит все компоненты и прогревает кэши данных; возвращает время каждого шага в секундах"""
+        timings = {}
+        steps = [
+            ("data_snapshot", lambda: self.data_processor),
+            ("data_caches", lambda: (self.data_processor.get_regions(), self.data_processor.get_statuses(),
+                                     self.data_processor.get_data_schema(), self.data_processor.get_compact_schema())),
+            ("analytics_agent", lambda: self.analytics_agent),
+            ("answer_evaluator", lambda: self.answer_evaluator),
+            # Отправитель заодно дочищает outbox, оставшийся с прошлого запуска
+            ("outbound", lambda: self.outbound),
+        ]
+        for name, step in steps:
+            started = time.monotonic()
+            step()
+            timings[name] = round(time.monotonic() - started, 3)
+        return timings
+    
+    def is_ready(self) -> bool:
+        return all(component is not None for component in
+                   (self._data_processor, self._analytics_agent, self._answer_evaluator, self._outbound))
+    
+    def handle_message(self, from_number: str, message_body: str, is_cancelled: Callable[[], bool] | None = None,
+                       deliver: Callable[[str], None] | None = None) -> str | None:
+        """Ответ на сообщение; None, если is_cancelled() сработал до отправки ответа.
+
+        С deliver ответ уходит по частям: "считаю…", если прогноз времени для типа
+        запроса выше ack_threshold_seconds, сам ответ сразу после answer_formatter
+        и оценка отдельным сообщением. Тогда возвращается только оценка ("" без нее);
+        при evaluation_followup=False оценка не считается вовсе.
+        """
+        is_cancelled = is_cancelled or (lambda: False)
+        started = time.monotonic()
         try:
             logger.info(f"Received message from {from_number}: '{message_body[:100]}...'")
             
             if not message_body.strip():
                 return "Пожалуйста, задайте вопрос для аналитики данных."
             
-            # Получаем детальный результат через граф
-            initial_state = AnalyticsState(user_query=message_body)
-            logger.info(f"Invoking analytics graph for query: '{message_body[:50]}...'")
+            self.data_processor.refresh_snapshot()
             
-            final_state = self.analytics_agent.graph.invoke(initial_state)
+            if deliver is not None:
+                self._acknowledge_if_slow(from_number, message_body, deliver)
+            
+            # Общий бюджет на все LLM вызовы одного сообщения, включая оценку
+            deadline = deadline_after(self.request_budget)
+            question, params, final_state = self._answer_followup(from_number, message_body, deadline)
+            query = followup_query(question, params)
+            
+            if final_state is None:
+                if is_cancelled():
+                    return None
+                # Получаем детальный результат через граф
+                initial_state = self._initial_state(query, deadline)
+                logger.info(f"Invoking analytics graph for query: '{query[:50]}...'")
+                final_state = self.analytics_agent.graph.invoke(initial_state)
             
             logger.info(f"Graph execution completed. State keys: {list(final_state.keys())}")
             logger.info(f"requires_data_analysis: {final_state.get('requires_data_analysis')}")
@@ -41,56 +177,133 @@ class WhatsAppBot:
             logger.info(f"Answer generated: '{answer[:100]}...' (length: {len(answer)})")
             logger.info(f"Pandas code present: {bool(pandas_code)}")
             logger.info(f"Execution result present: {bool(execution_result)}")
+            if final_state.get('candidate_agreement') is not None:
+                logger.info(f"Candidate agreement: {final_state.get('candidate_agreement')}")
             
-            # Получаем оценку с полным контекстом
-            code_reasoning = final_state.get('code_reasoning', '')
-            answer_reasoning = final_state.get('answer_reasoning', '')
+            # Время до готового ответа без оценки - то, чего ждет пользователь
+            self.reply_latency.record(final_state.get('query_type') or DATA_LABEL, time.monotonic() - started)
             
-            logger.info("Starting answer evaluation...")
-            evaluation = self.answer_evaluator.evaluate_answer(
-                message_body, answer, pandas_code, str(execution_result), code_reasoning, answer_reasoning
-            )
+            if pandas_code and not final_state.get('execution_error'):
+                self.conversations.remember(from_number, question, pandas_code, params)
             
-            # Логируем и принтуем детальные результаты оценки
-            eval_log = f"Query: {message_body[:50]}..."
-            eval_log += f"\nCorrectness: {evaluation['correctness']}/5 - {evaluation['correctness_reasoning'][:100]}..."
-            eval_log += f"\nConciseness: {evaluation['conciseness']}/5 - {evaluation['conciseness_reasoning'][:100]}..."
-            eval_log += f"\nCode Quality: {evaluation['code_checker']}/5 - {evaluation['code_reasoning'][:100]}..."
-            eval_log += f"\nOverall: {evaluation['overall_score']}/5"
+            # Шаблонный ответ на small talk не оцениваем - это еще два вызова LLM
+            if final_state.get('query_type') in TEMPLATES:
+                if deliver is not None:
+                    deliver(answer)
+                    return ""
+                return answer
             
-            logger.info(f"Evaluation completed:\n{eval_log}")
+            if deliver is not None:
+                if is_cancelled():
+                    return None
+                deliver(answer)
+                # Оценку никто не увидит - незачем тратить на нее до трех вызовов LLM
+                if not self.evaluation_followup:
+                    return ""
+                try:
+                    evaluation_text = self._evaluation_text(query, message_body, answer, final_state, deadline, is_cancelled)
+                except Exception:
+                    # Ответ уже у пользователя: сбой оценки не должен прийти ему сообщением об ошибке
+                    logger.exception("Evaluation failed after the answer was delivered")
+                    return ""
+                # Отмена после отправки ответа отменяет только оценку, а не вопрос
+                return evaluation_text or ""
             
-            # Подготавливаем текст оценки для включения в основной ответ
-            evaluation_text_for_display = ""
-            if final_state.get('requires_data_analysis') and evaluation and evaluation.get('overall_score') is not None:
-                evaluation_text_for_display = f"\n\nEval (автоматическая оценка соответствия ответа запросу):\n{evaluation['evaluation_text']}"
+            evaluation_text = self._evaluation_text(query, message_body, answer, final_state, deadline, is_cancelled)
+            if evaluation_text is None:
+                return None
             
-            final_response_content = f"{answer}{evaluation_text_for_display}"
+            final_response_content = f"{answer}\n\n{evaluation_text}" if evaluation_text else answer
 
             logger.info(f"Final response content ready (length: {len(final_response_content)})")
             
             return final_response_content
             
-        except Exception as e:
+        except Exception:
+            # Отправка только ставит сообщения в outbox: 429 Twilio ретраит TwilioOutboundSender
             logger.exception("Error handling WhatsApp message")
-            error_message = "Произошла ошибка при обработке сообщения."
-            if isinstance(e, TwilioRestException) and e.status == 429:
-                error_message = "Извините, превышен лимит на количество сообщений Twilio Sandbox. Пожалуйста, попробуйте позже."
-            return error_message
+            return "Произошла ошибка при обработке сообщения."
+    
+    def _acknowledge_if_slow(self, from_number: str, message_body: str, deliver: Callable[[str], None]):
+        query_type = self._predict_query_type(from_number, message_body)
+        predicted = self.reply_latency.predict(query_type)
+        if query_type not in TEMPLATES and predicted >= self.ack_threshold_seconds:
+            logger.info(f"Predicted {predicted:.1f}s for {query_type} query, sending acknowledgement")
+            deliver(ACK_MESSAGE)
+    
+    def _predict_query_type(self, from_number: str, message_body: str) -> str:
+        """Тип запроса до запуска графа: уточнение, small talk или вопрос к данным"""
+        if self.conversations.get(from_number) is not None:
+            data_processor = self.data_processor
+            if parse_followup(message_body, data_processor.get_regions(), data_processor.get_statuses()):
+                return "followup"
+        classifier = self.analytics_agent.smalltalk_classifier
+        return classifier.route(message_body) if classifier is not None else DATA_LABEL
+    
+    def _evaluation_text(self, query: str, message_body: str, answer: str, final_state: Dict[str, Any],
+                         deadline: float | None, is_cancelled: Callable[[], bool]) -> str | None:
+        """Текст оценки для пользователя; "" - показывать нечего, None - вопрос отменен"""
+        # Получаем оценку с полным контекстом
+        code_reasoning = final_state.get('code_reasoning', '')
+        answer_reasoning = final_state.get('answer_reasoning', '')
+        
+        # Оценка - еще до трех вызовов LLM, для устаревшего вопроса они не нужны
+        if is_cancelled():
+            return None
+        
+        logger.info("Starting answer evaluation...")
+        evaluation = self.answer_evaluator.evaluate_answer(
+            query, answer, final_state.get('pandas_code', ''), str(final_state.get('execution_result', '')),
+            code_reasoning, answer_reasoning, deadline=deadline
+        )
+        
+        # Логируем и принтуем детальные результаты оценки
+        eval_log = f"Query: {message_body[:50]}..."
+        eval_log += f"\nCorrectness: {evaluation['correctness']}/5 - {evaluation['correctness_reasoning'][:100]}..."
+        eval_log += f"\nConciseness: {evaluation['conciseness']}/5 - {evaluation['conciseness_reasoning'][:100]}..."
+        eval_log += f"\nCode Quality: {evaluation['code_checker']}/5 - {evaluation['code_reasoning'][:100]}..."
+        eval_log += f"\nOverall: {evaluation['overall_score']}/5"
+        
+        logger.info(f"Evaluation completed:\n{eval_log}")
+        
+        # Подготавливаем текст оценки для показа пользователю
+        if final_state.get('requires_data_analysis') and evaluation and evaluation.get('overall_score') is not None:
+            return f"{EVALUATION_HEADER}\n{evaluation['evaluation_text']}"
+        return ""
+    
+    def _answer_followup(self, from_number: str, message_body: str, deadline: float | None) -> tuple:
+        """Уточнение к прошлому вопросу: подставляем параметры в прошлый код без генерации.
+
+        Возвращает (исходный вопрос, накопленные параметры уточнений, итоговое состояние или None).
+        """
+        previous = self.conversations.get(from_number)
+        if previous is None:
+            return message_body, {}, None
+        
+        data_processor = self.data_processor
+        regions, statuses = data_processor.get_regions(), data_processor.get_statuses()
+        slots = parse_followup(message_body, regions, statuses)
+        if not slots:
+            return message_body, {}, None
+        
+        # "а за май?" без прошлого вопроса не имеет смысла; цепочка уточнений сводится
+        # к исходному вопросу и последним значениям параметров
+        params = {**previous.params, **slots}
+        query = followup_query(previous.query, params)
+        code = rewrite_code(previous.pandas_code, slots, regions, statuses)
+        if code is None:
+            logger.info(f"Follow-up slots {slots} are ambiguous for previous code, regenerating")
+            return previous.query, params, None
+        
+        logger.info(f"Answering follow-up by substituting {slots} into previous code")
+        return previous.query, params, self.analytics_agent.answer_with_code(query, code, deadline)
     
     def send_message(self, to_number: str, message: str):
+        # Ответ уходит в персистентный outbox; доставка, лимиты и ретраи - в фоновом потоке
         try:
-            self.client.messages.create(
-                from_=f'whatsapp:{self.phone_number}',
-                body=message,
-                to=f'whatsapp:{to_number}'
-            )
-
-        except TwilioRestException as e:
-            logger.exception(f"Failed to send WhatsApp message: {e}")
-            raise e # Re-raise to be caught by handle_message
+            self.outbound.send(to_number, message)
         except Exception as e:
-            logger.exception(f"An unexpected error occurred while sending WhatsApp message: {e}")
+            logger.exception(f"Failed to enqueue WhatsApp message: {e}")
             raise e
     
     def create_webhook_response(self, message: str) -> str:
@@ -0,0 +1,120 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict
+
+
+def _value_from_schema(schema: Dict[str, Any], defs: Dict[str, Any]) -> Any:
+    if "$ref" in schema:
+        return _value_from_schema(defs[schema["$ref"].split("/")[-1]], defs)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        return _value_from_schema(options[0], defs) if options else None
+    if "default" in schema and schema["default"] is not None:
+        return schema["default"]
+    schema_type = schema.get("type")
+    if isinstance(schema_type, list):
+        schema_type = next((t for t in schema_type if t != "null"), None)
+    if schema_type == "object":
+        return {name: _value_from_schema(prop, defs) for name, prop in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return []
+    if schema_type == "integer":
+        return min(max(3, schema.get("minimum", 3)), schema.get("maximum", 3))
+    if schema_type == "number":
+        return 1.0
+    if schema_type == "boolean":
+        return False
+    return "fake"
+
+
+def content_from_request(request: Dict[str, Any]) -> str:
+    """Ответ, удовлетворяющий json_schema из response_format запроса"""
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"]["schema"]
+        return json.dumps(_value_from_schema(schema, schema.get("$defs", {})), ensure_ascii=False)
+    return "fake answer"
+
+
+class FakeOpenAIServer:
+    """Локальный OpenAI-совместимый сервер с настраиваемой задержкой и ошибками.
+
+    latency(n) возвращает задержку в секундах для n-го запроса, status(n) - HTTP
+    код ответа, responder(request) - content ответа модели.
+    """
+
+    def __init__(self, latency: Callable[[int], float] | float = 0.0, status: Callable[[int], int] | None = None,
+                 responder: Callable[[Dict[str, Any]], str] | None = None):
+        self.latency = latency if callable(latency) else (lambda n: latency)
+        self.status = status or (lambda n: 200)
+        self.responder = responder or content_from_request
+        self.requests = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                n = next(server._counter)
+                with server._lock:
+                    server.requests.append(body)
+                time.sleep(server.latency(n))
+
+                status = server.status(n)
+                if status != 200:
+                    payload = {"error": {"message": f"Injected error {status}", "type": "server_error"}}
+                else:
+                    payload = {
+                        "id": f"chatcmpl-fake-{n}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", "gpt-4o"),
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": server.responder(body), "refusal": None},
+                            "finish_reason": "stop"
+                        }],
+                        "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+                    }
+                data = json.dumps(payload, ensure_ascii=False).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Клиент уже ушел по таймауту
+                    pass
+
+        return Handler
+
+    def start(self) -> "FakeOpenAIServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,86 @@
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List
+from urllib.parse import parse_qs
+
+
+class FakeTwilioServer:
+    """Локальный Twilio Messages API: записывает сообщения, умеет отвечать 429/5xx.
+
+    status(n) - HTTP код для n-го запроса, latency(n) - задержка в секундах.
+    """
+
+    def __init__(self, status: Callable[[int], int] | None = None, latency: Callable[[int], float] | float = 0.0,
+                 retry_after: str | None = None):
+        self.status = status or (lambda n: 201)
+        self.latency = latency if callable(latency) else (lambda n: latency)
+        self.retry_after = retry_after
+        self.messages = []
+        # Время доставки по получателю: когда пользователь увидел первое сообщение
+        self.delivered_at: Dict[str, List[float]] = {}
+        self.attempts = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+                n = next(server._counter)
+                time.sleep(server.latency(n))
+                status = server.status(n)
+                with server._lock:
+                    server.attempts += 1
+                    if 200 <= status < 300:
+                        server.messages.append({key: values[0] for key, values in form.items()})
+                        server.delivered_at.setdefault(form.get("To", [""])[0], []).append(time.monotonic())
+
+                payload = {"sid": f"SM{n:032d}", "status": "queued"} if status < 300 else {"code": 20429, "message": "Too Many Requests"}
+                data = json.dumps(payload).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    if status == 429 and server.retry_after:
+                        self.send_header("Retry-After", server.retry_after)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Клиент уже ушел по таймауту
+                    pass
+
+        return Handler
+
+    def first_delivery(self, to: str, since: float) -> float | None:
+        """Момент первого сообщения получателю не раньше since (time.monotonic)"""
+        with self._lock:
+            return next((at for at in self.delivered_at.get(to, ()) if at >= since), None)
+
+    def start(self) -> "FakeTwilioServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeTwilioServer":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
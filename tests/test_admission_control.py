@@ -0,0 +1,124 @@
+import os
+import sys
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.admission_control import (AdmissionController, CostRecord, calibrate, is_rejection, load_cost_log,
+                                   rejection_message)
+from src.cost_estimator import estimate_cost
+from src.data_processor import DataProcessor
+
+TABLES = {"users_df": 100_000, "orders_df": 200_000}
+CHEAP = "result = len(orders_df)"
+HEAVY = "result = orders_df.merge(users_df, on='user_id')['order_amount'].sum()"
+CROSS = "result = len(users_df.merge(orders_df, how='cross'))"
+
+
+def test_query_over_budget_is_rejected_without_running(tmp_path):
+    controller = AdmissionController(heavy_threshold=1e6, max_cost=1e9, log_path=str(tmp_path / "costs.jsonl"))
+    calls = []
+    result, error = controller.execute(CROSS, TABLES, lambda: calls.append(1) or (1, None))
+    assert result is None and calls == []
+    assert is_rejection(error)
+    message = rejection_message(error)
+    assert "cross join" in message and "сузить вопрос" in message
+    assert controller.stats()["rejected"] == 1
+    controller.close()
+
+    records = list(load_cost_log(str(tmp_path / "costs.jsonl")))
+    assert [record.lane for record in records] == ["rejected"]
+    assert records[0].wall_seconds is None
+
+
+def test_defaults_cap_only_the_heavy_lane_and_log_per_worker(tmp_path):
+    controller = AdmissionController(log_path=str(tmp_path / "costs.jsonl"))
+    # Быстрая полоса не уже пула потоков anyio (40), иначе она сама становится очередью
+    assert controller.stats()["lanes"]["fast"]["concurrency"] == 40
+    assert controller.log_path == str(tmp_path / f"costs.{os.getpid()}.jsonl")
+    controller.execute(CHEAP, TABLES, lambda: (1, None))
+    controller.close()
+    assert os.path.exists(controller.log_path)
+    assert [record.lane for record in load_cost_log(str(tmp_path / "costs.jsonl"))] == ["fast"]
+
+
+def test_heavy_lane_does_not_block_fast_lane():
+    controller = AdmissionController(fast_concurrency=2, heavy_concurrency=1, heavy_threshold=1e6, log_path=None)
+    heavy_started, release = threading.Event(), threading.Event()
+
+    def heavy_run():
+        heavy_started.set()
+        release.wait(5)
+        return "heavy", None
+
+    heavy = threading.Thread(target=controller.execute, args=(HEAVY, TABLES, heavy_run))
+    heavy.start()
+    assert heavy_started.wait(5)
+    try:
+        started = time.perf_counter()
+        assert controller.execute(CHEAP, TABLES, lambda: ("fast", None)) == ("fast", None)
+        assert time.perf_counter() - started < 1
+        stats = controller.stats()["lanes"]
+        assert stats["heavy"]["active"] == 1 and stats["fast"]["admitted"] == 1
+    finally:
+        release.set()
+        heavy.join()
+
+
+def test_busy_heavy_lane_times_out_with_message():
+    controller = AdmissionController(heavy_concurrency=1, heavy_threshold=1e6, heavy_queue_timeout=0.1, log_path=None)
+    heavy_started, release = threading.Event(), threading.Event()
+
+    def heavy_run():
+        heavy_started.set()
+        release.wait(5)
+        return "heavy", None
+
+    heavy = threading.Thread(target=controller.execute, args=(HEAVY, TABLES, heavy_run))
+    heavy.start()
+    assert heavy_started.wait(5)
+    try:
+        result, error = controller.execute(HEAVY, TABLES, lambda: ("second", None))
+    finally:
+        release.set()
+        heavy.join()
+    assert result is None and is_rejection(error)
+    assert "Повторите вопрос позже" in rejection_message(error)
+    assert controller.stats()["lanes"]["heavy"]["timed_out"] == 1
+
+
+def test_calibration_suggests_thresholds_from_logged_timings():
+    records = [CostRecord(code_hash=str(i), lane="fast", estimated_cost=cost, reasons=[], tables=TABLES,
+                          queue_seconds=0.0, wall_seconds=cost * 1e-8, cpu_seconds=cost * 1e-8, error=None)
+               for i, cost in enumerate([1e4, 1e5, 1e6, 1e7])]
+    records.append(CostRecord(code_hash="rejected", lane="rejected", estimated_cost=1e12, reasons=[], tables=TABLES,
+                              queue_seconds=0.0, wall_seconds=None, cpu_seconds=None, error="QueryRejected: ..."))
+    report = calibrate(records, target_fast_seconds=0.1, max_seconds=30)
+    assert report["executions"] == 4
+    assert report["rank_correlation"] == 1.0
+    assert abs(report["suggested_heavy_threshold"] - 1e7) < 1
+    assert abs(report["suggested_max_cost"] - 3e9) < 1e3
+
+
+def test_data_processor_routes_full_data_executions(tmp_path):
+    log_path = str(tmp_path / "costs.jsonl")
+    per_user = "result = {u: orders_df[orders_df['user_id'] == u]['order_amount'].sum() for u in users_df['user_id']}"
+    processor = DataProcessor()
+    table_rows = {name: len(df) for name, df in processor._frames.items()}
+    # Лимит между дешевым запросом и циклом по пользователям на нынешних данных
+    max_cost = estimate_cost(per_user, table_rows).cost / 2
+    assert estimate_cost(CHEAP, table_rows).cost < max_cost
+    processor.admission = controller = AdmissionController(max_cost=max_cost, log_path=log_path)
+
+    result, error = processor.execute_pandas_query(CHEAP)
+    assert error is None and result == len(processor.orders_df)
+    result, error = processor.execute_pandas_query(per_user)
+    assert result is None and is_rejection(error)
+    # Прогоны оптимизатора на выборке мимо полос
+    processor.execute_on_sample(per_user)
+    controller.close()
+
+    records = list(load_cost_log(log_path))
+    assert [record.lane for record in records] == ["fast", "rejected"]
+    assert records[0].wall_seconds is not None
+    assert records[0].tables == table_rows
@@ -0,0 +1,109 @@
+import io
+import json
+import os
+import sys
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.batch_runner import load_completed, open_output, parse_questions, run_batch
+
+
+class StubAgent:
+    """Вместо AnalyticsAgent: считает вызовы и максимальное число одновременных вопросов"""
+
+    def __init__(self, delay: float = 0.0, fail_on: str | None = None):
+        self.delay = delay
+        self.fail_on = fail_on
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, question: str):
+        with self._lock:
+            self.calls.append(question)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            if question == self.fail_on:
+                raise RuntimeError("LLM недоступна")
+            return {"final_answer": f"Ответ: {question}", "query_type": "analytics", "pandas_code": "result = 1",
+                    "execution_result": 1, "token_usage": {"input_tokens": 100, "output_tokens": 20, "llm_calls": 2}}
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def _records(text: str):
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def test_parses_jsonl_strings_and_plain_lines():
+    lines = ['{"id": "a", "question": "Сколько заказов?"}', '"Выручка за июнь"', "", "Сколько  пользователей",
+             '{"query": "Средний чек"}', '{"id": "a", "question": "сколько заказов?"}']
+    questions = parse_questions(lines)
+    assert [q.question for q in questions] == ["Сколько заказов?", "Выручка за июнь", "Сколько  пользователей", "Средний чек"]
+    assert questions[0].id == "a"
+    # id без явного значения стабилен между запусками
+    assert parse_questions(["Выручка за июнь"])[0].id == questions[1].id
+
+
+def test_identical_questions_are_answered_once():
+    questions = parse_questions(['{"id": "1", "question": "Сколько заказов?"}',
+                                 '{"id": "2", "question": "  сколько   заказов? "}',
+                                 '{"id": "3", "question": "Выручка за июнь"}'])
+    agent, out = StubAgent(), io.StringIO()
+    summary = run_batch(questions, agent, out, concurrency=2)
+
+    assert sorted(agent.calls) == ["Выручка за июнь", "Сколько заказов?"]
+    records = {record["id"]: record for record in _records(out.getvalue())}
+    assert set(records) == {"1", "2", "3"}
+    assert records["2"]["deduplicated_from"] == "1"
+    assert records["2"]["answer"] == records["1"]["answer"]
+    assert summary["answered"] == 2 and summary["deduplicated"] == 1
+    assert summary["input_tokens"] == 200
+
+
+def test_concurrency_is_bounded():
+    questions = parse_questions([f"Вопрос {i}" for i in range(12)])
+    agent = StubAgent(delay=0.05)
+    started = time.perf_counter()
+    run_batch(questions, agent, io.StringIO(), concurrency=3)
+    assert agent.max_active == 3
+    assert time.perf_counter() - started < 12 * 0.05
+
+
+def test_resumes_after_interrupted_run(tmp_path):
+    output = str(tmp_path / "answers.jsonl")
+    questions = parse_questions([f"Вопрос {i}" for i in range(5)])
+
+    # Первый запуск успел записать два ответа, ошибку и половину третьей строки
+    with open(output, "w", encoding="utf-8") as f:
+        run_batch(questions[:3], StubAgent(fail_on="Вопрос 2"), f, concurrency=1)
+        f.write('{"id": "' + questions[3].id + '", "quest')
+
+    completed = load_completed(output, retry_errors=True)
+    assert set(completed) == {questions[0].id, questions[1].id}
+
+    agent = StubAgent()
+    with open_output(output) as out:
+        summary = run_batch(questions, agent, out, concurrency=2, completed=completed)
+    assert sorted(agent.calls) == ["Вопрос 2", "Вопрос 3", "Вопрос 4"]
+    assert summary["resumed"] == 2 and summary["errors"] == 0
+
+    final = load_completed(output, retry_errors=True)
+    assert set(final) == {q.id for q in questions}
+    assert all(record["status"] == "ok" for record in final.values())
+
+
+def test_errors_are_recorded_not_raised():
+    questions = parse_questions(["Сломанный вопрос", "Нормальный вопрос"])
+    out = io.StringIO()
+    summary = run_batch(questions, StubAgent(fail_on="Сломанный вопрос"), out, concurrency=2)
+    records = {record["question"]: record for record in _records(out.getvalue())}
+    assert records["Сломанный вопрос"]["status"] == "error"
+    assert "LLM недоступна" in records["Сломанный вопрос"]["error"]
+    assert records["Нормальный вопрос"]["status"] == "ok"
+    assert summary["errors"] == 1
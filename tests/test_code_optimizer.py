@@ -0,0 +1,112 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import pytest
+
+from src.code_optimizer import CodeOptimizer, apply_rule, optimize_code
+from src.data_processor import DataProcessor
+from src.speculative import result_fingerprint
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return DataProcessor()
+
+
+def _optimized(processor, code: str):
+    optimizer = CodeOptimizer(processor.execute_on_sample, processor.get_columns)
+    outcome = optimizer.optimize(code)
+    original, original_error = processor.execute_pandas_query(code)
+    optimized, optimized_error = processor.execute_pandas_query(outcome.code)
+    assert original_error is None and optimized_error is None
+    assert result_fingerprint(optimized) == result_fingerprint(original)
+    return optimizer, outcome
+
+
+def test_drops_redundant_to_datetime(processor):
+    code = ("orders_df['order_date'] = pd.to_datetime(orders_df['order_date'])\n"
+            "result = len(orders_df[pd.to_datetime(orders_df['order_date']) >= '2024-06-15'])")
+    _, outcome = _optimized(processor, code)
+    assert outcome.applied == ["redundant_to_datetime"]
+    assert outcome.code == "result = len(orders_df[orders_df['order_date'] >= '2024-06-15'])"
+
+
+def test_vectorizes_row_apply(processor):
+    code = ("orders_df['big'] = orders_df.apply(lambda r: r['order_amount'] > 5000 and r['status'] == 'completed', axis=1)\n"
+            "orders_df['month'] = orders_df['order_date'].apply(lambda d: d.month)\n"
+            "result = orders_df[orders_df['big']].groupby('month')['order_amount'].sum()")
+    _, outcome = _optimized(processor, code)
+    assert outcome.applied == ["vectorize_apply"]
+    assert "apply" not in outcome.code
+    assert "orders_df['order_date'].dt.month" in outcome.code
+
+
+def test_vectorizes_iterrows_accumulation(processor):
+    code = ("total = 0\ncount = 0\n"
+            "for _, row in orders_df.iterrows():\n"
+            "    if row['status'] == 'completed' and row['order_amount'] > 1000:\n"
+            "        total += row['order_amount']\n"
+            "        count += 1\n"
+            "result = total / count")
+    _, outcome = _optimized(processor, code)
+    assert "vectorize_iterrows" in outcome.applied
+    assert "iterrows" not in outcome.code
+
+
+def test_keeps_loop_when_row_is_used_after_it():
+    code = ("total = 0\n"
+            "for _, row in orders_df.iterrows():\n"
+            "    total += row['order_amount']\n"
+            "result = (total, row['order_id'])")
+    assert apply_rule(code, "vectorize_iterrows", {}) is None
+
+
+def test_filters_before_merge(processor):
+    code = ("merged = users_df.merge(orders_df, on='user_id')\n"
+            "merged = merged[(merged['region'] == 'Москва') & (merged['status'] == 'completed') "
+            "& (merged['order_date'] > merged['registration_date'])]\n"
+            "result = merged['order_amount'].sum()")
+    _, outcome = _optimized(processor, code)
+    assert outcome.applied == ["filter_before_merge"]
+    assert ("users_df[users_df['region'] == 'Москва'].merge(orders_df[orders_df['status'] == 'completed'], on='user_id')"
+            in outcome.code)
+    assert "merged = merged[merged['order_date'] > merged['registration_date']]" in outcome.code
+
+
+def test_does_not_filter_merge_still_used_unfiltered(processor):
+    code = ("merged = users_df.merge(orders_df, on='user_id')\n"
+            "completed = merged[merged['status'] == 'completed']\n"
+            "result = len(completed) / len(merged)")
+    assert apply_rule(code, "filter_before_merge", processor.get_columns()) is None
+
+
+def test_hoists_repeated_masks_only_while_frame_is_unchanged():
+    code = ("revenue = orders_df[orders_df['status'] == 'completed']['order_amount'].sum()\n"
+            "buyers = orders_df[orders_df['status'] == 'completed']['user_id'].nunique()\n"
+            "result = revenue / buyers")
+    optimized, applied = optimize_code(code, {})
+    assert applied == ["hoist_repeated_masks"]
+    assert optimized.startswith("mask_1 = orders_df['status'] == 'completed'\n")
+
+    mutated = code.replace("buyers =", "orders_df['status'] = 'completed'\nbuyers =")
+    assert apply_rule(mutated, "hoist_repeated_masks", {}) is None
+
+
+def test_rejects_rule_that_changes_result_on_sample(processor):
+    # Первый вызов - исходный код, второй - переписанный, и он дает другой результат
+    results = iter([(1, None), (2, None)])
+    optimizer = CodeOptimizer(lambda code: next(results), processor.get_columns)
+    outcome = optimizer.optimize("result = orders_df['order_date'].apply(lambda d: d.month).sum()")
+    assert outcome.applied == []
+    assert outcome.rejected == ["vectorize_apply"]
+    assert outcome.code == "result = orders_df['order_date'].apply(lambda d: d.month).sum()"
+    assert optimizer.stats()["rules"]["vectorize_apply"]["mismatched"] == 1
+
+
+def test_decisions_are_cached(processor):
+    optimizer, _ = _optimized(processor, "result = orders_df['order_amount'].apply(lambda x: x * 2).sum()")
+    optimizer.optimize("result = orders_df['order_amount'].apply(lambda x: x * 2).sum()")
+    stats = optimizer.stats()
+    assert stats["cache_hits"] == 1
+    assert stats["rules"]["vectorize_apply"]["applied"] == 1
@@ -0,0 +1,73 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.code_repair import CodeRepairer, classify_error, local_fix_candidates
+from src.data_processor import DataProcessor
+
+
+def _repair(code: str):
+    processor = DataProcessor()
+    result, error = processor.execute_pandas_query(code)
+    assert error is not None
+    repairer = CodeRepairer(processor.execute_pandas_query)
+    return repairer, repairer.repair_locally(code, error), error
+
+
+def test_classify_error():
+    assert classify_error("TypeError: '>=' not supported between instances of 'Timestamp' and 'str'") == "datetime_comparison"
+    assert classify_error("AttributeError: 'Timestamp' object has no attribute 'dt'") == "dt_accessor"
+    assert classify_error("NameError: name 'result' is not defined") == "missing_result"
+    assert classify_error("ValueError: The truth value of a Series is ambiguous.") == "series_truth"
+    assert classify_error("KeyError: 'amount'") == "other"
+
+
+def test_repairs_date_comparison():
+    code = "june = orders_df[orders_df['order_date'].dt.date >= '2024-06-15']\nresult = len(june)"
+    repairer, repair, _ = _repair(code)
+    assert repair is not None
+    assert repair.error_class == "datetime_comparison"
+    assert "pd.Timestamp('2024-06-15')" in repair.code
+    assert repair.result > 0
+    assert repairer.stats()["datetime_comparison"]["llm_calls_saved"] == 1
+
+
+def test_repairs_dt_on_timestamp():
+    code = "result = orders_df['order_date'].apply(lambda d: d.dt.month).nunique()"
+    _, repair, _ = _repair(code)
+    assert repair is not None
+    assert repair.result == 1
+
+
+def test_repairs_series_truth_value():
+    code = "result = len(orders_df[(orders_df['status'] == 'completed') and (orders_df['order_amount'] > 5000)])"
+    _, repair, _ = _repair(code)
+    assert repair is not None
+    assert "&" in repair.code
+
+
+def test_series_truth_keeps_python_not_on_bools():
+    code = ("completed = orders_df[orders_df['status'] == 'completed']\n"
+            "if not completed.empty:\n"
+            "    result = len(orders_df[not orders_df['status'] == 'completed'])")
+    candidates = local_fix_candidates(code, "ValueError: The truth value of a Series is ambiguous.")
+    assert len(candidates) == 1
+    assert "if not completed.empty:" in candidates[0]
+    assert "~orders_df['status'] == 'completed'" not in candidates[0]
+    assert "~(orders_df['status'] == 'completed')" in candidates[0]
+
+
+def test_repairs_missing_result():
+    candidates = local_fix_candidates("total = orders_df['order_amount'].sum()", "NameError: name 'result' is not defined")
+    assert candidates == ["total = orders_df['order_amount'].sum()\nresult = total"]
+
+
+def test_unknown_error_falls_through_to_llm():
+    repairer, repair, error = _repair("result = orders_df['amount'].sum()")
+    assert repair is None
+    assert classify_error(error) == "other"
+    repairer.record_llm_repair("other", success=True)
+    stats = repairer.stats()["other"]
+    assert stats["failures"] == 1
+    assert stats["llm_fixed"] == 1
+    assert stats["llm_calls_saved"] == 0
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.whatsapp_bot import WhatsAppBot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["langgraph", "langchain_core", "langchain_openai", "openai", "pandas", "requests"]
+
+
+def test_importing_app_does_not_load_heavy_dependencies():
+    script = (
+        "import sys, app; "
+        "bot = app.get_bot(); "
+        f"print([name for name in {HEAVY_MODULES!r} if name in sys.modules]); "
+        "print(bot.is_ready())"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True,
+                            env={**os.environ, "WARMUP_ON_STARTUP": "false"})
+    assert result.returncode == 0, result.stderr
+    loaded, ready = result.stdout.strip().splitlines()[-2:]
+    assert loaded == "[]"
+    assert ready == "False"
+
+
+def test_data_processor_is_built_once_under_concurrent_access(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    bot = WhatsAppBot("AC123", "token", "+10000000000", "sk-test")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(bot.data_processor)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(processor) for processor in results}) == 1
+    # Справочники считаются один раз и сбрасываются только вместе со снапшотом
+    assert bot.data_processor.get_regions() is bot.data_processor.get_regions()
+
+
+def test_handle_message_builds_graph_state_without_eager_imports(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    bot = WhatsAppBot("AC123", "token", "+10000000000", "sk-test", request_budget=None)
+    states = []
+
+    class FakeGraph:
+        def invoke(self, state):
+            states.append(state)
+            return {"query_type": "greeting", "final_answer": "Привет!"}
+
+    bot._analytics_agent = type("FakeAgent", (), {"graph": FakeGraph()})()
+
+    assert bot.handle_message("whatsapp:+1", "Привет") == "Привет!"
+    assert type(states[0]).__name__ == "AnalyticsState"
+    assert states[0].user_query == "Привет"
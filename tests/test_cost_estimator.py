@@ -0,0 +1,56 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.cost_estimator import estimate_cost
+
+TABLES = {"users_df": 100_000, "orders_df": 200_000}
+
+COUNT = "result = len(orders_df[orders_df['status'] == 'completed'])"
+GROUPBY = "result = orders_df.groupby('status')['order_amount'].sum()"
+MERGE = """merged = orders_df.merge(users_df, on='user_id')
+result = merged.groupby('region')['order_amount'].sum()"""
+APPLY = "result = orders_df['order_amount'].apply(lambda x: x * 1.2).sum()"
+ITERROWS = """total = 0
+for _, row in orders_df.iterrows():
+    total += row['order_amount']
+result = total"""
+PER_USER = """totals = {}
+for user_id in users_df['user_id']:
+    totals[user_id] = orders_df[orders_df['user_id'] == user_id]['order_amount'].sum()
+result = totals"""
+CROSS = """pairs = users_df.merge(orders_df, how='cross')
+result = len(pairs[pairs['user_id_x'] == pairs['user_id_y']])"""
+
+
+def test_vectorized_queries_are_cheaper_than_python_loops():
+    costs = {name: estimate_cost(code, TABLES).cost for name, code in
+             [("count", COUNT), ("groupby", GROUPBY), ("merge", MERGE), ("apply", APPLY),
+              ("iterrows", ITERROWS), ("per_user", PER_USER)]}
+    assert costs["count"] < costs["merge"] < costs["apply"] < costs["iterrows"] < costs["per_user"]
+    assert costs["groupby"] < costs["apply"]
+
+
+def test_cross_join_costs_product_of_table_sizes():
+    estimate = estimate_cost(CROSS, TABLES)
+    assert estimate.cost >= TABLES["users_df"] * TABLES["orders_df"]
+    assert "cross join" in estimate.reasons[0]
+    assert estimate.tables == TABLES
+
+
+def test_loop_body_is_multiplied_by_iterations():
+    # Фильтр заказов на каждого пользователя: users x orders
+    estimate = estimate_cost(PER_USER, TABLES)
+    assert estimate.cost >= TABLES["users_df"] * TABLES["orders_df"]
+    assert any("в цикле" in reason for reason in estimate.reasons)
+
+
+def test_cost_grows_with_table_size():
+    small = estimate_cost(MERGE, TABLES).cost
+    large = estimate_cost(MERGE, {name: rows * 100 for name, rows in TABLES.items()}).cost
+    assert large > small * 50
+
+
+def test_syntax_error_costs_nothing():
+    estimate = estimate_cost("result = orders_df[", TABLES)
+    assert estimate.cost == 0
@@ -0,0 +1,21 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from langchain.smith.evaluation.runner_utils import _load_run_evaluators
+from langsmith.schemas import DataType
+
+import src.evaluator
+from src.evaluator import AnswerEvaluator
+
+RUN_OUTPUTS = ["answer", "code_reasoning", "answer_reasoning", "pandas_code", "execution_result", "data_schema", "success"]
+
+
+def test_evaluation_config_builds_evaluators_offline(monkeypatch):
+    # run_on_dataset строит оценщики до первого примера: здесь то же самое, без сети
+    monkeypatch.setattr(src.evaluator, "Client", lambda api_key=None: None)
+    evaluator = AnswerEvaluator("sk-test", langsmith_api_key="ls-test")
+    evaluators = _load_run_evaluators(evaluator.evaluation_config(), "chain", DataType.kv,
+                                      None, ["input"], RUN_OUTPUTS)
+    assert len(evaluators) == 2
+    assert evaluators[-1].func.__name__ == "correctness"
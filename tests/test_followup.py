@@ -0,0 +1,76 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.data_processor import DataProcessor
+from src.followup import ConversationStore, followup_query, parse_followup, rewrite_code
+from src.ttl_cache import TTLCache
+
+REGIONS = ["Екатеринбург", "Казань", "Москва", "Новосибирск", "Санкт-Петербург"]
+STATUSES = ["canceled", "completed", "pending"]
+
+JUNE_REVENUE = """june = orders_df[(orders_df['order_date'] >= '2024-06-01') & (orders_df['order_date'] <= '2024-06-30')]
+result = june[june['status'] == 'completed']['order_amount'].sum()"""
+
+
+def test_parse_followup_slots():
+    assert parse_followup("а за май?", REGIONS, STATUSES) == {"month": 5}
+    assert parse_followup("А только для Москвы?", REGIONS, STATUSES) == {"region": "Москва"}
+    assert parse_followup("а для Санкт-Петербурга за июль 2024", REGIONS, STATUSES) == {
+        "region": "Санкт-Петербург", "month": 7, "year": 2024
+    }
+    assert parse_followup("а отмененных?", REGIONS, STATUSES) == {"status": "canceled"}
+
+
+def test_parse_followup_rejects_new_questions():
+    assert parse_followup("сколько заказов в мае?", REGIONS, STATUSES) is None
+    assert parse_followup("а какой средний чек?", REGIONS, STATUSES) is None
+    assert parse_followup("а за май и июнь?", REGIONS, STATUSES) is None
+
+
+def test_rewrite_month_keeps_month_end():
+    code = rewrite_code(JUNE_REVENUE, {"month": 5}, REGIONS, STATUSES)
+    assert "'2024-05-01'" in code and "'2024-05-31'" in code
+
+    processor = DataProcessor()
+    result, error = processor.execute_pandas_query(code)
+    assert error is None
+    assert result == 0
+
+
+def test_rewrite_status_and_month_number():
+    code = "result = len(orders_df[(orders_df['order_date'].dt.month == 6) & (orders_df['status'] == 'completed')])"
+    rewritten = rewrite_code(code, {"status": "canceled", "month": 7}, REGIONS, STATUSES)
+    assert "== 7" in rewritten and "'canceled'" in rewritten
+
+
+def test_ambiguous_substitutions_are_refused():
+    two_months = "result = orders_df[(orders_df['order_date'] >= '2024-05-01') & (orders_df['order_date'] < '2024-07-01')]"
+    assert rewrite_code(two_months, {"month": 6}, REGIONS, STATUSES) is None
+    # Региона в прошлом коде нет - подставлять некуда
+    assert rewrite_code(JUNE_REVENUE, {"region": "Москва"}, REGIONS, STATUSES) is None
+
+
+def test_conversation_store_expires_turns():
+    now = [0.0]
+    store = ConversationStore(ttl_seconds=60, clock=lambda: now[0])
+    store.remember("whatsapp:+1", "выручка за июнь", JUNE_REVENUE, {"month": 5})
+    assert store.get("whatsapp:+1").params == {"month": 5}
+    now[0] = 61
+    assert store.get("whatsapp:+1") is None
+
+
+def test_followup_query_keeps_original_question_and_latest_params():
+    assert followup_query("выручка за июнь", {}) == "выручка за июнь"
+    assert followup_query("выручка за июнь", {"status": "canceled", "month": 5, "region": "Москва"}) == (
+        "выручка за июнь\nУточнение: месяц - май, регион - Москва, статус - canceled"
+    )
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "a" in cache and "c" in cache and "b" not in cache
@@ -0,0 +1,203 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import pandas as pd
+import pytest
+
+import src.data_processor as data_processor_module
+from src.data_processor import DataProcessor
+from src.ingest import AppendableTable, IngestError, coerce_rows
+from src.shared_snapshot import SharedSnapshotStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def ingest_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    files = {'users_df': str(tmp_path / "ingested_users.csv"), 'orders_df': str(tmp_path / "ingested_orders.csv")}
+    monkeypatch.setattr(data_processor_module, "INGEST_FILES", files)
+    return files
+
+
+def _user(user_id: int, region: str = "Сочи") -> dict:
+    return {"user_id": user_id, "region": region, "registration_date": "2024-07-01", "is_active": True,
+            "last_login_date": None}
+
+
+def _order(order_id: int, user_id: int = 1, amount: int = 1000, status: str = "completed") -> dict:
+    return {"order_id": order_id, "user_id": user_id, "order_date": "2024-07-01T12:30:00",
+            "order_amount": amount, "status": status}
+
+
+def test_rejects_invalid_batch_with_row_errors():
+    reference = DataProcessor().orders_df
+    rows = [_order(9001), {**_order(9002), "order_date": "вчера", "order_amount": 10.5, "extra": 1},
+            {**_order(9003), "status": None}]
+    with pytest.raises(IngestError) as error:
+        coerce_rows('orders_df', rows, reference)
+    problems = {(item["row"], item["column"]) for item in error.value.errors}
+    assert problems == {(1, "extra"), (2, "status")}
+
+    with pytest.raises(IngestError) as error:
+        coerce_rows('orders_df', [_order(9001), {**_order(9002), "order_date": "вчера", "order_amount": 10.5}], reference)
+    assert {(item["row"], item["column"]) for item in error.value.errors} == {(1, "order_date"), (1, "order_amount")}
+
+    with pytest.raises(IngestError) as error:
+        coerce_rows('orders_df', [_order(9001, amount=-1), _order(9001, status="done")], reference)
+    assert {(item["row"], item["column"]) for item in error.value.errors} == {(1, "order_id"), (0, "order_amount"), (1, "status")}
+
+
+def test_coerces_rows_to_reference_types():
+    reference = DataProcessor().orders_df
+    typed = coerce_rows('orders_df', [_order(9001, amount=1200.0)], reference)
+    assert typed.dtypes.to_dict() == reference.dtypes.to_dict()
+    assert typed['order_date'].iloc[0] == pd.Timestamp("2024-07-01 12:30:00")
+
+
+def test_appendable_table_keeps_issued_frames_unchanged():
+    table = AppendableTable(pd.DataFrame({"id": [1, 2], "region": ["Москва", "Казань"]}))
+    before = table.frame()
+    for start in range(3, 3000, 100):
+        ids = list(range(start, start + 100))
+        table.append(pd.DataFrame({"id": ids, "region": [f"Город {i % 300}" for i in ids]}))
+    after = table.frame()
+
+    assert before["id"].tolist() == [1, 2]
+    assert before["region"].tolist() == ["Москва", "Казань"]
+    assert len(after) == 3002
+    assert after["region"].iloc[-1] == "Город 2"
+    assert after["region"].dtype == object
+    assert after["region"].iloc[1] == "Казань"
+    with pytest.raises(ValueError):
+        after["id"].to_numpy()[0] = 0
+
+
+def test_string_dtype_columns_are_treated_as_strings():
+    reference = DataProcessor().users_df.astype({"region": "string"})
+    typed = coerce_rows('users_df', [_user(1000)], reference)
+    assert typed['region'].tolist() == ["Сочи"]
+
+    table = AppendableTable(pd.DataFrame({"id": [1], "region": pd.array(["Москва"], dtype="string")}))
+    table.append(pd.DataFrame({"id": [2], "region": pd.array(["Казань"], dtype="string")}))
+    assert table.frame()["region"].tolist() == ["Москва", "Казань"]
+
+
+def test_ingest_appends_without_touching_running_queries(ingest_files):
+    processor = DataProcessor()
+    frames_before = processor._frames
+    orders_before = len(processor.orders_df)
+
+    result = processor.ingest({'users_df': [_user(1000)], 'orders_df': [_order(9001, user_id=1000), _order(1001, user_id=129)]})
+    assert result["tables"] == {'users_df': {"accepted": 1, "duplicates": 0}, 'orders_df': {"accepted": 1, "duplicates": 1}}
+    assert len(frames_before['orders_df']) == orders_before
+    assert len(processor.orders_df) == orders_before + 1
+
+    revenue, error = processor.execute_pandas_query(
+        "result = orders_df.merge(users_df, on='user_id').query(\"region == 'Сочи'\")['order_amount'].sum()")
+    assert (revenue, error) == (1000, None)
+    assert "Сочи" in processor.get_regions()
+
+    # Повтор того же пакета ничего не меняет
+    assert processor.ingest({'orders_df': [_order(9001, user_id=1000)]})["rows"] == 0
+
+
+def test_ingest_keeps_query_results_and_schema_of_untouched_data(ingest_files):
+    processor = DataProcessor()
+    code = "result = orders_df[orders_df['status'] == 'completed'].groupby('status')['order_amount'].sum().to_dict()"
+    before, schema = processor.execute_pandas_query(code), processor.get_data_schema()
+    processor.ingest({'orders_df': [_order(9001, user_id=129, status="canceled")]})
+
+    assert processor.execute_pandas_query(code) == before
+    assert list(before[0]) == ["completed"]
+    assert processor.get_compact_schema() == DataProcessor().get_compact_schema()
+    assert "category" not in processor.get_data_schema() and "category" not in schema
+
+
+def test_rejected_batch_changes_nothing(ingest_files):
+    processor = DataProcessor()
+    users_before = len(processor.users_df)
+    with pytest.raises(IngestError):
+        processor.ingest({'users_df': [_user(1000)], 'orders_df': [_order(9001, user_id=424242)]})
+    assert len(processor.users_df) == users_before
+    assert not os.path.exists(ingest_files['users_df'])
+
+
+def test_ingested_rows_survive_restart(ingest_files):
+    DataProcessor().ingest({'users_df': [_user(1000)], 'orders_df': [_order(9001, user_id=1000)]})
+    DataProcessor().ingest({'orders_df': [_order(9002, user_id=1000, status="pending")]})
+    restarted = DataProcessor()
+    assert restarted.orders_df['order_id'].tolist()[-2:] == [9001, 9002]
+    assert restarted.orders_df['order_date'].iloc[-1] == pd.Timestamp("2024-07-01 12:30:00")
+    assert restarted.users_df['last_login_date'].isna().iloc[-1]
+
+
+def test_workers_without_shared_snapshot_share_the_journal(ingest_files):
+    # Два воркера --workers 2 без SHARED_SNAPSHOT_DIR: общий у них только журнал ingest
+    first, second = DataProcessor(), DataProcessor()
+    batch = {'users_df': [_user(1000)], 'orders_df': [_order(9001, user_id=1000)]}
+    assert first.ingest(batch)["rows"] == 2
+
+    # Ретрай того же пакета пришел на другой воркер
+    retried = second.ingest(batch)
+    assert retried["rows"] == 0
+    assert retried["tables"]["orders_df"] == {"accepted": 0, "duplicates": 1}
+
+    second.ingest({'orders_df': [_order(9002, user_id=1000)]})
+    assert first.refresh_snapshot()
+    assert not first.refresh_snapshot()
+    assert first.orders_df['order_id'].tolist()[-2:] == second.orders_df['order_id'].tolist()[-2:] == [9001, 9002]
+
+    assert pd.read_csv(ingest_files['orders_df'])['order_id'].tolist() == [9001, 9002]
+    assert DataProcessor().orders_df['order_id'].tolist()[-3:] == [first.orders_df['order_id'].iloc[-3], 9001, 9002]
+
+
+def test_shared_snapshot_appends_in_place_and_other_workers_refresh(tmp_path):
+    store_dir = str(tmp_path / "snapshot")
+    writer = DataProcessor(snapshot_store=SharedSnapshotStore(store_dir))
+    reader = DataProcessor(snapshot_store=SharedSnapshotStore(store_dir))
+    reader_frames = reader._frames
+
+    writer.ingest({'users_df': [_user(1000)], 'orders_df': [_order(9001, user_id=1000)]})
+    # Строки дописаны в файлы того же поколения, новое поколение не создавалось
+    assert sorted(name for name in os.listdir(store_dir) if name.startswith("g")) == ["g1"]
+    assert len(reader_frames['orders_df']) == 200
+
+    assert reader.refresh_snapshot()
+    assert reader.orders_df['order_id'].iloc[-1] == 9001
+    assert reader.users_df['region'].iloc[-1] == "Сочи"
+    assert len(reader_frames['orders_df']) == 200
+
+    # Емкости не хватило - таблицы переписаны в новое поколение, данные те же
+    many = [_order(10000 + i, user_id=1000) for i in range(2000)]
+    writer.ingest({'orders_df': many})
+    assert reader.refresh_snapshot()
+    assert len(reader.orders_df) == 2201
+    assert "g2" in os.listdir(store_dir)
+
+
+def test_ingest_endpoint_requires_token_and_reports_errors(monkeypatch):
+    from fastapi.testclient import TestClient
+    import app as app_module
+    from src.whatsapp_bot import WhatsAppBot
+
+    bot = WhatsAppBot("AC123", "token", "+10000000000", "sk-test", data_processor=DataProcessor())
+    monkeypatch.setattr(app_module, "_bot", bot)
+    monkeypatch.setenv("WARMUP_ON_STARTUP", "false")
+    client = TestClient(app_module.app)
+
+    monkeypatch.delenv("INGEST_TOKEN", raising=False)
+    assert client.post("/ingest", json={"orders": [_order(9001)]}).status_code == 404
+
+    monkeypatch.setenv("INGEST_TOKEN", "secret")
+    assert client.post("/ingest", json={"orders": [_order(9001)]}, headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    headers = {"Authorization": "Bearer secret"}
+    response = client.post("/ingest", json={"users": [_user(1000)], "orders": [_order(9001, user_id=1000)]}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["rows"] == 2
+
+    response = client.post("/ingest", json={"orders": [{**_order(9002), "status": "lost"}]}, headers=headers)
+    assert response.status_code == 422
+    assert response.json()["errors"][0]["column"] == "status"
@@ -0,0 +1,136 @@
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from openai import OpenAI
+
+from src.llm_resilience import CircuitBreaker, LLMCallTimeout, ResilientCaller, deadline_after
+from tests.fake_openai_server import FakeOpenAIServer
+
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "evaluation_result",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "score": {"type": "integer", "minimum": 1, "maximum": 5},
+                "reasoning": {"type": "string"}
+            },
+            "required": ["score", "reasoning"],
+            "additionalProperties": False
+        }
+    }
+}
+
+
+def _judge(client: OpenAI, model: str = "gpt-4o"):
+    response = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": "Оцени от 1 до 5"}],
+        response_format=RESPONSE_FORMAT
+    )
+    return json.loads(response.choices[0].message.content)
+
+
+def test_hedged_request_beats_slow_primary():
+    # Первый вызов ждет, пока его не отпустят; дубликат отвечает сразу. Медленным
+    # назначается именно вызов, а не первый пришедший на сервер запрос
+    release = threading.Event()
+    attempts = itertools.count()
+
+    def judge():
+        if next(attempts) == 0:
+            release.wait(5.0)
+        return _judge(client)
+
+    with FakeOpenAIServer() as server:
+        client = OpenAI(api_key="test", base_url=server.base_url, max_retries=0)
+        caller = ResilientCaller("judge", default_hedge_delay=0.1, call_timeout=5.0)
+        # Первый запрос клиента открывает соединение и может идти дольше хеджа
+        _judge(client)
+        try:
+            started = time.monotonic()
+            result = caller.call(judge)
+            elapsed = time.monotonic() - started
+        finally:
+            release.set()
+
+        assert result["score"] == 3
+        assert elapsed < 1.0
+        assert caller.stats()["hedges"] == 1
+        assert caller.stats()["hedge_wins"] == 1
+        assert caller.stats()["abandoned"] == 1
+
+
+def test_deadline_falls_back_to_cheaper_model():
+    with FakeOpenAIServer(latency=lambda n: 1.0) as slow, FakeOpenAIServer() as fast:
+        primary = OpenAI(api_key="test", base_url=slow.base_url, max_retries=0)
+        fallback = OpenAI(api_key="test", base_url=fast.base_url, max_retries=0)
+        caller = ResilientCaller("judge", default_hedge_delay=None, max_attempts=1)
+
+        result = caller.call(lambda: _judge(primary), fallback=lambda: _judge(fallback, "gpt-4o-mini"),
+                             deadline=deadline_after(0.2))
+
+        assert result["score"] == 3
+        assert fast.requests[0]["model"] == "gpt-4o-mini"
+        assert caller.stats()["timeouts"] == 1
+        assert caller.stats()["fallbacks"] == 1
+
+
+def test_retries_server_errors_with_jitter():
+    with FakeOpenAIServer(status=lambda n: 500 if n == 0 else 200) as server:
+        client = OpenAI(api_key="test", base_url=server.base_url, max_retries=0)
+        caller = ResilientCaller("judge", default_hedge_delay=None, backoff_base=0.01)
+
+        assert caller.call(lambda: _judge(client))["score"] == 3
+        assert caller.stats()["retries"] == 1
+        assert len(server.requests) == 2
+
+
+def test_open_circuit_skips_primary():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    caller = ResilientCaller("formatter", breaker=breaker, default_hedge_delay=None, max_attempts=1)
+    calls = []
+
+    def failing():
+        calls.append(1)
+        raise RuntimeError("upstream down")
+
+    for _ in range(2):
+        assert caller.call(failing, fallback=lambda: "local") == "local"
+    assert breaker.state == "open"
+
+    assert caller.call(failing, fallback=lambda: "local") == "local"
+    assert len(calls) == 2
+
+
+def test_timeout_without_fallback_raises():
+    caller = ResilientCaller("formatter", default_hedge_delay=None, max_attempts=1, call_timeout=0.05)
+    try:
+        caller.call(lambda: time.sleep(0.5))
+    except LLMCallTimeout:
+        pass
+    else:
+        raise AssertionError("expected LLMCallTimeout")
+
+
+def test_fallback_is_bounded_after_budget_is_spent():
+    caller = ResilientCaller("formatter", default_hedge_delay=None, max_attempts=1, fallback_timeout=0.1)
+    release = threading.Event()
+    started = time.monotonic()
+    try:
+        caller.call(lambda: time.sleep(0.5), fallback=lambda: release.wait(5.0), deadline=deadline_after(0.05))
+    except LLMCallTimeout:
+        pass
+    else:
+        raise AssertionError("expected LLMCallTimeout")
+    finally:
+        release.set()
+
+    assert time.monotonic() - started < 0.5
+    assert caller.stats()["fallbacks"] == 1
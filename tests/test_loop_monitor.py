@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.loop_monitor import EventLoopLagMonitor
+
+
+def test_blocking_call_shows_up_as_loop_lag():
+    monitor = EventLoopLagMonitor(interval=0.01)
+
+    async def main():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        quiet = monitor.stats()
+        # Синхронный код в async обработчике держит loop целиком
+        time.sleep(0.3)
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+        return quiet
+
+    quiet = asyncio.run(main())
+    assert quiet["samples"] > 0 and quiet["window_max_ms"] < 200
+    stats = monitor.stats()
+    assert stats["window_max_ms"] >= 250
+    assert stats["max_ms"] >= 250
+    assert stats["p50_ms"] < 200
+
+
+def test_stats_window_only_counts_recent_samples():
+    monitor = EventLoopLagMonitor(interval=0.01)
+    monitor._samples.append((time.monotonic() - 60, 1.0))
+    monitor._samples.append((time.monotonic(), 0.002))
+    assert monitor.stats()["window_max_ms"] == 1000
+    assert monitor.stats(seconds=5)["window_max_ms"] == 2
+    assert monitor.stats(seconds=5)["samples"] == 1
+
+
+def test_loop_stats_endpoint(monkeypatch):
+    from fastapi.testclient import TestClient
+    import app as app_module
+
+    monkeypatch.setenv("WARMUP_ON_STARTUP", "false")
+    monkeypatch.setenv("THREADPOOL_SIZE", "8")
+    with TestClient(app_module.app) as client:
+        time.sleep(0.3)
+        stats = client.get("/stats/loop", params={"seconds": 10}).json()
+    assert stats["samples"] > 0
+    assert stats["pid"] == os.getpid()
+    assert stats["rss_mb"] is None or stats["rss_mb"] > 0
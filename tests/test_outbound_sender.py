@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.outbound_sender import Outbox, TokenBucket, TwilioOutboundSender, split_message
+from tests.fake_twilio_server import FakeTwilioServer
+
+ACCOUNT_SID = "AC" + "0" * 32
+
+
+def _sender(server, tmp_path, **kwargs):
+    kwargs.setdefault("messages_per_second", 100)
+    kwargs.setdefault("backoff_base", 0.01)
+    return TwilioOutboundSender(ACCOUNT_SID, "token", "+10000000000", base_url=server.base_url,
+                                outbox_path=str(tmp_path / "outbox.sqlite3"), **kwargs)
+
+
+def test_split_message_on_boundaries():
+    text = "\n".join(f"Регион {i}: {'x' * 90}" for i in range(40))
+    chunks = split_message(text, limit=1600)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 1600 for chunk in chunks)
+    assert "\n".join(chunks) == text
+    assert split_message("коротко") == ["коротко"]
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=20, capacity=1)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.19
+
+
+def test_token_bucket_is_shared_between_workers(tmp_path):
+    # Два воркера с одним outbox делят один лимит, а не получают по своему
+    path = str(tmp_path / "outbox.sqlite3")
+    buckets = [TokenBucket(rate=20, capacity=1, outbox=Outbox(path)) for _ in range(2)]
+    started = time.monotonic()
+    for i in range(6):
+        buckets[i % 2].acquire()
+    assert time.monotonic() - started >= 0.24
+
+
+def test_retries_429_and_reports_retry_count(tmp_path):
+    with FakeTwilioServer(status=lambda n: 429 if n < 2 else 201) as server:
+        sender = _sender(server, tmp_path)
+        sender.send("+79990000000", "Выручка за июнь: 1549875 руб.")
+        assert sender.flush(timeout=5)
+        stats = sender.stats()
+        sender.close()
+
+    assert server.messages[0]["To"] == "whatsapp:+79990000000"
+    assert stats["sent"] == 1
+    assert stats["retries"] == 2
+    assert stats["latency_p50_seconds"] is not None
+
+
+def test_long_answer_delivered_in_order(tmp_path):
+    text = " ".join(f"слово{i}" for i in range(800))
+    with FakeTwilioServer(status=lambda n: 503 if n == 0 else 201) as server:
+        sender = _sender(server, tmp_path)
+        sender.send("+79990000000", text)
+        assert sender.flush(timeout=5)
+        sender.close()
+
+    bodies = [message["Body"] for message in server.messages]
+    assert len(bodies) == len(split_message(text))
+    assert " ".join(bodies) == text
+
+
+def test_permanent_error_is_not_retried(tmp_path):
+    with FakeTwilioServer(status=lambda n: 400) as server:
+        sender = _sender(server, tmp_path)
+        sender.send("+79990000000", "ответ")
+        assert sender.flush(timeout=5)
+        stats = sender.stats()
+        sender.close()
+
+    assert server.attempts == 1
+    assert stats["failed"] == 1
+
+
+def test_outbox_survives_restart(tmp_path):
+    with FakeTwilioServer(status=lambda n: 503) as server:
+        sender = _sender(server, tmp_path, backoff_base=30)
+        sender.send("+79990000000", "ответ после рестарта")
+        time.sleep(0.2)
+        sender.close()
+
+    with FakeTwilioServer() as server:
+        sender = _sender(server, tmp_path)
+        # Сообщение лежит в outbox с отложенным ретраем - подталкиваем его
+        sender.outbox._conn.execute("UPDATE outbox SET next_attempt_at = 0")
+        assert sender.flush(timeout=5)
+        sender.close()
+
+    assert [message["Body"] for message in server.messages] == ["ответ после рестарта"]
+
+
+def _dead_pid() -> int:
+    import subprocess
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_dead_worker_does_not_block_recipient(tmp_path):
+    path = str(tmp_path / "outbox.sqlite3")
+    crashed = Outbox(path)
+    first, second = crashed.enqueue("+79990000000", ["часть 1", "часть 2"])
+    assert crashed.claim_next()["id"] == first
+    # Воркер умер посреди отправки первого куска
+    crashed._conn.execute("UPDATE outbox SET claimed_by = ? WHERE id = ?", (_dead_pid(), first))
+    crashed.close()
+
+    outbox = Outbox(path)
+    assert outbox.claim_next()["id"] == first
+    outbox.mark_sent(first, 1)
+    assert outbox.claim_next()["id"] == second
+    # Строку живого воркера не забираем
+    assert outbox.claim_next() is None
+    assert outbox.counts() == {"sent": 1, "sending": 1}
+    outbox.close()
+
+
+def test_sent_rows_are_pruned_and_recipient_lookup_is_indexed(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.sqlite3"))
+    old, recent = outbox.enqueue("+79990000000", ["старое", "новое"])
+    for message_id in (old, recent):
+        outbox.claim_next()
+        outbox.mark_sent(message_id, 1)
+    outbox._conn.execute("UPDATE outbox SET sent_at = 0 WHERE id = ?", (old,))
+    assert outbox.prune_sent() == 1
+    assert outbox.counts() == {"sent": 1}
+
+    plan = " ".join(row[-1] for row in outbox._conn.execute(
+        "EXPLAIN QUERY PLAN SELECT 1 FROM outbox WHERE to_number = ? AND id < ? AND status IN ('pending', 'sending')",
+        ("+79990000000", 10)))
+    assert "outbox_recipient" in plan
+    outbox.close()
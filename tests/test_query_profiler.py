@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import numpy as np
+import pytest
+
+from src.data_processor import DataProcessor
+from src.query_profiler import ExecutionProfile, QueryProfiler, code_hash, load_slow_log, normalize_code, report_from_log
+
+
+def test_code_shape_ignores_literals_but_not_columns():
+    june = "result = orders_df[orders_df['order_date'] >= '2024-06-01']['order_amount'].sum()"
+    may = "result = orders_df[orders_df['order_date'] >= '2024-05-01']['order_amount'].sum()"
+    other_column = "result = orders_df[orders_df['order_date'] >= '2024-06-01']['user_id'].nunique()"
+    assert code_hash(june) == code_hash(may)
+    assert code_hash(june) != code_hash(other_column)
+    assert "STR" in normalize_code(june) and "'order_amount'" in normalize_code(june)
+
+
+@pytest.mark.parametrize("memory_mode", ["rss", "tracemalloc"])
+def test_profiles_every_execution(tmp_path, memory_mode):
+    profiler = QueryProfiler(slow_threshold_seconds=60, log_path=str(tmp_path / "slow.jsonl"), memory_mode=memory_mode)
+    processor = DataProcessor(profiler=profiler)
+    code = "result = orders_df.groupby('status')['order_amount'].sum()"
+    result, error = processor.execute_pandas_query(code)
+    assert error is None
+    processor.execute_pandas_query("result = users_df['missing'].sum()")
+    # Прогоны оптимизатора на выборке не профилируются
+    processor.execute_on_sample(code)
+
+    report = profiler.report()
+    assert report["executions"] == 2
+    top = {row["code_hash"]: row for row in report["top"]}
+    assert top[code_hash(code)]["max_rows_touched"] == len(processor.orders_df)
+    assert top[code_hash("result = users_df['missing'].sum()")]["errors"] == 1
+    if memory_mode == "tracemalloc":
+        assert top[code_hash(code)]["max_peak_memory_bytes"] > 0
+    # Порог не превышен - журнал пуст
+    assert list(load_slow_log(str(tmp_path / "slow.jsonl"))) == []
+    profiler.close()
+
+
+def test_slow_executions_go_to_rotating_log(tmp_path):
+    log_path = str(tmp_path / "slow.jsonl")
+    profiler = QueryProfiler(slow_threshold_seconds=0.0, log_path=log_path, max_log_bytes=2000, log_backups=5)
+    for month in range(1, 13):
+        profiler.record(ExecutionProfile(
+            code_hash=code_hash(f"result = orders_df[orders_df['order_date'].dt.month == {month}]"),
+            wall_seconds=0.1 * month, cpu_seconds=0.1, peak_memory_bytes=1024, memory_source="rss",
+            rows_touched=200, result_rows=10, error=None,
+            code=f"result = orders_df[orders_df['order_date'].dt.month == {month}]"
+        ))
+    profiler.record(ExecutionProfile(
+        code_hash=code_hash("result = len(users_df)"), wall_seconds=5.0, cpu_seconds=5.0, peak_memory_bytes=0,
+        memory_source="rss", rows_touched=150, result_rows=None, error=None, code="result = len(users_df)"
+    ))
+    profiler.close()
+
+    # У процесса свой файл журнала, ротируется он независимо от других воркеров
+    assert profiler.log_path == str(tmp_path / f"slow.{os.getpid()}.jsonl")
+    assert os.path.exists(profiler.log_path + ".1")
+    assert len(list(load_slow_log(log_path))) == 13
+
+    top = report_from_log(log_path, top_n=2)
+    assert [row["executions"] for row in top] == [12, 1]
+    assert top[0]["max_wall_seconds"] == pytest.approx(1.2)
+    assert report_from_log(log_path, top_n=1, order_by="max_wall_seconds")[0]["normalized_code"] == "result = len(users_df)"
+
+
+def test_slow_log_reads_files_of_all_workers(tmp_path):
+    log_path = str(tmp_path / "slow.jsonl")
+    profile = ExecutionProfile(code_hash=code_hash("result = len(users_df)"), wall_seconds=1.0, cpu_seconds=1.0,
+                               peak_memory_bytes=0, memory_source="rss", rows_touched=150, result_rows=None,
+                               error=None, code="result = len(users_df)")
+    profiler = QueryProfiler(slow_threshold_seconds=0.0, log_path=log_path)
+    profiler.record(profile)
+    profiler.close()
+    # Журнал другого воркера рядом с нашим
+    with open(profiler.log_path, encoding="utf-8") as f, open(tmp_path / "slow.1.jsonl", "w", encoding="utf-8") as other:
+        other.write(f.read())
+
+    assert len(list(load_slow_log(log_path))) == 2
+    assert report_from_log(log_path)[0]["executions"] == 2
+
+
+def test_rss_mode_measures_growth_after_earlier_peak(tmp_path):
+    profiler = QueryProfiler(log_path=None, memory_mode="rss")
+
+    def allocate(megabytes):
+        def run():
+            block = np.ones(megabytes * 2 ** 20 // 8)
+            time.sleep(0.05)
+            return float(block[-1]), None
+        return run
+
+    # После большего пика ru_maxrss уже не растет - замер по нему дал бы 0
+    profiler.profile("result = len(users_df)", 0, allocate(240))
+    profiler.profile("result = len(orders_df)", 0, allocate(160))
+
+    top = {row["code_hash"]: row for row in profiler.report()["top"]}
+    assert top[code_hash("result = len(users_df)")]["max_peak_memory_bytes"] > 200 * 2 ** 20
+    assert top[code_hash("result = len(orders_df)")]["max_peak_memory_bytes"] > 120 * 2 ** 20
@@ -0,0 +1,163 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import pytest
+
+from src.answer_evaluator import AnswerEvaluator
+from src.data_processor import DataProcessor
+from src.reference_answers import REFERENCES, ReferenceChecker, extract_numbers
+
+ACTIVE_BY_REGION, CONVERSION, AVERAGE_CHECK = REFERENCES[0][0], REFERENCES[1][0], REFERENCES[2][0]
+TOP_REGIONS, CANCELED_SHARE, DAILY_REGISTRATIONS = REFERENCES[4][0], REFERENCES[5][0], REFERENCES[8][0]
+
+
+@pytest.fixture(scope="module")
+def checker():
+    return ReferenceChecker(DataProcessor())
+
+
+def test_extracts_russian_number_formats():
+    numbers = extract_numbers("Выручка 1 234 567,5 руб., доля 34,2 %, около 1,2 млн; с 2024-06-01 по 30.06.2024, было -5")
+    assert [number.value for number in numbers] == [1234567.5, 34.2, 1200000.0, -5.0]
+    assert [number.percent for number in numbers] == [False, True, False, False]
+    # Точность записи задает допуск: "1,2 млн" покрывает 1 150 000..1 250 000
+    assert numbers[2].rounding == pytest.approx(50000)
+
+
+def test_every_canonical_question_has_a_reference(checker):
+    for question, _ in REFERENCES:
+        variants = checker.expected(question)
+        assert variants and all(variants.values()), question
+    assert checker.expected("Привет, как дела?") is None
+
+
+def test_correct_answer_scores_five(checker):
+    expected = checker.expected(AVERAGE_CHECK)["completed заказы"]
+    answer = "Средний чек за июнь: " + ", ".join(f"{item.label} - {item.value:,.0f} руб.".replace(",", " ") for item in expected)
+    check = checker.check(AVERAGE_CHECK, answer)
+    assert check.score == 5
+    assert check.variant == "completed заказы"
+
+
+def test_percent_may_be_written_as_share_or_rounded(checker):
+    share = checker.expected(CANCELED_SHARE)["доля от всех заказов"][0].value
+    assert checker.check(CANCELED_SHARE, f"Доля отмененных заказов: {share:.1f}%".replace(".", ",")).score == 5
+    assert checker.check(CANCELED_SHARE, f"Доля отмененных заказов: {round(share)}%").score == 5
+    assert checker.check(CANCELED_SHARE, f"Доля отмененных: {share / 100:.3f}").score == 5
+    assert checker.check(CANCELED_SHARE, f"Доля отмененных заказов: {share + 3:.1f}%").score == 1
+
+
+def test_partial_answer_gets_partial_score(checker):
+    expected = checker.expected(DAILY_REGISTRATIONS)["регистрации по дням"]
+    half = expected[:len(expected) // 2 + 1]
+    answer = "; ".join(f"{item.label}: {item.value:.0f}" for item in half)
+    assert checker.check(DAILY_REGISTRATIONS, answer).score == 3
+
+
+def test_picks_closest_interpretation(checker):
+    # "Активные" можно посчитать по флагу is_active - это тоже верный ответ
+    expected = checker.expected(ACTIVE_BY_REGION)["is_active"]
+    answer = ", ".join(f"{item.label}: {item.value:.0f}" for item in expected)
+    check = checker.check(ACTIVE_BY_REGION, answer)
+    assert (check.score, check.variant) == (5, "is_active")
+
+
+def test_reference_is_recomputed_after_snapshot_change():
+    processor = DataProcessor()
+    checker = ReferenceChecker(processor)
+    before = checker.expected(CANCELED_SHARE)["доля от всех заказов"][0].value
+    orders = processor.orders_df.copy()
+    orders.loc[orders['status'] == 'canceled', 'status'] = 'completed'
+    processor._use_frames({'users_df': processor.users_df, 'orders_df': orders})
+    assert before > 0
+    assert checker.expected(CANCELED_SHARE)["доля от всех заказов"][0].value == 0
+
+
+class _FailingCompletions:
+    def create(self, **kwargs):
+        raise AssertionError("LLM судья не должен вызываться для вопроса с эталоном")
+
+
+def test_evaluator_skips_llm_judge_for_referenced_questions(checker):
+    evaluator = AnswerEvaluator("sk-test", reference_checker=checker)
+    evaluator.client.chat.completions = _FailingCompletions()
+    expected = checker.expected(CONVERSION)["completed заказы"][0].value
+    result = evaluator._evaluate_correctness(CONVERSION, f"Конверсия в покупку за июнь - {expected:.1f}%", "")
+    assert result.score == 5
+    assert "эталон" in result.reasoning
+
+    # Вопрос без эталона уходит к судье; ошибка судьи дает пустую оценку, а не исключение
+    assert evaluator._evaluate_correctness("Сколько заказов в мае?", "12", "").score is None
+
+
+def test_values_are_bound_to_their_labels(checker):
+    expected = [item for item in checker.expected(ACTIVE_BY_REGION)["вход в июне"] if item.required]
+    labels, values = [item.label for item in expected], [item.value for item in expected]
+    correct = "\n".join(f"{n}. {value:.0f} активных пользователей в регионе {label}"
+                        for n, (label, value) in enumerate(zip(labels, values), start=1))
+    assert checker.check(ACTIVE_BY_REGION, correct).score == 5
+
+    # Те же пять чисел, но у чужих регионов
+    shuffled = ", ".join(f"{label}: {value:.0f}" for label, value in zip(labels, values[1:] + values[:1]))
+    check = checker.check(ACTIVE_BY_REGION, shuffled)
+    assert check.score < 5
+    assert check.wrong
+
+
+def test_top_regions_checks_region_names(checker):
+    expected = checker.expected(TOP_REGIONS)["регистрации в июне"]
+    rows = [(item.label, item.value) for item in expected]
+    assert checker.check(TOP_REGIONS, "\n".join(f"{n}. {label} — {value:.0f}" for n, (label, value) in
+                                                enumerate(rows, start=1))).score == 5
+
+    outsider = next(region for region in checker.data_processor.users_df['region'].unique()
+                    if region not in {label for label, _ in rows})
+    rows[1] = (outsider, rows[1][1])
+    check = checker.check(TOP_REGIONS, "; ".join(f"{label} — {value:.0f}" for label, value in rows))
+    assert check.score < 5
+    assert any(outsider in item for item in check.unexpected)
+
+
+def test_inline_list_markers_are_not_numbers(checker):
+    rows = [(item.label, item.value) for item in checker.expected(TOP_REGIONS)["регистрации в июне"]]
+    answer = "Топ-3 городов: " + ", ".join(f"{n}. {label} - {value:.0f}" for n, (label, value) in enumerate(rows, start=1))
+    check = checker.check(TOP_REGIONS, answer)
+    assert (check.score, check.unexpected) == (5, [])
+
+
+def test_every_number_next_to_a_label_is_checked(checker):
+    rows = [(item.label, item.value) for item in checker.expected(TOP_REGIONS)["регистрации в июне"]]
+    answer = "; ".join(f"{label} - {value:.0f}" for label, value in rows)
+    assert checker.check(TOP_REGIONS, answer).score == 5
+    # Лишняя цифра у первой метки: раньше второе число участка молча пропускалось
+    label, value = rows[0]
+    check = checker.check(TOP_REGIONS, answer.replace(f"{label} - {value:.0f}", f"{label} - {value:.0f} (рост на 4 000)"))
+    assert check.score < 5
+    assert check.unexpected == ["4000"]
+
+
+def test_unexpected_numbers_lower_the_score(checker):
+    conversion = checker.expected(CONVERSION)["completed заказы"]
+    share, part, whole = (item.value for item in conversion)
+    answer = f"Конверсия за июнь - {share:.1f}% ({part:.0f} из {whole:.0f} зарегистрированных)".replace(".", ",")
+    assert checker.check(CONVERSION, answer).score == 5
+    assert checker.check(CONVERSION, answer + f", из них {whole * 3:.0f} купили повторно").score < 5
+
+
+def test_unbound_numbers_leave_the_decision_to_the_judge(checker):
+    values = [item.value for item in checker.expected(ACTIVE_BY_REGION)["вход в июне"] if item.required]
+    check = checker.check(ACTIVE_BY_REGION, "Активных пользователей: " + ", ".join(f"{value:.0f}" for value in values))
+    assert not check.decided
+
+    evaluator = AnswerEvaluator("sk-test", reference_checker=checker)
+    calls = []
+
+    class _RecordingCompletions:
+        def create(self, **kwargs):
+            calls.append(kwargs)
+            raise RuntimeError("judge unavailable")
+
+    evaluator.client.chat.completions = _RecordingCompletions()
+    evaluator._evaluate_correctness(ACTIVE_BY_REGION, "Активных пользователей: 12, 11", "")
+    assert calls
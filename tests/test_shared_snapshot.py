@@ -0,0 +1,117 @@
+import mmap
+import os
+import subprocess
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import numpy as np
+import pandas as pd
+
+from src.data_processor import DataProcessor
+from src.shared_snapshot import SharedSnapshotStore
+
+
+def _frames():
+    users = pd.DataFrame({
+        "user_id": [1, 2, 3, 4],
+        "region": ["Москва", "Казань", "Москва", "Москва"],
+        "registration_date": pd.to_datetime(["2024-06-01", "2024-06-02", "2024-06-03", None]),
+        "is_active": [True, False, True, True],
+    })
+    return {"users_df": users}
+
+
+def _is_mmap_backed(array) -> bool:
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, "base", None)
+    return False
+
+
+def test_workers_attach_to_one_published_version(tmp_path):
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return _frames()
+
+    store = SharedSnapshotStore(str(tmp_path))
+    first = store.load("key-1", loader)
+    second = store.load("key-1", loader)
+
+    assert len(loads) == 1
+    assert first.version == second.version == "v1"
+    users = second.frames["users_df"]
+    assert users["region"].tolist() == ["Москва", "Казань", "Москва", "Москва"]
+    assert users["registration_date"].isna().tolist() == [False, False, False, True]
+    assert users["is_active"].sum() == 3
+    # Колонки смотрят прямо в mmap файлов снапшота, без копии в памяти процесса
+    assert _is_mmap_backed(users["user_id"].to_numpy())
+    assert _is_mmap_backed(users["registration_date"].to_numpy())
+    # Строки декодируются в object: сгенерированный код видит те же типы, что после read_csv
+    assert users["region"].dtype == object
+
+
+def test_refresh_switches_version_and_collects_old_one(tmp_path):
+    store = SharedSnapshotStore(str(tmp_path))
+    snapshot = store.load("key-1", _frames)
+
+    updated = _frames()
+    updated["users_df"].loc[0, "region"] = "Новосибирск"
+    store.publish(updated, "key-2")
+    assert os.path.isdir(tmp_path / "v1")
+
+    assert snapshot.refresh()
+    assert snapshot.version == "v2"
+    assert snapshot.frames["users_df"]["region"].iloc[0] == "Новосибирск"
+    assert not os.path.isdir(tmp_path / "v1")
+
+
+def test_dead_worker_lease_does_not_pin_version(tmp_path):
+    store = SharedSnapshotStore(str(tmp_path))
+    store.publish(_frames(), "key-1")
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    open(tmp_path / "v1" / "leases" / str(dead.pid), "w").close()
+
+    store.publish(_frames(), "key-2")
+    assert not os.path.isdir(tmp_path / "v1")
+
+
+def test_data_processor_runs_queries_on_shared_snapshot(tmp_path):
+    processor = DataProcessor(snapshot_store=SharedSnapshotStore(str(tmp_path)))
+    plain = DataProcessor()
+    code = "result = orders_df[orders_df['status'] == 'completed'].groupby(orders_df['order_date'].dt.day)['order_amount'].sum().max()"
+    assert processor.execute_pandas_query(code) == plain.execute_pandas_query(code)
+    grouped = ("result = orders_df[orders_df['status'] == 'completed']"
+               ".groupby('status')['order_amount'].sum().to_dict()")
+    assert processor.execute_pandas_query(grouped) == plain.execute_pandas_query(grouped)
+    assert list(processor.execute_pandas_query(grouped)[0]) == ["completed"]
+    assert processor.get_data_schema() == plain.get_data_schema()
+
+    # Запись в фрейм идет в копию воркера, а не в read-only mmap
+    result, error = processor.execute_pandas_query(
+        "orders_df.loc[orders_df['status'] == 'canceled', 'order_amount'] = 0\nresult = orders_df['order_amount'].sum()")
+    assert error is None
+    assert processor.orders_df["order_amount"].iloc[0] == plain.orders_df["order_amount"].iloc[0]
+
+
+def test_changed_csv_is_published_on_next_refresh(tmp_path, monkeypatch):
+    import src.data_processor as data_processor_module
+    users = pd.read_csv(data_processor_module.DATA_FILES["users_df"])
+    users_path = tmp_path / "users.csv"
+    users.to_csv(users_path, index=False)
+    monkeypatch.setitem(data_processor_module.DATA_FILES, "users_df", str(users_path))
+    monkeypatch.setattr(data_processor_module, "INGEST_FILES", {})
+
+    store = SharedSnapshotStore(str(tmp_path / "snapshot"))
+    worker_a = DataProcessor(snapshot_store=store)
+    worker_b = DataProcessor(snapshot_store=store)
+    assert not worker_a.refresh_snapshot()
+
+    pd.concat([users, users.tail(1).assign(user_id=users["user_id"].max() + 1)]).to_csv(users_path, index=False)
+    assert worker_a.refresh_snapshot()
+    assert worker_b.refresh_snapshot()
+    assert worker_a.snapshot.version == worker_b.snapshot.version
+    assert len(worker_b.users_df) == len(users) + 1
@@ -0,0 +1,50 @@
+import os
+import sys
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.smalltalk_classifier import DATA_LABEL, TEMPLATES, SmallTalkClassifier, load_examples
+
+
+def _model():
+    return SmallTalkClassifier.train(load_examples())
+
+
+def test_smalltalk_answered_from_templates():
+    model = _model()
+    assert model.route("Привет!") == "greeting"
+    assert model.route("спасибо большое") == "thanks"
+    assert model.route("что ты умеешь?") == "capabilities"
+    assert model.answer("спасибо") == TEMPLATES["thanks"]
+
+
+def test_data_questions_pass_through():
+    model = _model()
+    for text in [
+        "Сколько заказов было в июне 2024?",
+        "привет, сколько пользователей в Москве?",
+        "спасибо, а средний чек?",
+        "а за май?",
+    ]:
+        assert model.route(text) == DATA_LABEL, text
+
+
+# Вопросы к данным, которые модель уверенно (p > 0.9) принимала за small talk
+UNSEEN_DATA_QUESTIONS = [
+    "самый дорогой товар", "сравни города", "как дела с продажами?", "как там продажи?",
+    "как идут продажи", "что по деньгам", "какие категории",
+]
+
+
+@pytest.mark.parametrize("text", UNSEEN_DATA_QUESTIONS)
+def test_unseen_words_are_not_answered_from_templates(text):
+    assert _model().route(text) == DATA_LABEL
+
+
+def test_saved_model_matches_training(tmp_path):
+    model = _model()
+    path = tmp_path / "model.json"
+    model.save(str(path))
+    loaded = SmallTalkClassifier.load(str(path))
+    assert loaded.predict_proba("добрый день") == pytest.approx(model.predict_proba("добрый день"))
+    assert SmallTalkClassifier.load(str(tmp_path / "missing.json")) is None
@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.speculative import result_fingerprint, run_candidates
+
+
+def _fake_execute(outputs):
+    def execute(code):
+        delay, result, error = outputs[code]
+        time.sleep(delay)
+        return result, error
+    return execute
+
+
+def test_fingerprint_ignores_float_noise():
+    assert result_fingerprint(25.4) == result_fingerprint(25.400000001)
+    assert result_fingerprint({"a": 1, "b": 2}) == result_fingerprint({"b": 2, "a": 1})
+
+
+def test_majority_wins_over_first_candidate():
+    execute = _fake_execute({
+        "a": (0.0, 10, None),
+        "b": (0.01, 12, None),
+        "c": (0.02, 12, None),
+    })
+    outcome = run_candidates(execute, ["a", "b", "c"])
+    assert outcome.code == "b"
+    assert outcome.result == 12
+    assert outcome.agreement == round(2 / 3, 3)
+
+
+def test_failed_candidates_are_skipped():
+    execute = _fake_execute({
+        "a": (0.0, None, "KeyError: 'amount'"),
+        "b": (0.0, 5, None),
+    })
+    outcome = run_candidates(execute, ["a", "b"])
+    assert outcome.code == "b"
+    assert outcome.error is None
+    assert outcome.agreement == 1.0
+
+
+def test_all_candidates_failed():
+    execute = _fake_execute({
+        "a": (0.0, None, "KeyError: 'amount'"),
+        "b": (0.0, None, "NameError: name 'x' is not defined"),
+    })
+    outcome = run_candidates(execute, ["a", "b"])
+    assert outcome.code == "a"
+    assert outcome.error == "KeyError: 'amount'"
+    assert outcome.agreement is None
@@ -0,0 +1,165 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+import pytest
+
+from src.data_processor import DataProcessor
+from src.reply_latency import RollingLatency
+from src.whatsapp_bot import ACK_MESSAGE, EVALUATION_HEADER, WhatsAppBot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SENDER = "whatsapp:+79990000000"
+JUNE_REVENUE = """june = orders_df[(orders_df['order_date'] >= '2024-06-01') & (orders_df['order_date'] <= '2024-06-30')]
+result = june[june['status'] == 'completed']['order_amount'].sum()"""
+
+
+class FakeAgent:
+    """Уточнение "а за май?" отвечается подстановкой в прошлый код, без графа"""
+    smalltalk_classifier = None
+
+    def answer_with_code(self, query, code, deadline):
+        return {"final_answer": "В мае выручка 0 руб.", "pandas_code": code, "execution_result": 0,
+                "query_type": "followup", "requires_data_analysis": True}
+
+
+class FakeEvaluator:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+
+    def evaluate_answer(self, *args, **kwargs):
+        if self.fail:
+            raise RuntimeError("evaluator is down")
+        return {"correctness": 5, "correctness_reasoning": "", "conciseness": 5, "conciseness_reasoning": "",
+                "code_checker": 5, "code_reasoning": "", "overall_score": 5, "evaluation_text": "Оценка: 5/5"}
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    bot = WhatsAppBot("AC123", "token", "+10000000000", "sk-test", data_processor=DataProcessor(),
+                      ack_threshold_seconds=5.0, reply_latency=RollingLatency(min_samples=3, default_seconds=10.0))
+    bot._analytics_agent = FakeAgent()
+    bot._answer_evaluator = FakeEvaluator()
+    bot.conversations.remember(SENDER, "выручка за июнь", JUNE_REVENUE)
+    return bot
+
+
+def test_rolling_latency_predicts_upper_quantile_per_type():
+    latency = RollingLatency(window=10, quantile=0.75, min_samples=3, default_seconds=10.0)
+    assert latency.predict("data") == 10.0
+    for seconds in [1, 2, 3, 4]:
+        latency.record("data", seconds)
+    latency.record("followup", 0.5)
+    assert latency.predict("data") == 4
+    # Замеров мало - остаемся на осторожном значении по умолчанию
+    assert latency.predict("followup") == 10.0
+    for _ in range(10):
+        latency.record("data", 0.1)
+    assert latency.predict("data") == 0.1
+    assert latency.stats()["data"] == {"samples": 10, "predicted_seconds": 0.1}
+
+
+def test_staged_reply_acknowledges_then_answers_then_evaluates(bot):
+    delivered = []
+    rest = bot.handle_message(SENDER, "а за май?", deliver=delivered.append)
+    # Замеров еще нет: прогноз по умолчанию выше порога, "считаю…" уходит первым
+    assert delivered == [ACK_MESSAGE, "В мае выручка 0 руб."]
+    assert rest == f"{EVALUATION_HEADER}\nОценка: 5/5"
+    assert bot.reply_latency.stats()["followup"]["samples"] == 1
+
+
+def test_fast_query_type_is_answered_without_acknowledgement(bot):
+    for _ in range(3):
+        bot.reply_latency.record("followup", 0.2)
+    delivered = []
+    bot.handle_message(SENDER, "а за май?", deliver=delivered.append)
+    assert delivered == ["В мае выручка 0 руб."]
+
+
+def test_evaluation_failure_after_answer_is_not_reported_to_user(bot):
+    bot._answer_evaluator = FakeEvaluator(fail=True)
+    delivered = []
+    assert bot.handle_message(SENDER, "а за май?", deliver=delivered.append) == ""
+    assert delivered[-1] == "В мае выручка 0 руб."
+
+
+def test_single_reply_mode_keeps_answer_and_evaluation_together(bot):
+    reply = bot.handle_message(SENDER, "а за май?")
+    assert reply == f"В мае выручка 0 руб.\n\n{EVALUATION_HEADER}\nОценка: 5/5"
+
+
+def test_evaluation_is_skipped_when_followup_is_off(bot):
+    calls = []
+    bot._answer_evaluator.evaluate_answer = lambda *args, **kwargs: calls.append(args)
+    bot.evaluation_followup = False
+    delivered = []
+    assert bot.handle_message(SENDER, "а за май?", deliver=delivered.append) == ""
+    assert delivered[-1] == "В мае выручка 0 руб."
+    assert calls == []
+
+
+def test_cancel_after_delivered_answer_only_drops_evaluation(bot):
+    delivered = []
+
+    def answered():
+        return "В мае выручка 0 руб." in delivered
+
+    assert bot.handle_message(SENDER, "а за май?", is_cancelled=answered, deliver=delivered.append) == ""
+
+
+@pytest.mark.parametrize("supersede_on, cancelled", [(ACK_MESSAGE, 1), ("В мае выручка 0 руб.", 0)])
+def test_webhook_counts_cancelled_only_without_delivered_answer(bot, monkeypatch, supersede_on, cancelled):
+    import asyncio
+    import app as app_module
+
+    lanes = app_module.SenderLanes(cancel_superseded=True)
+    monkeypatch.setattr(app_module, "_bot", bot)
+    monkeypatch.setattr(app_module, "staged_replies", True)
+    monkeypatch.setattr(app_module, "sender_lanes", lanes)
+    monkeypatch.setattr(app_module, "message_deduplicator", app_module.MessageDeduplicator())
+    monkeypatch.setattr(app_module, "resend_tracker", app_module.ResendTracker())
+    sent = []
+
+    def send_message(to_number, message):
+        sent.append(message)
+        if message == supersede_on:
+            # Пока идет ответ, тот же отправитель прислал новый вопрос
+            lanes.ticket(SENDER)
+
+    bot.send_message = send_message
+    asyncio.run(app_module.whatsapp_webhook(None, Body="а за май?", From=SENDER, MessageSid="SM1"))
+    assert lanes.stats()["cancelled"] == cancelled
+    assert ("В мае выручка 0 руб." in sent) == (not cancelled)
+    # Оценка устаревшего вопроса не отправляется
+    assert not any(EVALUATION_HEADER in message for message in sent)
+
+
+def test_webhook_stats_report_resends_by_mode(monkeypatch):
+    from fastapi.testclient import TestClient
+    import app as app_module
+
+    monkeypatch.setenv("WARMUP_ON_STARTUP", "false")
+    monkeypatch.setattr(app_module, "resend_tracker", app_module.ResendTracker())
+    app_module.resend_tracker.observe("whatsapp:+1", "выручка за июнь", "staged")
+    app_module.resend_tracker.observe("whatsapp:+1", "Выручка за июнь?", "staged")
+    with TestClient(app_module.app) as client:
+        stats = client.get("/stats/webhook").json()
+    assert stats["reply_mode"] == ("staged" if app_module.staged_replies else "single")
+    assert stats["resends"]["staged"]["resend_rate"] == 0.5
+    assert isinstance(stats["reply_latency"], dict)
+
+
+def test_chained_followups_do_not_accumulate_clarifications(bot):
+    queries = []
+    agent_answer = bot._analytics_agent.answer_with_code
+    bot._analytics_agent.answer_with_code = lambda query, code, deadline: queries.append(query) or agent_answer(query, code, deadline)
+
+    for message in ["а за май?", "а за июль?", "а отмененных?"]:
+        bot.handle_message(SENDER, message)
+
+    assert queries[-1] == "выручка за июнь\nУточнение: месяц - июль, статус - canceled"
+    turn = bot.conversations.get(SENDER)
+    assert turn.query == "выручка за июнь"
+    assert turn.params == {"month": 7, "status": "canceled"}
+    assert "'2024-07-31'" in turn.pandas_code and "'canceled'" in turn.pandas_code
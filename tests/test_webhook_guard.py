@@ -0,0 +1,152 @@
+import asyncio
+import os
+import subprocess
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(__file__))))
+
+from src.webhook_guard import MessageDeduplicator, ResendTracker, SenderLanes
+
+
+def test_duplicate_message_sid_is_skipped():
+    dedupe = MessageDeduplicator()
+    assert dedupe.first_seen("SM1")
+    assert not dedupe.first_seen("SM1")
+    assert dedupe.first_seen("SM2")
+    assert dedupe.first_seen(None)
+    assert dedupe.duplicates == 1
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_shared_index_dedupes_across_workers_and_recovers_from_crash(tmp_path):
+    path = str(tmp_path / "webhook_state.sqlite3")
+    worker_a, worker_b = MessageDeduplicator(path=path), MessageDeduplicator(path=path)
+    assert worker_a.first_seen("SM1")
+    # Ретрай попал в другой воркер, пока первый еще отвечает
+    assert not worker_b.first_seen("SM1")
+    worker_a.finish("SM1")
+    assert not worker_b.first_seen("SM1")
+
+    # Воркер упал, не дойдя до finish: ретрай Twilio обрабатывается заново
+    assert worker_a.first_seen("SM2")
+    worker_a._conn.execute("UPDATE webhook_messages SET owner_pid = ? WHERE message_sid = 'SM2'", (_dead_pid(),))
+    assert worker_b.first_seen("SM2")
+    assert worker_b.duplicates == 2
+
+
+def _simulate(lanes: SenderLanes | list, messages, gap: float = 0.001):
+    order = []
+
+    workers = lanes if isinstance(lanes, list) else [lanes]
+
+    async def handle(lanes, sender, text, delay):
+        ticket = lanes.ticket(sender)
+        async with lanes.lane(ticket):
+            if ticket.is_superseded():
+                lanes.record_cancelled(ticket)
+                return
+            order.append(("start", sender, text))
+            await asyncio.sleep(delay)
+            if ticket.is_superseded():
+                lanes.record_cancelled(ticket)
+                return
+            order.append(("done", sender, text))
+
+    async def main():
+        tasks = []
+        for i, (sender, text, delay) in enumerate(messages):
+            tasks.append(asyncio.create_task(handle(workers[i % len(workers)], sender, text, delay)))
+            await asyncio.sleep(gap)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    return order
+
+
+def test_one_sender_is_processed_in_order():
+    lanes = SenderLanes()
+    order = _simulate(lanes, [("a", "1", 0.03), ("a", "2", 0.0), ("b", "1", 0.0)])
+    a_events = [event for event in order if event[1] == "a"]
+    assert a_events == [("start", "a", "1"), ("done", "a", "1"), ("start", "a", "2"), ("done", "a", "2")]
+    # Другой отправитель не ждет первого
+    assert order.index(("done", "b", "1")) < order.index(("done", "a", "1"))
+    assert lanes.stats()["active_senders"] == 0
+
+
+def test_newer_message_cancels_superseded_ones():
+    lanes = SenderLanes(cancel_superseded=True)
+    order = _simulate(lanes, [("a", "1", 0.03), ("a", "2", 0.0), ("a", "3", 0.0)])
+    assert ("done", "a", "1") not in order
+    assert ("start", "a", "2") not in order
+    assert order[-1] == ("done", "a", "3")
+    assert lanes.cancelled == 2
+
+
+def test_shared_lanes_keep_order_and_cancel_across_workers(tmp_path):
+    path = str(tmp_path / "webhook_state.sqlite3")
+    workers = [SenderLanes(path=path), SenderLanes(path=path)]
+    order = _simulate(workers, [("a", "1", 0.1), ("a", "2", 0.0), ("b", "1", 0.0)])
+    a_events = [event for event in order if event[1] == "a"]
+    assert a_events == [("start", "a", "1"), ("done", "a", "1"), ("start", "a", "2"), ("done", "a", "2")]
+
+    workers = [SenderLanes(cancel_superseded=True, path=path), SenderLanes(cancel_superseded=True, path=path)]
+    # Проверка очереди в SQLite идет в потоке: второе сообщение приходит, когда первое уже начато
+    order = _simulate(workers, [("a", "1", 0.2), ("a", "2", 0.0)], gap=0.05)
+    # Первое сообщение отменено в своем воркере, второе ждало его в другом
+    assert order == [("start", "a", "1"), ("start", "a", "2"), ("done", "a", "2")]
+    assert workers[0].cancelled == 1
+
+
+def test_locked_database_does_not_stall_event_loop(tmp_path):
+    import sqlite3
+    import threading
+    import time
+
+    path = str(tmp_path / "webhook_state.sqlite3")
+    lanes = SenderLanes(path=path)
+    other_worker = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    gaps, released_in = [], []
+
+    async def ticker(stop: asyncio.Event):
+        last = time.perf_counter()
+        while not stop.is_set():
+            await asyncio.sleep(0.01)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    async def main():
+        stop = asyncio.Event()
+        tick = asyncio.create_task(ticker(stop))
+        async with lanes.lane(lanes.ticket("a")):
+            # Другой воркер держит запись в базе 0.3 с: выход из очереди ждет ее
+            other_worker.execute("BEGIN IMMEDIATE")
+            threading.Timer(0.3, other_worker.execute, args=("COMMIT",)).start()
+            started = time.perf_counter()
+        released_in.append(time.perf_counter() - started)
+        stop.set()
+        await tick
+
+    asyncio.run(main())
+    assert released_in[0] > 0.2
+    assert max(gaps) < 0.15
+    other_worker.close()
+
+
+def test_resends_are_counted_per_reply_mode():
+    tracker = ResendTracker()
+    assert not tracker.observe("a", "Какая выручка за июнь?", "single")
+    # Тот же вопрос другим MessageSid до ответа - повтор от нетерпения
+    assert tracker.observe("a", "какая выручка за июнь", "single")
+    tracker.replied("a")
+    assert tracker.observe("a", "Какая выручка за июнь?", "single")
+    assert not tracker.observe("b", "Какая выручка за июнь?", "staged")
+    assert not tracker.observe("a", "а за май?", "staged")
+
+    stats = tracker.stats()
+    assert stats["single"] == {"messages": 3, "resends": 2, "resends_before_reply": 1, "resend_rate": 0.6667}
+    assert stats["staged"]["resends"] == 0